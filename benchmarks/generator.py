@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import random
+from dataclasses import dataclass, field, replace
+from functools import cached_property
+from datetime import datetime, timedelta, timezone
+
+# Runs are generated relative to this instant unless another is given, so the same seed always gives the same files.
+DEFAULT_NOW = datetime(2025, 11, 5, 20, 0, tzinfo=timezone.utc)
+
+# The fields of a Nayax lastSales entry, with the values that are the same for every synthetic sale.
+_STATIC_SALE_FIELDS = {
+    "PaymentServiceProviderName": "Stripe",
+    "CurrencyCode": "USD",
+    "PaymentMethod": "Credit Card",
+    "RecognitionMethod": "Chip",
+    "CardNumber": "************1234",
+    "CLI": "+1234567890",
+    "UnitOfMeasurement": "Item",
+    "EnergyConsumed": 0,
+    "SiteID": 2,
+    "SiteName": "IL1",
+}
+
+_CARD_BRANDS = ("Visa", "Mastercard", "Amex", "Discover")
+
+EMAIL_TEMPLATE = {
+    "subject": "{customer_name} Daily Sales Report for {date}",
+    "greeting": "Dear {customer_name},",
+    "header": "Here's your sales summary for {date}:\n\n",
+    "sign_off": "Thank you,",
+    "signature": "The Underpin Team",
+    "total_revenue": "Your total revenue from yesterday's sales:",
+}
+
+
+@dataclass(frozen=True)
+class Scale:
+    """
+    The size of a synthetic data set.
+
+    machines: Number of machines. \n
+    sales_per_day: Sales per machine per day. \n
+    customers: Number of customers. Every product belongs to one customer, so at most products. \n
+    products: Number of products. \n
+    days: Days of history in each machine's lastSales, ending now. Only yesterday is reported, so the rest is what the fetch has to skip.
+    """
+
+    machines: int = 4
+    sales_per_day: int = 500
+    customers: int = 50
+    products: int = 200
+    days: int = 3
+
+    def times(self, multiplier):
+        """
+        Returns the scale with multiplier times the machines, customers and products. Sales per machine per day stay the same, as they would when the fleet grows.
+        """
+        return replace(
+            self,
+            machines=self.machines * multiplier,
+            customers=self.customers * multiplier,
+            products=self.products * multiplier,
+        )
+
+
+@dataclass
+class SyntheticData:
+    """
+    Generated Nayax lastSales payloads and config files.
+
+    machine_ids: The machines, in order. \n
+    customers, products: The contents of customers.json and products.json. \n
+    email_template: The contents of email-template.json. \n
+    now: The instant the payloads end at. Use get_day_window(now=now) for the day to report on.
+
+    Each machine's sales are generated when they are first asked for, from a random generator seeded with the seed and machine ID, so large fleets don't have to be held in memory.
+    """
+
+    scale: Scale
+    seed: int
+    now: datetime
+    machine_ids: list = field(default_factory=list)
+    customers: list = field(default_factory=list)
+    products: list = field(default_factory=list)
+    email_template: dict = field(default_factory=lambda: dict(EMAIL_TEMPLATE))
+    # {machine_id: (products stocked, their weights, first TransactionID)}
+    catalogues: dict = field(default_factory=dict, repr=False)
+    prices: dict = field(default_factory=dict, repr=False)
+
+    def machine_sales(self, machine_id):
+        """
+        Returns the machine's lastSales as a list of sale dicts, newest first. Every call returns the same sales.
+        """
+
+        rng = random.Random(f"{self.seed}-{machine_id}")
+        names, weights, first_id = self.catalogues[machine_id]
+        count = self.scale.sales_per_day * self.scale.days
+        history = timedelta(days=self.scale.days).total_seconds()
+
+        offsets = sorted(rng.uniform(0, history) for _ in range(count))
+        names = rng.choices(names, weights=weights, k=count) if names else []
+
+        sales = []
+        for transaction_id, offset, name in zip(
+            range(first_id, first_id + count), offsets, names
+        ):
+            authorized_at = self.now - timedelta(seconds=offset)
+            quantity = rng.choice((1, 1, 1, 2, 3))
+            value = round(self.prices[name] * quantity, 2)
+            sales.append(
+                {
+                    "TransactionID": transaction_id,
+                    "PaymentServiceTransactionID": f"PS{transaction_id:011d}",
+                    "MachineID": int(machine_id),
+                    "MachineName": f"Machine {machine_id}",
+                    "MachineNumber": f"M{machine_id[-4:]}",
+                    "InstituteLocationName": "Synthetic Warehouse",
+                    "AuthorizationValue": value,
+                    "SettlementValue": value,
+                    "CardBrand": rng.choice(_CARD_BRANDS),
+                    "ProductName": name,
+                    "MultivendTransactionBit": "false",
+                    "MultivendNumverOfProducts": 1,
+                    "Quantity": quantity,
+                    "AuthorizationDateTimeGMT": _gmt(authorized_at),
+                    "MachineAuthorizationTime": _gmt(authorized_at),
+                    "SettlementDateTimeGMT": _gmt(
+                        authorized_at + timedelta(seconds=60)
+                    ),
+                    **_STATIC_SALE_FIELDS,
+                }
+            )
+
+        return sales
+
+    @cached_property
+    def last_sales(self):
+        """
+        {machine_id: list of sale dicts, newest first} for every machine. Only use this for small scales- it holds every sale in memory.
+        """
+        return {
+            machine_id: self.machine_sales(machine_id)
+            for machine_id in self.machine_ids
+        }
+
+    def last_sales_json(self, machine_id):
+        """
+        Returns the machine's lastSales response body as bytes.
+        """
+        return json.dumps(self.machine_sales(machine_id)).encode("utf-8")
+
+    def write_config(self, directory):
+        """
+        Writes customers.json, products.json and email-template.json to directory.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        files = {
+            "customers.json": self.customers,
+            "products.json": self.products,
+            "email-template.json": self.email_template,
+        }
+        for name, content in files.items():
+            with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+                json.dump(content, f, indent=2)
+
+        return directory
+
+    def write(self, directory):
+        """
+        Writes the config files, last_sales.json (the first machine's payload, as the mock_sales_file) and last_sales/<machine_id>.json for every machine.
+
+        Returns:
+        The directory
+        """
+
+        self.write_config(directory)
+        os.makedirs(os.path.join(directory, "last_sales"), exist_ok=True)
+
+        for index, machine_id in enumerate(self.machine_ids):
+            payload = self.last_sales_json(machine_id)
+            paths = [os.path.join(directory, "last_sales", f"{machine_id}.json")]
+            if index == 0:
+                paths.append(os.path.join(directory, "last_sales.json"))
+            for path in paths:
+                with open(path, "wb") as f:
+                    f.write(payload)
+
+        return directory
+
+
+def _gmt(instant):
+    return (
+        instant.strftime("%Y-%m-%dT%H:%M:%S.") + f"{instant.microsecond // 1000:03d}Z"
+    )
+
+
+def generate(scale=Scale(), seed=0, now=DEFAULT_NOW):
+    """
+    Generates the machines, customers and products at the given scale. The same scale, seed and now always give the same data.
+
+    Every customer stocks their products on a few machines and lists those machines in customers.json, and each machine only sells the products of the customers that list it. Sales are spread at random over the last scale.days days. Product popularity is skewed so a few products and customers account for most of the sales, as in the real data.
+
+    Args:
+    scale (Scale): The size of the data set. \n
+    seed (int): Seed for the random generator. \n
+    now (datetime): The instant the payloads end at.
+
+    Returns:
+    A SyntheticData
+    """
+
+    rng = random.Random(seed)
+    data = SyntheticData(scale, seed, now)
+
+    product_names = [f"Product {index:05d}" for index in range(scale.products)]
+    data.prices = {name: rng.randint(50, 2500) / 100 for name in product_names}
+    data.products = [
+        {"name": name, "price": data.prices[name]} for name in product_names
+    ]
+
+    data.machine_ids = [
+        str(100000000 + index * 7919) for index in range(scale.machines)
+    ]
+
+    customer_count = max(1, min(scale.customers, scale.products))
+    owned = [[] for _ in range(customer_count)]
+    for index, name in enumerate(product_names):
+        owned[index % customer_count].append(name)
+
+    # Every machine has at least one customer, and every customer is on one to three machines.
+    placements = [set() for _ in range(customer_count)]
+    for index, machine_id in enumerate(data.machine_ids):
+        placements[index % customer_count].add(machine_id)
+    for index, machines in enumerate(placements):
+        if not machines:
+            machines.add(data.machine_ids[index % len(data.machine_ids)])
+        machines.update(rng.sample(data.machine_ids, k=min(2, len(data.machine_ids))))
+
+    data.customers = [
+        {
+            "name": f"Customer {index:05d}",
+            "email": f"customer{index:05d}@example.com",
+            "products": products,
+            "machines": sorted(placements[index]),
+        }
+        for index, products in enumerate(owned)
+    ]
+
+    stocked = {machine_id: [] for machine_id in data.machine_ids}
+    for index, products in enumerate(owned):
+        for machine_id in placements[index]:
+            stocked[machine_id].extend(products)
+
+    # Zipf-like weights by the product's overall rank: the first products sell far more often than the last.
+    rank = {name: index for index, name in enumerate(product_names)}
+    count = scale.sales_per_day * scale.days
+    for index, machine_id in enumerate(data.machine_ids):
+        names = sorted(stocked[machine_id], key=rank.get)
+        weights = [1 / (rank[name] + 1) for name in names]
+        data.catalogues[machine_id] = (names, weights, 1 + index * count)
+
+    return data
+
+
+def add_scale_arguments(parser):
+    """
+    Adds the --machines, --sales-per-day, --customers, --products, --days and --seed options to parser.
+    """
+
+    defaults = Scale()
+    parser.add_argument("--machines", type=int, default=defaults.machines)
+    parser.add_argument("--sales-per-day", type=int, default=defaults.sales_per_day)
+    parser.add_argument("--customers", type=int, default=defaults.customers)
+    parser.add_argument("--products", type=int, default=defaults.products)
+    parser.add_argument("--days", type=int, default=defaults.days)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def scale_from_args(args):
+    return Scale(
+        args.machines, args.sales_per_day, args.customers, args.products, args.days
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Writes synthetic Nayax lastSales payloads and config files."
+    )
+    parser.add_argument("directory")
+    add_scale_arguments(parser)
+    args = parser.parse_args(argv)
+
+    data = generate(scale_from_args(args), args.seed)
+    data.write(args.directory)
+    sales = len(data.machine_ids) * data.scale.sales_per_day * data.scale.days
+    print(
+        f"Wrote {sales} sales on {len(data.machine_ids)} machines, {len(data.customers)} customers and {len(data.products)} products to {args.directory}"
+    )
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.generator <directory> [--machines N] [--sales-per-day N] ...
+    main()
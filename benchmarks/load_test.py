@@ -0,0 +1,265 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict, field, replace
+from datetime import datetime, timezone
+
+from benchmarks.generator import Scale, generate
+from benchmarks.standins import Faults, FileBucket, NayaxServer, SMTPSink, FakeSheet
+from utils.config import Config, set_config
+from utils.context import ServiceContext, set_context
+from utils.spans import current_run
+
+# Roughly today's fleet: the two configured machines, a handful of customers and the products they stock. Load tests run at multiples of it.
+CURRENT_SCALE = Scale(
+    machines=len(Config("", "", "").machine_ids),
+    sales_per_day=50,
+    customers=10,
+    products=40,
+    days=2,
+)
+
+DEFAULT_MULTIPLIERS = (10, 100, 1000)
+
+# The spans shown in the per-stage latency report, in run order.
+REPORTED_SPANS = (
+    "config.load",
+    "checkpoints.load",
+    "fetch.machine",
+    "pipeline.fetch",
+    "pipeline.group",
+    "pipeline.render",
+    "pipeline.send",
+    "pipeline.persist",
+    "pipeline",
+    "checkpoints.save",
+    "sheets.write",
+    "sheets.drain",
+)
+
+
+@dataclass
+class LoadTestFaults:
+    """
+    The Faults for each stand-in.
+    """
+
+    nayax: Faults = field(default_factory=Faults)
+    smtp: Faults = field(default_factory=Faults)
+    sheets: Faults = field(default_factory=Faults)
+    bucket: Faults = field(default_factory=Faults)
+
+
+@dataclass
+class LoadTestResult:
+    """
+    What one run of the job at a scale did and how long it took.
+
+    spans: The run's span totals by name, as in the run summary. \n
+    services: What each stand-in handled, from Stats.as_dict().
+    """
+
+    multiplier: int
+    scale: Scale
+    seconds: float
+    sales: int
+    emails: int
+    sheet_rows: int
+    peak_rss_mb: float
+    spans: dict
+    services: dict
+
+    @property
+    def sales_per_second(self):
+        return self.sales / self.seconds if self.seconds else 0.0
+
+    @property
+    def emails_per_second(self):
+        return self.emails / self.seconds if self.seconds else 0.0
+
+
+def run_load_test(multiplier, faults=None, seed=0, **settings):
+    """
+    Runs the whole job once against local stand-ins, at multiplier times CURRENT_SCALE.
+
+    A local HTTP server answers the Nayax lastSales requests, an SMTP sink receives the emails, a fake Sheet takes the rows and a directory stands in for the config bucket. The sending rate limit is turned off so the run measures the job rather than the limit.
+
+    Args:
+    multiplier (int): Multiple of CURRENT_SCALE to run at. \n
+    faults (LoadTestFaults): Latency and errors for the stand-ins. Defaults to none. \n
+    seed (int): Seed for the synthetic data. \n
+    settings: Config fields to override, for example fetch_workers or smtp_pool_size.
+
+    Returns:
+    A LoadTestResult
+    """
+
+    # Imported here so the stand-ins are in place before main sets anything up.
+    import main as job
+
+    faults = faults or LoadTestFaults()
+    scale = CURRENT_SCALE.times(multiplier)
+    data = generate(scale, seed, now=datetime.now(timezone.utc))
+
+    with tempfile.TemporaryDirectory(prefix="underpin-load-test-") as workdir:
+        bucket = FileBucket(
+            data.write_config(os.path.join(workdir, "bucket")), faults.bucket
+        )
+        sheet = FakeSheet(faults.sheets)
+
+        with NayaxServer(data, faults.nayax) as nayax, SMTPSink(faults.smtp) as smtp:
+            config = Config(
+                NAYAX_API_KEY="load-test",
+                sender_email="load-test@example.com",
+                sender_pw="load-test",
+                notification_address="notifications@example.com",
+                machine_ids=tuple(data.machine_ids),
+                nayax_api_url=nayax.url,
+                mock_sales_file="",
+                blob_cache_dir="",
+                sheets_spool_dir=os.path.join(workdir, "spool"),
+                smtp_host=smtp.host,
+                smtp_port=smtp.port,
+                smtp_starttls=False,
+                smtp_rate_per_second=0,
+                send_retry_backoff=0.05,
+            )
+            previous_config = set_config(replace(config, **settings))
+            previous_context = set_context(ServiceContext(bucket=bucket, sheet=sheet))
+
+            try:
+                start = time.perf_counter()
+                job.main()
+                seconds = time.perf_counter() - start
+            finally:
+                set_context(previous_context)
+                set_config(previous_config)
+
+    spans = current_run().summary()
+    return LoadTestResult(
+        multiplier=multiplier,
+        scale=scale,
+        seconds=round(seconds, 3),
+        sales=spans.get("fetch.machine", {}).get("items", 0),
+        emails=smtp.stats.items,
+        sheet_rows=sheet.stats.items,
+        # ru_maxrss is in kilobytes on Linux. It is the peak of the whole process, so it only grows from one scale to the next.
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        spans=spans,
+        services={
+            "nayax": nayax.stats.as_dict(),
+            "smtp": smtp.stats.as_dict(),
+            "sheets": sheet.stats.as_dict(),
+            "bucket": bucket.stats.as_dict(),
+        },
+    )
+
+
+def format_report(results):
+    """
+    Formats the throughput of each run, then the latency of each stage: the total time for stages that ran once, and the mean and longest call for the per-machine fetch and the Sheets writes.
+    """
+
+    lines = [
+        f"{'scale':>7}{'machines':>10}{'customers':>11}{'sales':>9}{'emails':>8}{'rows':>9}{'seconds':>10}{'sales/s':>10}{'emails/s':>10}{'errors':>8}{'rss MB':>8}"
+    ]
+    for result in results:
+        errors = sum(service["errors"] for service in result.services.values())
+        lines.append(
+            f"{str(result.multiplier) + 'x':>7}{result.scale.machines:>10}{result.scale.customers:>11}{result.sales:>9}{result.emails:>8}{result.sheet_rows:>9}{result.seconds:>10.2f}{result.sales_per_second:>10.0f}{result.emails_per_second:>10.1f}{errors:>8}{result.peak_rss_mb:>8.0f}"
+        )
+
+    lines.append("")
+    lines.append(
+        "Stage latency in ms (total, or mean / max for stages that run many times):"
+    )
+    lines.append(
+        f"{'span':<20}" + "".join(f"{str(r.multiplier) + 'x':>20}" for r in results)
+    )
+    for name in REPORTED_SPANS:
+        cells = []
+        for result in results:
+            stats = result.spans.get(name)
+            if not stats:
+                cells.append(f"{'-':>20}")
+            elif stats["count"] == 1:
+                cells.append(f"{stats['duration_ms']:>20.1f}")
+            else:
+                mean = stats["duration_ms"] / stats["count"]
+                cell = f"{mean:.1f} / {stats['max_ms']:.1f}"
+                cells.append(f"{cell:>20}")
+        lines.append(f"{name:<20}" + "".join(cells))
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs the whole job against local Nayax, SMTP, Sheets and bucket stand-ins at multiples of the current scale, and reports throughput and per-stage latency."
+    )
+    parser.add_argument(
+        "--multipliers", type=int, nargs="+", default=list(DEFAULT_MULTIPLIERS)
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    for service in ("nayax", "smtp", "sheets", "bucket"):
+        parser.add_argument(f"--{service}-latency", type=float, default=0.0)
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+    parser.add_argument("--fetch-workers", type=int)
+    parser.add_argument("--render-workers", type=int)
+    parser.add_argument("--smtp-pool-size", type=int)
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the job's log and span records."
+    )
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    settings = {
+        name: getattr(args, name)
+        for name in ("fetch_workers", "render_workers", "smtp_pool_size")
+        if getattr(args, name) is not None
+    }
+
+    results = []
+    for multiplier in args.multipliers:
+        faults = LoadTestFaults(
+            **{
+                service: Faults(
+                    latency=getattr(args, f"{service}_latency"),
+                    error_rate=getattr(args, f"{service}_error_rate"),
+                    seed=args.seed,
+                )
+                for service in ("nayax", "smtp", "sheets", "bucket")
+            }
+        )
+        results.append(run_load_test(multiplier, faults, args.seed, **settings))
+        print(f"{multiplier}x: {results[-1].seconds:.2f} seconds", file=sys.stderr)
+
+    print(format_report(results))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                [
+                    dict(
+                        asdict(result),
+                        sales_per_second=result.sales_per_second,
+                        emails_per_second=result.emails_per_second,
+                    )
+                    for result in results
+                ],
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.load_test [--multipliers 10 100 1000] [--smtp-latency 0.05] [--nayax-error-rate 0.01] ...
+    main()
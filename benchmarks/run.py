@@ -0,0 +1,322 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from dataclasses import dataclass, asdict
+
+from benchmarks.generator import (
+    generate,
+    add_scale_arguments,
+    scale_from_args,
+)
+from utils.config import Config, set_config
+from utils.customers import create_customer_list, get_customer_to_product_map
+from utils.products import to_cents
+from utils.sales import (
+    iter_sales,
+    get_daily_sales,
+    group_sales_by_customer,
+    merge_sales,
+    stream_chunk_size,
+)
+from utils.notifications import create_notifications
+from utils.time import parse_gmt, convert_gmt_pst, get_day_window
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+# A benchmark is reported as a regression when its median is this much slower than the baseline.
+DEFAULT_TOLERANCE = 0.25
+
+
+@dataclass
+class Benchmark:
+    """
+    One hot path to time. run() is called once per repeat, after reset() if there is one. items is the number of sales, customers or calls handled by one run().
+    """
+
+    name: str
+    run: object
+    items: int
+    reset: object = None
+
+
+@dataclass(frozen=True)
+class Result:
+    name: str
+    items: int
+    median_ms: float
+    min_ms: float
+
+    @property
+    def per_item_us(self):
+        return self.median_ms * 1000 / max(1, self.items)
+
+
+def _chunks(payload):
+    return [
+        payload[start : start + stream_chunk_size]
+        for start in range(0, len(payload), stream_chunk_size)
+    ]
+
+
+def build_benchmarks(data):
+    """
+    Prepares the inputs for every hot path from a SyntheticData, outside of the timed code.
+
+    Returns:
+    A list of Benchmark
+    """
+
+    window = get_day_window(now=data.now)
+    payloads = {
+        machine_id: _chunks(data.last_sales_json(machine_id))
+        for machine_id in data.machine_ids
+    }
+    parsed = {
+        machine_id: list(iter_sales(chunks, machine_id))
+        for machine_id, chunks in payloads.items()
+    }
+    total_sales = sum(len(sales) for sales in parsed.values())
+
+    daily_sales = {
+        machine_id: get_daily_sales(sales, None, window)
+        for machine_id, sales in parsed.items()
+    }
+    merged = list(merge_sales(daily_sales.values()))
+
+    customers = create_customer_list(data.customers)
+    customer_product_dict = get_customer_to_product_map(customers)
+    product_costs = {item["name"]: to_cents(item["price"]) for item in data.products}
+    customer_sales = group_sales_by_customer(merged, customer_product_dict)
+
+    timestamps = [
+        sale["AuthorizationDateTimeGMT"]
+        for sales in data.last_sales.values()
+        for sale in sales
+    ]
+
+    def clear_timestamp_caches():
+        parse_gmt.cache_clear()
+        convert_gmt_pst.cache_clear()
+
+    return [
+        Benchmark(
+            "iter_sales",
+            lambda: [
+                list(iter_sales(chunks, machine_id))
+                for machine_id, chunks in payloads.items()
+            ],
+            total_sales,
+            clear_timestamp_caches,
+        ),
+        Benchmark(
+            "get_daily_sales",
+            lambda: [get_daily_sales(sales, None, window) for sales in parsed.values()],
+            total_sales,
+        ),
+        Benchmark(
+            "merge_sales",
+            lambda: list(merge_sales(daily_sales.values())),
+            len(merged),
+        ),
+        Benchmark(
+            "group_sales_by_customer",
+            lambda: group_sales_by_customer(merged, customer_product_dict),
+            len(merged),
+        ),
+        Benchmark(
+            "create_notifications",
+            lambda: create_notifications(
+                customer_sales, product_costs, data.email_template
+            ),
+            len(customer_sales),
+        ),
+        Benchmark(
+            "parse_gmt",
+            lambda: [parse_gmt(timestamp) for timestamp in timestamps],
+            len(timestamps),
+            clear_timestamp_caches,
+        ),
+        Benchmark(
+            "parse_gmt_cached",
+            lambda: [parse_gmt(timestamp) for timestamp in timestamps],
+            len(timestamps),
+        ),
+        Benchmark(
+            "convert_gmt_pst",
+            lambda: [convert_gmt_pst(timestamp) for timestamp in timestamps],
+            len(timestamps),
+            clear_timestamp_caches,
+        ),
+        Benchmark(
+            "get_day_window",
+            lambda: [get_day_window(now=data.now) for _ in range(1000)],
+            1000,
+        ),
+    ]
+
+
+def time_benchmark(benchmark, repeat=5):
+    """
+    Runs the benchmark once to warm up, then repeat more times.
+
+    Returns:
+    A Result with the median and fastest time of the timed runs.
+    """
+
+    timings = []
+    for attempt in range(repeat + 1):
+        if benchmark.reset is not None:
+            benchmark.reset()
+        start = time.perf_counter()
+        benchmark.run()
+        elapsed = time.perf_counter() - start
+        if attempt:
+            timings.append(elapsed)
+
+    return Result(
+        benchmark.name,
+        benchmark.items,
+        round(statistics.median(timings) * 1000, 4),
+        round(min(timings) * 1000, 4),
+    )
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares the results to a baseline from save_baseline().
+
+    Returns:
+    A list of (Result, baseline median_ms or None, change) tuples, and the names of the benchmarks more than tolerance slower than the baseline.
+    """
+
+    baseline_results = baseline.get("results", {})
+    rows = []
+    regressions = []
+
+    for result in results:
+        previous = baseline_results.get(result.name, {}).get("median_ms")
+        change = None
+        if previous:
+            change = result.median_ms / previous - 1
+            if change > tolerance:
+                regressions.append(result.name)
+        rows.append((result, previous, change))
+
+    return rows, regressions
+
+
+def format_results(rows):
+    lines = [
+        f"{'benchmark':<26}{'items':>9}{'median ms':>12}{'min ms':>11}{'us/item':>10}{'baseline':>11}{'change':>9}"
+    ]
+    for result, previous, change in rows:
+        baseline = f"{previous:.3f}" if previous else "-"
+        change = f"{change:+.0%}" if change is not None else "-"
+        lines.append(
+            f"{result.name:<26}{result.items:>9}{result.median_ms:>12.3f}{result.min_ms:>11.3f}{result.per_item_us:>10.3f}{baseline:>11}{change:>9}"
+        )
+    return "\n".join(lines)
+
+
+def load_baseline(path=BASELINE_FILE):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(results, scale, seed, path=BASELINE_FILE):
+    """
+    Stores the results, with the scale and seed they were measured at, as the baseline for later runs.
+    """
+
+    baseline = {
+        "scale": asdict(scale),
+        "seed": seed,
+        "python": sys.version.split()[0],
+        "results": {
+            result.name: {"items": result.items, "median_ms": result.median_ms}
+            for result in results
+        },
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Times the sales, grouping, notification and time helper hot paths on synthetic data and compares them to a stored baseline."
+    )
+    add_scale_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--only", action="append", help="Only run this benchmark. Can be repeated."
+    )
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store these results as the new baseline.",
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    # The hot paths log every run- only the results are wanted here.
+    logging.disable(logging.INFO)
+
+    # create_notifications reads the sender from the config.
+    set_config(
+        Config(
+            NAYAX_API_KEY="benchmark",
+            sender_email="benchmark@example.com",
+            sender_pw="benchmark",
+            notification_address="notifications@example.com",
+        )
+    )
+
+    scale = scale_from_args(args)
+    data = generate(scale, args.seed)
+    benchmarks = [
+        benchmark
+        for benchmark in build_benchmarks(data)
+        if not args.only or benchmark.name in args.only
+    ]
+    results = [time_benchmark(benchmark, args.repeat) for benchmark in benchmarks]
+
+    baseline = load_baseline(args.baseline)
+    if baseline and (
+        baseline.get("scale") != asdict(scale) or baseline.get("seed") != args.seed
+    ):
+        print(
+            f"Baseline in {args.baseline} was measured at a different scale or seed- not comparing"
+        )
+        baseline = None
+
+    rows, regressions = compare(results, baseline or {}, args.tolerance)
+    print(f"Scale: {asdict(scale)}, seed {args.seed}, {args.repeat} repeats")
+    print(format_results(rows))
+
+    if args.save_baseline:
+        save_baseline(results, scale, args.seed, args.baseline)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(
+            f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.run [--machines N] [--sales-per-day N] ... [--save-baseline]
+    sys.exit(main())
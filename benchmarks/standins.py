@@ -0,0 +1,331 @@
+import json
+import os
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the services the job talks to, for load testing without GCS, Nayax, Gmail or Google Sheets. Each one counts what it handled and takes a Faults to add latency and fail a share of the calls.
+
+
+@dataclass
+class Faults:
+    """
+    Latency and errors added to every call a stand-in handles.
+
+    latency: Seconds added to each call. \n
+    jitter: Up to this many more seconds, at random. \n
+    error_rate: Share of calls that fail, from 0 to 1. \n
+    seed: Seed for choosing the calls that fail, so a run can be repeated.
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+    _rng: random.Random = field(default=None, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+
+    def inject(self):
+        """
+        Sleeps for the call's latency. Returns True if the call should fail.
+        """
+        with self._lock:
+            delay = self.latency + (
+                self._rng.uniform(0, self.jitter) if self.jitter else 0
+            )
+            fail = self.error_rate > 0 and self._rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+
+@dataclass
+class Stats:
+    """
+    What a stand-in handled: calls, injected errors, bytes and items such as messages or rows.
+    """
+
+    calls: int = 0
+    errors: int = 0
+    bytes: int = 0
+    items: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, calls=0, errors=0, bytes=0, items=0):
+        with self._lock:
+            self.calls += calls
+            self.errors += errors
+            self.bytes += bytes
+            self.items += items
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "items": self.items,
+        }
+
+
+class FileBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+
+    def download_as_bytes(self, **kwargs):
+        if self.bucket.faults.inject():
+            self.bucket.stats.add(calls=1, errors=1)
+            raise ConnectionError(f"Injected error reading {self.name}")
+
+        # The storage client raises NotFound for a missing object- the callers treat any exception the same way.
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.bucket.stats.add(calls=1, bytes=len(data))
+        return data
+
+    def upload_from_string(self, data, content_type=None):
+        if self.bucket.faults.inject():
+            self.bucket.stats.add(calls=1, errors=1)
+            raise ConnectionError(f"Injected error writing {self.name}")
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        temp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+        self.bucket.stats.add(calls=1, bytes=len(data))
+
+    def delete(self):
+        self.bucket.stats.add(calls=1)
+        os.remove(self.path)
+
+
+class FileBucket:
+    """
+    A GCS bucket backed by a local directory, with the blob methods the job uses.
+    """
+
+    def __init__(self, root, faults=None, name="loadtest"):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.name = name
+        self.faults = faults or Faults()
+        self.stats = Stats()
+
+    def blob(self, name):
+        return FileBlob(self, name)
+
+
+class _QuietServerMixin:
+    # The job closes a sales stream as soon as it has read past yesterday, so resets are expected rather than errors worth a traceback.
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class _HTTPServer(_QuietServerMixin, ThreadingHTTPServer):
+    pass
+
+
+class _TCPServer(_QuietServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+_LAST_SALES_PATH = re.compile(r"^/operational/v1/machines/([^/]+)/lastSales$")
+
+
+class NayaxServer:
+    """
+    A local HTTP server for the Nayax lastSales endpoint, serving the payloads of a SyntheticData. Injected errors are answered with 503.
+
+    Use it as a context manager, and point nayax_api_url in the config at url.
+    """
+
+    def __init__(self, data, faults=None, host="127.0.0.1"):
+        self.data = data
+        self.faults = faults or Faults()
+        self.stats = Stats()
+        machines = set(data.machine_ids)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                match = _LAST_SALES_PATH.match(self.path)
+                if not match or match.group(1) not in machines:
+                    self._reply(404, b'{"error": "not found"}')
+                    return
+
+                if server.faults.inject():
+                    server.stats.add(calls=1, errors=1)
+                    self._reply(503, b'{"error": "injected failure"}')
+                    return
+
+                body = server.data.last_sales_json(match.group(1))
+                server.stats.add(calls=1, bytes=len(body), items=1)
+                self._reply(200, body)
+
+            def _reply(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stops reading once it has passed yesterday.
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _HTTPServer((host, 0), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="nayax-standin", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib: EHLO, MAIL, RCPT, DATA, RSET, NOOP and QUIT. Messages are counted and dropped.
+
+    def _send(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+        self._send("220 localhost SMTP sink ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+
+            if command == b"EHLO":
+                self._send("250-localhost")
+                self._send("250 8BITMIME")
+            elif command in (b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self._send("250 OK")
+            elif command == b"DATA":
+                self._send("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+
+                if sink.faults.inject():
+                    sink.stats.add(calls=1, errors=1)
+                    self._send("451 4.3.0 Injected failure")
+                else:
+                    sink.stats.add(calls=1, bytes=size, items=1)
+                    self._send("250 OK queued")
+            elif command == b"QUIT":
+                self._send("221 Bye")
+                return
+            else:
+                self._send("502 Command not implemented")
+
+
+class SMTPSink:
+    """
+    An in-process SMTP server that accepts and counts every message. Injected errors are answered with a 451 to the message data, which the job treats as a failed send.
+
+    Use it as a context manager, and point smtp_host and smtp_port in the config at host and port with smtp_starttls off.
+    """
+
+    def __init__(self, faults=None, host="127.0.0.1"):
+        self.faults = faults or Faults()
+        self.stats = Stats()
+        self._server = _TCPServer((host, 0), _SMTPHandler)
+        self._server.sink = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="smtp-sink", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+
+class FakeSheet:
+    """
+    A Google Sheet with the notification, itemized receipt and transaction log worksheets. batch_update() counts the appended rows per worksheet instead of storing them.
+    """
+
+    def __init__(self, faults=None, worksheets=3):
+        self.id = "loadtest"
+        self.faults = faults or Faults()
+        self.stats = Stats()
+        self.rows_by_sheet = {}
+        self._sheet_ids = [100 + index for index in range(worksheets)]
+        self._lock = threading.Lock()
+
+    def fetch_sheet_metadata(self, params=None):
+        return {
+            "sheets": [
+                {"properties": {"sheetId": sheet_id, "index": index}}
+                for index, sheet_id in enumerate(self._sheet_ids)
+            ]
+        }
+
+    def batch_update(self, body):
+        if self.faults.inject():
+            self.stats.add(calls=1, errors=1)
+            raise ConnectionError("Injected Sheets failure")
+
+        rows = 0
+        with self._lock:
+            for request in body["requests"]:
+                append = request["appendCells"]
+                count = len(append["rows"])
+                self.rows_by_sheet[append["sheetId"]] = (
+                    self.rows_by_sheet.get(append["sheetId"], 0) + count
+                )
+                rows += count
+
+        self.stats.add(calls=1, bytes=len(json.dumps(body)), items=rows)
+        return {"replies": [{} for _ in body["requests"]]}
@@ -1,11 +1,115 @@
+import atexit
+import json
 import logging
+import queue
 import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+TEXT_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Attributes every LogRecord has. Anything else on a record was passed with extra= and is added to the JSON payload.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class CloudLoggingFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, which Cloud Logging reads as a structured jsonPayload with the severity, message and source location in their own fields. Fields passed with extra= are added to the payload. A record with a json_fields dict, such as a span record, is always written as JSON, even in text mode.
+    """
+
+    def __init__(self, json_output=True):
+        super().__init__(TEXT_FORMAT, TEXT_DATE_FORMAT)
+        self.json_output = json_output
+
+    def format(self, record):
+        json_fields = getattr(record, "json_fields", None)
+        if not self.json_output and json_fields is None:
+            return super().format(record)
+
+        message = record.getMessage()
+        if record.exc_info:
+            message = f"{message}\n{self.formatException(record.exc_info)}"
+        elif record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+
+        payload = {
+            "severity": record.levelname,
+            "message": message,
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "logger": record.name,
+            "thread": record.threadName,
+            "logging.googleapis.com/sourceLocation": {
+                "file": record.pathname,
+                "line": record.lineno,
+                "function": record.funcName,
+            },
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key != "json_fields":
+                payload[key] = value
+        if json_fields:
+            payload.update(json_fields)
+
+        return json.dumps(payload, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    # QueueHandler.prepare() formats the message in the logging thread. Here the record is queued as it is, so the message is only built from its arguments on the listener thread- pass arguments that won't change after the call, such as strings and numbers.
+
+    def prepare(self, record):
+        return record
+
+
+# Every logger from setup_logging() puts its records on one queue. A single background thread formats them and writes them to stdout, so logging never waits on I/O in the sending or fetching threads.
+_queue = queue.SimpleQueue()
+_queue_handler = _DeferredQueueHandler(_queue)
+_output = logging.StreamHandler(sys.stdout)
+_output.setFormatter(CloudLoggingFormatter(json_output=False))
+_listener = QueueListener(_queue, _output)
+_listener_lock = threading.Lock()
+_listener_started = False
+
+_default_level = logging.DEBUG
+_levels = {}
+
+
+def _start_listener():
+    global _listener_started
+
+    with _listener_lock:
+        if not _listener_started:
+            _listener.start()
+            _listener_started = True
+            # Write out whatever is still queued when the program exits.
+            atexit.register(shutdown_logging)
+
+
+def _to_level(level):
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError(f"Unknown log level: {level}")
+    return number
+
+
+def _level_for(name):
+    # The level of the closest configured parent: "utils" covers "utils.sales".
+    while name:
+        if name in _levels:
+            return _levels[name]
+        name = name.rpartition(".")[0]
+    return _default_level
 
 
 def setup_logging(name="main_app_log"):
     """
     Setup logging with output directly to the console which is recorded by Google Cloud Logging
 
+    Records are queued and written by a background thread. Log messages in hot loops with %-style arguments, for example logger.info("Email sent to %s", name), so the message is only built if the record is written, and then off the calling thread.
+
     Args:
     name: Name of the logger (use __name__ from calling module)
 
@@ -14,16 +118,42 @@ def setup_logging(name="main_app_log"):
 
     # Only add a logging handler if one doesn't already exist.
     if not logger.handlers:
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(_level_for(name))
+        logger.addHandler(_queue_handler)
+        _start_listener()
 
-        # Configure the logging format
-        formatter = logging.Formatter(
-            "%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%dT%H:%M:%SZ"
-        )
+    return logger
 
-        # Add console logging
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
 
-    return logger
+def configure_logging(log_format="json", level="DEBUG", levels=None):
+    """
+    Sets the output format and the log levels, for the loggers already created by setup_logging() and for the ones created later.
+
+    Args:
+    log_format (str): "json" for Cloud Logging structured JSON, or "text". \n
+    level (str or int): Level of every logger not in levels. \n
+    levels (dict): {logger name: level}. A name also covers the loggers below it, for example {"utils.sales": "WARNING"} or {"utils": "INFO"}.
+    """
+    global _default_level, _levels
+
+    _output.setFormatter(CloudLoggingFormatter(json_output=log_format == "json"))
+    _default_level = _to_level(level)
+    _levels = {
+        name: _to_level(name_level) for name, name_level in (levels or {}).items()
+    }
+
+    for name, logger in list(logging.Logger.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and _queue_handler in logger.handlers:
+            logger.setLevel(_level_for(name))
+
+
+def shutdown_logging():
+    """
+    Writes out every queued record and stops the background thread. Called when the program exits.
+    """
+    global _listener_started
+
+    with _listener_lock:
+        if _listener_started:
+            _listener.stop()
+            _listener_started = False
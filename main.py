@@ -1,162 +1,346 @@
-from utils.sales import get_last_sales, get_daily_sales, group_sales_by_customer
-from utils.customers import (
-    load_customers,
-    create_customer_list,
-    get_customer_to_product_map,
+import time
+
+# Measured before the other imports to log how long startup takes. Run python -m utils.import_report for the slowest modules.
+import_start_time = time.perf_counter()
+
+from utils.pipeline import run_pipeline
+from utils.bundle import load_config_bundle
+from utils.checkpoints import (
+    load_checkpoints,
+    save_checkpoints,
+    update_checkpoint,
+    is_day_processed,
 )
-from utils.products import load_product_costs
+from utils.time import get_day_window
 from utils.notifications import (
-    create_notifications,
-    send_notifications,
     send_no_sales_notification,
+    resend_failed_notifications,
 )
 from utils.config import (
-    customer_file,
-    product_file,
-    machine_ids,
+    get_config,
+    checkpoint_file,
 )
-from utils.sheets import connect_sheets, write_to_sheet
-import time
-from logger import setup_logging
-import os
-from google.cloud import storage
+from utils.spool import SheetSpool
+from utils.sales import fetch_all_daily_sales
+from utils.dedup import (
+    TransactionFilter,
+    load_transaction_history,
+    save_transaction_history,
+)
+from utils.intraday import run_poller, load_completed_day
+from utils.shards import (
+    shard_machines,
+    open_shard_store,
+    shard_run_key,
+    write_shard,
+    claim_merge,
+    load_shards,
+    remove_shards,
+)
+from utils.context import get_context
+from utils.spans import span, record_span, start_run, emit_run_summary
+import signal
+import sys
+from logger import setup_logging, configure_logging
 
+import_seconds = time.perf_counter() - import_start_time
 
-def main():
 
-    # Calculate the start time
-    program_start_time = time.time()
+def main(resend_failed=False, merge_shards=False, poll=False):
 
     logger = setup_logging(__name__)
 
-    logger.info("Starting Main.py")
-
-    # Use an environment variable to define the bucket name for Google Cloud Storage
-    BUCKET_NAME = os.environ.get("CONFIG_BUCKET")
+    # Every stage writes a JSON span record with its duration and counts, and the run ends with a summary of all of them.
+    start_run()
+    record_span("startup.imports", import_seconds)
 
-    try:
+    # Read and check the settings from the environment. Nothing reads them at import time.
+    with span("config.environment"):
+        config = get_config()
 
-        # Initialize the storage client and bucket for Google Cloud- will be used for both load_customers and load_products
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
+    # Log records are formatted and written by a background thread, as Cloud Logging JSON unless LOG_FORMAT is text.
+    configure_logging(config.log_format, config.log_level, dict(config.log_levels))
 
-        # Load customer and product info from files.
-        customer_data = load_customers(bucket, customer_file)
-        logger.info(f"Loaded customer info from {customer_file}")
+    logger.info("Starting Main.py")
 
-        customers = create_customer_list(customer_data)
-        logger.info(f"Created customer list of {len(customers)} customers")
+    # Shared clients for the run- created on first use and reused by every stage.
+    context = get_context()
 
-        customer_product_dict = get_customer_to_product_map(customers)
-        logger.info(
-            f"Created dictionary of product keys with customer values for {len(customer_product_dict)} products"
-        )
-
-        product_costs = load_product_costs(bucket, product_file)
-        logger.info(f"Loaded product data for {len(product_costs)} products")
+    # Cloud Run sends SIGTERM before killing a task that runs past its timeout- exit through the finally block so unwritten sheet rows are saved.
+    # Stopping is how the poller normally ends, so it exits with success.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0 if poll else 1))
 
-    except Exception as e:
-        logger.error(
-            f"Error loading customer and product info from files: {e}", exc_info=True
-        )
+    spool = None
+    if resend_failed:
+        summary = {"mode": "resend_failed"}
+    elif poll:
+        summary = {"mode": "poll"}
+    elif merge_shards or config.task_count > 1:
+        summary = {"mode": "sharded", "task_index": config.task_index}
+    else:
+        summary = {"mode": "daily"}
 
-    # Initialize a list to store the combination of last sales from all machines.
-    all_machine_last_sales = []
+    try:
+        if poll:
+            # Runs until stopped or for poll_duration seconds. Nothing is sent- the daily run sends the notifications from the collected sales.
+            summary.update(run_poller(context.bucket))
+        elif summary["mode"] == "sharded":
+            # Only the task that merges the shards writes to Google Sheets and sends the notifications.
+            merged, window = shard_stage(context, logger, summary, merge_shards)
+            if merged is not None:
+                spool = SheetSpool(context.bucket).start()
+                if main_stages(
+                    context, spool, logger, summary, window, merged.sales_source
+                ):
+                    # The checkpoints were saved, so the next run doesn't need the shards- and a run reusing the key finds no stale claim.
+                    remove_shards(
+                        open_shard_store(context.bucket),
+                        merged.run_key,
+                        merged.task_count,
+                    )
+        else:
+            # Rows for Google Sheets are spooled and written in the background while the rest of the run continues.
+            # Rows a previous run could not write are replayed first.
+            spool = SheetSpool(context.bucket).start()
+            if resend_failed:
+                resend_stage(spool, logger, summary)
+            else:
+                main_stages(context, spool, logger, summary)
+    finally:
+        if spool is not None:
+            spool.close()
+        context.close()
+        emit_run_summary(**summary)
+        logger.info("Program execution ended")
+
+
+def resend_stage(spool, logger, summary):
+    """
+    Resends only the notifications in the retry queue and records them in the Notification Sheet.
+    """
+
+    notification_rows, notification_success, notification_fail = (
+        resend_failed_notifications(spool=spool)
+    )
+    logger.info(
+        f"Queued notifications resent: {notification_success} successful. {notification_fail} failed"
+    )
+    summary.update(sent=notification_success, failed=notification_fail)
 
-    # Loop through each machine in the list and add the last sales together.
-    for machine_id in machine_ids:
-        logger.info(f"Fetching sales for Machine ID: {machine_id}")
-        try:
-            machine_sales = get_last_sales(machine_id)
-            all_machine_last_sales.extend(machine_sales)
-        except Exception as e:
-            logger.error(f"Error fetching sales for {machine_id}: {str(e)}")
 
-    # Go through the last sales and find all sales from yesterday. End execution if not found.
-    daily_sales = get_daily_sales(all_machine_last_sales)
+def shard_stage(context, logger, summary, merge_only=False):
+    """
+    Fetches and filters this task's share of the machines and writes their sales to the shard store. The task that writes the last shard merges every shard.
 
-    # Send a notification to main address and end program execution if no sales found.
-    if not daily_sales:
+    With merge_only nothing is fetched and the shards already written are merged without claiming them, to finish a run whose merging task failed. SHARD_RUN_ID and SHARD_TASK_COUNT name that run and its number of shards.
 
-        logger.info("No sales from yesterday. Ending program execution")
-        notification_rows = send_no_sales_notification()
-        try:
-            sheet = connect_sheets()
+    Returns:
+    A tuple of (MergedShards or None, DayWindow). The MergedShards is None if another task merges the shards.
+    """
 
-        except Exception as e:
-            logger.error(f"Error connecting to sheets: {e}")
+    config = get_config()
+    bucket = context.bucket
+    window = get_day_window()
+    store = open_shard_store(bucket)
+    run_key = shard_run_key(window)
 
-        try:
-            write_to_sheet(sheet, 0, notification_rows)
-            logger.info(f"Wrote to Notification Sheet")
+    if not merge_only:
+        machine_ids = shard_machines(
+            config.machine_ids, config.task_index, config.task_count
+        )
+        logger.info(
+            f"Task {config.task_index} of {config.task_count} fetching sales for Machine IDs: {', '.join(machine_ids)}"
+        )
 
-        except Exception as e:
-            logger.error(f"Error writing to sheets: {str(e)}")
+        with span("checkpoints.load") as load_span:
+            checkpoints = load_checkpoints(bucket, checkpoint_file)
+            load_span.add(items=len(checkpoints))
+
+        with span("shard.fetch", machines=len(machine_ids)) as fetch_span:
+            sales_by_machine = fetch_all_daily_sales(
+                machine_ids, checkpoints, bucket, window
+            )
+            fetch_span.add(items=sum(len(sales) for sales in sales_by_machine.values()))
+        failed = [
+            machine_id
+            for machine_id in machine_ids
+            if machine_id not in sales_by_machine
+        ]
+
+        with span("shard.write", machines=len(sales_by_machine)) as write_span:
+            size = write_shard(
+                store,
+                run_key,
+                config.task_index,
+                config.task_count,
+                sales_by_machine,
+                failed,
+                window.label,
+            )
+            write_span.add(bytes=size)
+        summary.update(machines=len(machine_ids), fetch_failed=len(failed))
+
+        if not claim_merge(store, run_key, config.task_count):
+            return None, window
+
+    # A --merge-shards job on Cloud Run has its own CLOUD_RUN_TASK_COUNT, not the failed run's.
+    task_count = (merge_only and config.shard_task_count) or config.task_count
+    logger.info(f"Merging {task_count} shards of {run_key}")
+    try:
+        with span("shard.merge", shards=task_count) as merge_span:
+            merged = load_shards(store, run_key, task_count, window.label)
+            merge_span.add(
+                items=sum(len(sales) for sales in merged.sales_by_machine.values())
+            )
+    except (LookupError, ValueError) as e:
+        # A shard is missing or from another day- nothing is sent, and the shards are kept for another --merge-shards.
+        logger.error(f"Could not merge the shards of {run_key}: {e}")
+        summary.update(error="shards")
+        return None, window
+    summary.update(merged=True)
+    return merged, window
+
+
+def main_stages(context, spool, logger, summary, window=None, sales_source=None):
+    """
+    Fetches, groups and sends the day's notifications and saves the checkpoints.
+
+    Returns:
+    True if the day was processed and the checkpoints saved, otherwise None
+    """
+
+    machine_ids = get_config().machine_ids
 
-        return
+    try:
 
-    logger.info(f"{len(daily_sales)} sales from yesterday")
+        # The config bucket named by the CONFIG_BUCKET environment variable- will be used for both load_customers and load_products
+        bucket = context.bucket
 
-    customer_sales_dict = group_sales_by_customer(
-        daily_sales, customer_product_dict, product_costs
-    )
-    logger.info(f"Grouped sales for {len(customer_sales_dict)} customers")
+        # Load the customer, product and email template files concurrently.
+        config = load_config_bundle(bucket)
 
-    if len(customer_sales_dict) == 0:
-        logger.Error(f"Customer sales dictionary is empty")
+    except Exception as e:
+        # Nothing can be grouped or priced without them- end the run before fetching or moving any checkpoints.
+        logger.error(
+            f"Error loading customer, product and email template files: {e}",
+            exc_info=True,
+        )
+        summary.update(error="config")
         return
 
-    notification_start_time = time.time()
+    # Load the newest sale already processed for each machine so only new sales are scanned.
+    with span("checkpoints.load") as load_span:
+        checkpoints = load_checkpoints(bucket, checkpoint_file)
+        load_span.add(items=len(checkpoints))
+    # The sales processed on the last few days, in case a fetch returns some of them again.
+    with span("dedup.load"):
+        dedup = TransactionFilter(load_transaction_history(bucket))
+    # Compute yesterday's UTC window once and share it across every machine.
+    window = window or get_day_window()
+    sales_date = window.label
+    already_processed = is_day_processed(checkpoints, machine_ids, sales_date)
+
+    # When the intraday poller ran through the day, send from its sales instead of downloading and scanning every machine again.
+    if sales_source is None:
+        day = load_completed_day(bucket, sales_date, machine_ids)
+        if day is not None:
+            logger.info(f"Sending from the intraday sales for {sales_date}")
+            sales_source = day.sales_source
+            summary.update(intraday=True)
+
+    # Fetch, group, render, send and persist run as concurrent stages, so the first customer's email goes out while later machines are still downloading.
+    logger.info(f"Fetching sales for Machine IDs: {', '.join(machine_ids)}")
+    with span("pipeline", machines=len(machine_ids)) as pipeline_span:
+        result = run_pipeline(
+            machine_ids,
+            checkpoints,
+            config,
+            window,
+            spool,
+            bucket,
+            sales_source=sales_source,
+            dedup=dedup,
+        )
+        pipeline_span.set(
+            customers=result.customers, sent=result.sent, failed=result.failed
+        )
 
-    messages, itemized_receipt_rows, sales_list = create_notifications(
-        bucket, customer_sales_dict
-    )
-    notification_rows, notification_success, notification_fail = send_notifications(
-        messages
+    for machine_id, machine_daily_sales in result.sales_by_machine.items():
+        update_checkpoint(checkpoints, machine_id, machine_daily_sales, sales_date)
+
+    daily_sales_count = sum(len(sales) for sales in result.sales_by_machine.values())
+    summary.update(
+        sales=daily_sales_count,
+        customers=result.customers,
+        render_failed=result.render_failed,
+        sent=result.sent,
+        failed=result.failed,
+        duplicates=result.duplicates,
+        already_processed=result.already_processed,
     )
-    logger.info(
-        f"Notifications sent: {notification_success} successful. {notification_fail} failed"
-    )
-    notification_end_time = time.time()
-    notification_time = notification_end_time - notification_start_time
-    logger.info(f"It took {notification_time} seconds to send notifications")
-
-    # Calculate the start time
-    connect_sheet_start = time.time()
-    try:
-
-        sheet = connect_sheets()
-
-    except Exception as e:
-        logger.error(f"Error connecting to sheets: {e}")
 
-    connect_sheet_end = time.time()
-    connect_sheet_time = connect_sheet_end - connect_sheet_start
-    logger.info(f"It took {connect_sheet_time} seconds to connect to sheets")
+    # A rerun on the same day finds no new sales- don't send a second "no sales" email.
+    if not daily_sales_count and (already_processed or result.already_processed):
+        logger.info(
+            f"Sales from {sales_date} were already processed. Ending program execution"
+        )
+        return True
 
-    sheet_start_time = time.time()
+    # Send a notification to main address and end program execution if no sales found.
+    if not daily_sales_count and not result.render_failed:
 
-    try:
+        logger.info("No sales from yesterday. Ending program execution")
+        send_no_sales_notification(spool, sales_date)
+        with span("checkpoints.save", machines=len(checkpoints)):
+            save_checkpoints(bucket, checkpoints, checkpoint_file)
+        return True
 
-        write_to_sheet(sheet, 0, notification_rows)
-        logger.info(f"Wrote to Notification Sheet")
-        write_to_sheet(sheet, 1, itemized_receipt_rows)
-        logger.info(f"Wrote to Itemized Receipt Sheet")
-        write_to_sheet(sheet, 2, sales_list)
-        logger.info(f"Wrote to Transaction Log Sheet")
+    logger.info(f"{daily_sales_count} sales from yesterday")
+    logger.info(f"Grouped sales for {result.customers} customers")
 
-    except Exception as e:
-        logger.error(f"Error writing to sheets: {str(e)}")
+    if result.customers == 0:
+        logger.error("Customer sales dictionary is empty")
+        return
 
-    sheet_end_time = time.time()
-    sheet_write_time = sheet_end_time - sheet_start_time
-    logger.info(f"It took {sheet_write_time} seconds to write to sheets ")
+    logger.info(f"Notifications sent: {result.sent} successful. {result.failed} failed")
 
-    program_end_time = time.time()
-    program_run_time = program_end_time - program_start_time
-    logger.info(f"It took, {program_run_time} seconds to run the whole program")
-    logger.info(f"Program execution ended")
+    # The machines of customers that could not be rendered were left out of result.sales_by_machine, so their checkpoints stay put and the next run sends them.
+    if result.render_failed:
+        logger.error(
+            f"Notifications for {result.render_failed} customers could not be rendered and will be sent next run"
+        )
+        summary.update(error="render")
+
+    # Only move the checkpoints forward and remember the sales once the notifications went out.
+    with span("checkpoints.save", machines=len(checkpoints)):
+        save_checkpoints(bucket, checkpoints, checkpoint_file)
+    with span("dedup.save") as save_span:
+        dedup.commit(sales_date)
+        save_span.add(bytes=save_transaction_history(bucket, dedup.history))
+
+    # Wait for the spooled rows to finish writing to the Notification, Itemized Receipt and Transaction Log Sheets.
+    with span("sheets.drain") as drain_span:
+        unwritten_rows = spool.close()
+        drain_span.add(items=spool.rows_written).set(unwritten=unwritten_rows)
+    summary.update(sheet_rows=spool.rows_written, unwritten_rows=unwritten_rows)
+
+    if unwritten_rows:
+        logger.error(
+            f"{unwritten_rows} rows could not be written to sheets and will be retried next run"
+        )
+    else:
+        logger.info(
+            f"Wrote {spool.rows_written} rows to Notification, Itemized Receipt and Transaction Log Sheets"
+        )
+    return True
 
 
 if __name__ == "__main__":
-    main()
+    # python main.py --resend-failed only sends the notifications waiting in the retry queue.
+    # python main.py --merge-shards merges the shards of a sharded run whose merging task failed.
+    # python main.py --poll polls the machines through the day and keeps the sales the daily run sends from.
+    main(
+        resend_failed="--resend-failed" in sys.argv[1:],
+        merge_shards="--merge-shards" in sys.argv[1:],
+        poll="--poll" in sys.argv[1:],
+    )
@@ -0,0 +1,53 @@
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+# Lets plain `pytest` import the service modules from the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.config import Config, set_config
+from utils.sales import Sale
+
+
+@pytest.fixture(autouse=True)
+def config():
+    """
+    A Config that needs no environment variables, restored after each test.
+    """
+    previous = set_config(
+        Config("test-key", "sender@example.com", "password", "notify@example.com")
+    )
+    yield
+    set_config(previous)
+
+
+@pytest.fixture
+def make_sale():
+    """
+    Returns a function building a Sale with defaults for the fields a test doesn't care about.
+    """
+
+    def make_sale(
+        transaction_id,
+        authorized_at,
+        product_name="Sticker Left",
+        quantity=1,
+        settlement_cents=500,
+        machine_id="942488501",
+    ):
+        if isinstance(authorized_at, str):
+            authorized_at = datetime.fromisoformat(authorized_at).replace(
+                tzinfo=timezone.utc
+            )
+        return Sale(
+            transaction_id,
+            machine_id,
+            product_name,
+            quantity,
+            settlement_cents,
+            authorized_at,
+        )
+
+    return make_sale
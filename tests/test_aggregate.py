@@ -0,0 +1,77 @@
+from utils.aggregate import aggregate_sales
+from utils.customers import Customer
+
+ALICE = Customer("Alice", "alice@example.com", ("Sticker Left", "Mug"))
+BOB = Customer("Bob", "bob@example.com", ("Sticker Right",))
+
+PRODUCT_COSTS = {"Sticker Left": 333, "Sticker Right": 250, "Mug": 1099}
+
+
+def test_totals_are_exact_cents(make_sale):
+    customer_sales = {
+        ALICE: [
+            make_sale(1, "2025-10-06T20:00:00", "Sticker Left", 2),
+            make_sale(2, "2025-10-06T19:00:00", "Mug", 1),
+            make_sale(3, "2025-10-06T18:00:00", "Sticker Left", 1),
+        ],
+        BOB: [make_sale(4, "2025-10-06T17:00:00", "Sticker Right", 3)],
+    }
+
+    aggregate = aggregate_sales(customer_sales, PRODUCT_COSTS)
+
+    # 3 x 333 + 1099, with no float rounding on the way.
+    assert aggregate.totals == {ALICE: 2098, BOB: 750}
+    assert aggregate.line_items == {
+        ALICE: [("Sticker Left", 3, 999), ("Mug", 1, 1099)],
+        BOB: [("Sticker Right", 3, 750)],
+    }
+    assert aggregate.revenue_cents == 2848
+    assert aggregate.settlement_cents == 4 * 500
+
+
+def test_receipt_rows_per_customer_product_and_day(make_sale):
+    customer_sales = {
+        ALICE: [
+            # 10-06 in the machines' timezone.
+            make_sale(1, "2025-10-06T20:00:00", "Sticker Left", 1),
+            make_sale(2, "2025-10-06T18:00:00", "Sticker Left", 1),
+            # Still 10-05 locally.
+            make_sale(3, "2025-10-06T03:00:00", "Sticker Left", 4),
+        ]
+    }
+
+    aggregate = aggregate_sales(customer_sales, PRODUCT_COSTS)
+
+    assert sorted(aggregate.receipt_rows) == [
+        ["10-05-2025", "Alice", "alice@example.com", "Sticker Left", 4, 1332],
+        ["10-06-2025", "Alice", "alice@example.com", "Sticker Left", 2, 666],
+    ]
+    assert [row[3:] for row in aggregate.transaction_rows] == [
+        ["Sticker Left", 1, 333],
+        ["Sticker Left", 1, 333],
+        ["Sticker Left", 4, 1332],
+    ]
+
+
+def test_unpriced_product_uses_settled_value(make_sale):
+    customer_sales = {
+        ALICE: [
+            make_sale(1, "2025-10-06T20:00:00", "Sticker Left", 1),
+            make_sale(2, "2025-10-06T19:00:00", "Poster", 2, settlement_cents=1500),
+        ],
+        BOB: [make_sale(3, "2025-10-06T18:00:00", "Sticker Right", 1)],
+    }
+
+    aggregate = aggregate_sales(customer_sales, PRODUCT_COSTS)
+
+    # The unpriced product doesn't fail the other customer's totals.
+    assert aggregate.totals == {ALICE: 333 + 1500, BOB: 250}
+    assert ("Poster", 2, 1500) in aggregate.line_items[ALICE]
+
+
+def test_no_sales(make_sale):
+    aggregate = aggregate_sales({}, PRODUCT_COSTS)
+
+    assert aggregate.totals == {}
+    assert aggregate.receipt_rows == []
+    assert aggregate.revenue_cents == 0
@@ -0,0 +1,146 @@
+from dataclasses import replace
+
+import pytest
+
+from benchmarks.standins import FileBucket
+from utils.config import get_config, set_config, transaction_history_file
+from utils.dedup import (
+    TransactionFilter,
+    TransactionHistory,
+    load_transaction_history,
+    save_transaction_history,
+    transaction_key,
+)
+
+
+def _history(days=3):
+    # A tiny false match rate, so a key that was never added is never found.
+    return TransactionHistory(days, capacity=1000, error_rate=1e-12)
+
+
+@pytest.fixture
+def sales(make_sale):
+    return [
+        make_sale(
+            transaction_id, f"2025-10-06T{10 + transaction_id:02d}:00:00", "Sticker"
+        )
+        for transaction_id in range(5)
+    ]
+
+
+def test_filter_drops_sales_seen_twice_in_a_run(sales):
+    dedup = TransactionFilter()
+
+    assert dedup.new_sales(sales[:3]) == sales[:3]
+    assert dedup.new_sales(sales[2:]) == sales[3:]
+    assert dedup.duplicates == 1
+
+
+def test_multivend_products_are_different_sales(make_sale):
+    first = make_sale(7, "2025-10-06T10:00:00", "Sticker Left")
+    second = make_sale(7, "2025-10-06T10:00:00", "Sticker Right")
+
+    assert transaction_key(first) != transaction_key(second)
+    assert TransactionFilter().new_sales([first, second]) == [first, second]
+
+
+def test_filter_drops_sales_processed_by_an_earlier_run(sales):
+    history = _history()
+    earlier = TransactionFilter(history)
+    earlier.new_sales(sales[:2])
+    earlier.commit("10-06-2025")
+
+    dedup = TransactionFilter(history)
+
+    assert dedup.new_sales(sales) == sales[2:]
+    assert dedup.already_processed == 2
+
+
+def test_discarded_sales_are_not_committed(sales):
+    history = _history()
+    dedup = TransactionFilter(history)
+    dedup.new_sales(sales)
+    dedup.discard(sales[3:])
+    dedup.commit("10-06-2025")
+
+    assert history.contains_many([transaction_key(sale) for sale in sales]) == [
+        True,
+        True,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_history_rotation_drops_old_days():
+    history = _history(days=2)
+    history.add_many("10-04-2025", [1])
+    history.add_many("10-05-2025", [2])
+    history.add_many("10-06-2025", [3])
+
+    assert list(history.filters) == ["10-05-2025", "10-06-2025"]
+    assert history.contains_many([1, 2, 3]) == [False, True, True]
+
+
+def test_history_round_trip():
+    history = _history()
+    history.add_many("10-05-2025", [1, 2])
+    history.add_many("10-06-2025", [3])
+
+    loaded = _history().load_bytes(history.to_bytes())
+
+    assert list(loaded.filters) == ["10-05-2025", "10-06-2025"]
+    assert loaded.contains_many([1, 2, 3, 4]) == [True, True, True, False]
+
+
+def test_history_of_another_size_is_dropped():
+    history = _history()
+    history.add_many("10-06-2025", [1])
+
+    resized = TransactionHistory(3, capacity=2000, error_rate=1e-12)
+
+    assert resized.load_bytes(history.to_bytes()).filters == {}
+
+
+@pytest.mark.parametrize(
+    "data",
+    [b"not a history", b'{"bits": 8}\n', b'{"bits": 8, "hashes": 1, "dates": []}'],
+)
+def test_unreadable_history_is_rejected(data):
+    with pytest.raises(ValueError):
+        _history().load_bytes(data)
+
+
+def test_truncated_history_is_rejected():
+    history = _history()
+    history.add_many("10-06-2025", [1])
+
+    with pytest.raises(ValueError):
+        _history().load_bytes(history.to_bytes()[:-1])
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    set_config(replace(get_config(), dedup_capacity=1000))
+    return FileBucket(str(tmp_path))
+
+
+def test_saved_history_is_loaded_by_the_next_run(bucket):
+    history = load_transaction_history(bucket)
+    assert history.filters == {}
+
+    history.add_many("10-06-2025", [1])
+    save_transaction_history(bucket, history)
+
+    assert load_transaction_history(bucket).contains_many([1, 2]) == [True, False]
+
+
+def test_corrupt_history_is_not_overwritten(bucket, tmp_path):
+    path = tmp_path / transaction_history_file
+    path.write_bytes(b"corrupt")
+
+    history = load_transaction_history(bucket)
+    save_transaction_history(bucket, history)
+
+    assert history is None
+    assert path.read_bytes() == b"corrupt"
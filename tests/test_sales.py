@@ -0,0 +1,180 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from utils.checkpoints import update_checkpoint
+from utils.sales import get_daily_sales, iter_sales
+from utils.time import get_day_window
+
+
+def _api_sale(transaction_id, product_name, quantity, value, authorized_at):
+    return {
+        "TransactionID": transaction_id,
+        "ProductName": product_name,
+        "Quantity": quantity,
+        "SettlementValue": value,
+        "AuthorizationDateTimeGMT": authorized_at,
+        # Fields the service doesn't read are skipped.
+        "PaymentMethod": "Credit Card",
+    }
+
+
+PAYLOAD = json.dumps(
+    [
+        _api_sale(3, "Café Sticker", 2, 10.2, "2025-10-06T16:54:51.225Z"),
+        _api_sale(2, "Sticker Left", 1, 5, "2025-10-06T15:00:00.000Z"),
+        _api_sale(1, "Sticker [Right]", 1, "4.99", "2025-10-05T09:30:00.000Z"),
+    ],
+    indent=1,
+).encode("utf-8")
+
+
+def _chunks(data, size):
+    return [data[start : start + size] for start in range(0, len(data), size)]
+
+
+def _fields(sales):
+    return [
+        (sale.transaction_id, sale.product_name, sale.quantity, sale.settlement_cents)
+        for sale in sales
+    ]
+
+
+EXPECTED = [
+    (3, "Café Sticker", 2, 1020),
+    (2, "Sticker Left", 1, 500),
+    (1, "Sticker [Right]", 1, 499),
+]
+
+
+def test_iter_sales_parses_whole_payload():
+    sales = list(iter_sales([PAYLOAD], "942488501"))
+
+    assert _fields(sales) == EXPECTED
+    assert {sale.machine_id for sale in sales} == {"942488501"}
+    assert sales[0].authorized_at == datetime(
+        2025, 10, 6, 16, 54, 51, 225000, tzinfo=timezone.utc
+    )
+
+
+@pytest.mark.parametrize("size", range(1, 40))
+def test_iter_sales_any_chunk_boundary(size):
+    # Small chunks split the sales, the brackets and the two bytes of "é" at every offset.
+    assert _fields(iter_sales(_chunks(PAYLOAD, size))) == EXPECTED
+
+
+def test_iter_sales_empty_list():
+    assert list(iter_sales([b" [ ] "])) == []
+
+
+def test_iter_sales_unexpected_format():
+    assert list(iter_sales([b'{"error": "machine not found"}'])) == []
+
+
+def test_iter_sales_stops_reading_when_caller_stops():
+    read = []
+
+    def chunks():
+        for chunk in _chunks(PAYLOAD, 16):
+            read.append(chunk)
+            yield chunk
+
+    sales = iter_sales(chunks())
+    assert next(sales).transaction_id == 3
+    sales.close()
+
+    assert len(read) < len(_chunks(PAYLOAD, 16))
+
+
+@pytest.mark.parametrize("cut", [-1, -5, len(PAYLOAD) // 2])
+def test_iter_sales_truncated_payload(cut):
+    sales = iter_sales(_chunks(PAYLOAD[:cut], 7))
+
+    with pytest.raises(ValueError):
+        list(sales)
+
+
+def test_iter_sales_truncated_after_a_whole_sale():
+    # Cut right after the first sale's closing brace- the list was never closed.
+    end = PAYLOAD.index(b"}") + 1
+    received = []
+
+    with pytest.raises(ValueError):
+        for sale in iter_sales([PAYLOAD[:end]]):
+            received.append(sale)
+
+    assert _fields(received) == EXPECTED[:1]
+
+
+@pytest.fixture
+def window():
+    # The machines' 10-06-2025, as the run on the morning of the 7th sees it.
+    return get_day_window(now=datetime(2025, 10, 7, 15, tzinfo=timezone.utc))
+
+
+@pytest.fixture
+def last_sales(make_sale, window):
+    # Newest first, as the API returns them: two sales from today, three from yesterday and one from the day before.
+    times = [
+        window.end + timedelta(hours=2),
+        window.end + timedelta(minutes=1),
+        window.end - timedelta(microseconds=1),
+        window.start + timedelta(hours=12),
+        window.start,
+        window.start - timedelta(microseconds=1),
+    ]
+    return [
+        make_sale(transaction_id, authorized_at)
+        for transaction_id, authorized_at in zip(range(6, 0, -1), times)
+    ]
+
+
+def _ids(sales):
+    return [sale.transaction_id for sale in sales]
+
+
+def test_get_daily_sales_keeps_only_the_window(last_sales, window):
+    assert _ids(get_daily_sales(last_sales, None, window)) == [4, 3, 2]
+
+
+def test_get_daily_sales_stops_at_checkpoint(last_sales, window):
+    checkpoints = update_checkpoint({}, "942488501", last_sales[3:4], window.label)
+
+    assert _ids(get_daily_sales(last_sales, checkpoints["942488501"], window)) == [4]
+
+
+def test_get_daily_sales_stops_at_older_sale_than_checkpoint(
+    make_sale, last_sales, window
+):
+    # The checkpointed sale itself dropped off the list- the first older sale stops the scan.
+    checkpoints = update_checkpoint(
+        {},
+        "942488501",
+        [make_sale(99, last_sales[3].authorized_at + timedelta(seconds=1))],
+        window.label,
+    )
+
+    assert _ids(get_daily_sales(last_sales, checkpoints["942488501"], window)) == [4]
+
+
+def test_get_daily_sales_reads_no_further_than_it_needs(last_sales, window):
+    read = []
+
+    def stream():
+        for sale in last_sales:
+            read.append(sale.transaction_id)
+            yield sale
+
+    checkpoints = update_checkpoint({}, "942488501", last_sales[3:4], window.label)
+    get_daily_sales(stream(), checkpoints["942488501"], window)
+
+    assert read == [6, 5, 4, 3]
+
+
+def test_update_checkpoint_keeps_old_position_without_sales(last_sales, window):
+    checkpoints = update_checkpoint({}, "942488501", last_sales[2:4], window.label)
+    update_checkpoint(checkpoints, "942488501", [], "10-07-2025")
+
+    assert checkpoints["942488501"]["transaction_id"] == 4
+    assert checkpoints["942488501"]["sales_date"] == "10-07-2025"
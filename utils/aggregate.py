@@ -0,0 +1,188 @@
+from dataclasses import dataclass, field
+from utils.products import format_cents
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+@dataclass
+class SalesAggregate:
+    """
+    The per-customer and per-product totals for a set of sales, in the shapes the notification stage needs.
+
+    line_items: {Customer: [(product_name, quantity_sold, revenue_cents), ...]} - one entry per product for the email. \n
+    totals: {Customer: revenue_cents} \n
+    receipt_rows: [[date, customer.name, customer.email, product_name, quantity_sold, revenue_cents], ...] - one row per (customer, product, day). \n
+    transaction_rows: [[transaction_dt, customer.name, customer.email, product_name, quantity_sold, revenue_cents], ...] - one row per sale. \n
+    revenue_cents / settlement_cents: the run totals, to reconcile the priced revenue against SettlementValue.
+    """
+
+    line_items: dict = field(default_factory=dict)
+    totals: dict = field(default_factory=dict)
+    receipt_rows: list = field(default_factory=list)
+    transaction_rows: list = field(default_factory=list)
+    revenue_cents: int = 0
+    settlement_cents: int = 0
+
+
+def _group_starts(sorted_keys):
+    import numpy as np
+
+    # Index of the first element of each run of equal keys.
+    return np.concatenate(([0], np.flatnonzero(np.diff(sorted_keys)) + 1))
+
+
+def aggregate_sales(customer_sales_dict: dict, product_costs: dict):
+    """
+    Builds columnar arrays of customer ids, product ids, days, quantities and cents from the grouped sales, then computes every total with NumPy group-by reductions keyed by (customer, product, day).
+
+    Args:
+    customer_sales_dict (dict): dictionary of {Customer: [Sale, ...]} from group_sales_by_customer() \n
+    product_costs (dict): dictionary of {"product name": price in cents} from load_product_costs(). Sales of a product without a price are counted at their settled value, as in sale_cents().
+
+    Returns:
+    A SalesAggregate
+    """
+
+    # Imported on first use so runs without sales don't load NumPy.
+    import numpy as np
+
+    aggregate = SalesAggregate()
+
+    customers = list(customer_sales_dict)
+    product_ids = {}
+    day_ids = {}
+    customer_column = []
+    product_column = []
+    day_column = []
+    quantity_column = []
+    settlement_column = []
+    transaction_dts = []
+
+    for customer_id, customer in enumerate(customers):
+        for sale in customer_sales_dict[customer]:
+            local_time = sale.local_time
+            day = local_time.strftime("%m-%d-%Y")
+            customer_column.append(customer_id)
+            product_column.append(
+                product_ids.setdefault(sale.product_name, len(product_ids))
+            )
+            day_column.append(day_ids.setdefault(day, len(day_ids)))
+            quantity_column.append(sale.quantity)
+            settlement_column.append(sale.settlement_cents)
+            transaction_dts.append(str(local_time))
+
+    if not customer_column:
+        return aggregate
+
+    products = list(product_ids)
+    days = list(day_ids)
+
+    customer_ids = np.array(customer_column, dtype=np.int64)
+    product_id_column = np.array(product_column, dtype=np.int64)
+    day_id_column = np.array(day_column, dtype=np.int64)
+    quantities = np.array(quantity_column, dtype=np.int64)
+
+    settlements = np.array(settlement_column, dtype=np.int64)
+
+    unpriced = [product for product in products if product not in product_costs]
+    if unpriced:
+        logger.warning(
+            "No price in the products file for %s- using the settled value of their sales",
+            ", ".join(unpriced),
+        )
+
+    # Price every sale at once from a per-product unit price lookup.
+    unit_cents = np.array(
+        [product_costs.get(product, 0) for product in products], dtype=np.int64
+    )
+    priced = np.array([product in product_costs for product in products], dtype=bool)
+    cents = np.where(
+        priced[product_id_column],
+        quantities * unit_cents[product_id_column],
+        settlements,
+    )
+
+    # One transaction log row per sale.
+    for customer_id, product_id, quantity, sale_cents, transaction_dt in zip(
+        customer_column,
+        product_column,
+        quantity_column,
+        cents.tolist(),
+        transaction_dts,
+    ):
+        customer = customers[customer_id]
+        aggregate.transaction_rows.append(
+            [
+                transaction_dt,
+                customer.name,
+                customer.email,
+                products[product_id],
+                quantity,
+                sale_cents,
+            ]
+        )
+
+    # Encode (customer, product, day) as one integer so a single sort groups the sales.
+    keys = (customer_ids * len(products) + product_id_column) * len(
+        days
+    ) + day_id_column
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = _group_starts(sorted_keys)
+
+    group_keys = sorted_keys[starts]
+    group_quantities = np.add.reduceat(quantities[order], starts)
+    group_cents = np.add.reduceat(cents[order], starts)
+
+    group_days = group_keys % len(days)
+    group_products = (group_keys // len(days)) % len(products)
+    group_customers = group_keys // (len(days) * len(products))
+
+    customer_totals = np.zeros(len(customers), dtype=np.int64)
+    np.add.at(customer_totals, customer_ids, cents)
+
+    for customer_id, product_id, day_id, quantity, group_total in zip(
+        group_customers.tolist(),
+        group_products.tolist(),
+        group_days.tolist(),
+        group_quantities.tolist(),
+        group_cents.tolist(),
+    ):
+        customer = customers[customer_id]
+        product_name = products[product_id]
+        aggregate.receipt_rows.append(
+            [
+                days[day_id],
+                customer.name,
+                customer.email,
+                product_name,
+                quantity,
+                group_total,
+            ]
+        )
+        aggregate.line_items.setdefault(customer, []).append(
+            (product_name, quantity, group_total)
+        )
+
+    # Keep the customers in the order they were grouped in.
+    for customer_id, customer in enumerate(customers):
+        aggregate.totals[customer] = int(customer_totals[customer_id])
+
+    aggregate.revenue_cents = int(customer_totals.sum())
+    aggregate.settlement_cents = int(settlements.sum())
+
+    logger.info(
+        "Priced revenue $%s, settled value $%s",
+        format_cents(aggregate.revenue_cents),
+        format_cents(aggregate.settlement_cents),
+    )
+
+    logger.info(
+        "Aggregated %d sales into %d receipt rows for %d customers",
+        len(quantities),
+        len(starts),
+        len(customers),
+    )
+
+    return aggregate
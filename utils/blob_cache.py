@@ -0,0 +1,115 @@
+import json
+import os
+from urllib.parse import quote
+from .config import get_config
+from utils.spans import span
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+def _cache_paths(bucket, blob_name, cache_dir):
+    # One data file and one metadata file per object, named so any blob name is a safe file name.
+    base = os.path.join(cache_dir, quote(f"{bucket.name}/{blob_name}", safe=""))
+    return base + ".data", base + ".meta.json"
+
+
+def _read_cached(data_path, meta_path):
+    try:
+        with open(meta_path, "r") as meta_file:
+            meta = json.load(meta_file)
+        with open(data_path, "rb") as data_file:
+            return data_file.read(), meta
+    except (OSError, ValueError):
+        return None, None
+
+
+def _write_cached(data_path, meta_path, data, meta):
+    # Write to temporary files and rename so a concurrent reader never sees a partial file.
+    try:
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        for path, content, mode in (
+            (data_path, data, "wb"),
+            (meta_path, json.dumps(meta), "w"),
+        ):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, mode) as tmp_file:
+                tmp_file.write(content)
+            os.replace(tmp_path, path)
+
+    except OSError as e:
+        logger.warning(f"Error caching blob to {data_path}: {e}")
+
+
+def is_not_found(error):
+    """
+    Returns True if error means the blob or file doesn't exist, as opposed to one that couldn't be read.
+    """
+    if isinstance(error, FileNotFoundError):
+        return True
+    try:
+        # Imported here so loading the module doesn't import the Google client.
+        from google.api_core.exceptions import NotFound
+    except ImportError:
+        return False
+    return isinstance(error, NotFound)
+
+
+def read_blob(bucket, blob_name, cache_dir=None):
+    """
+    Returns the contents of a blob, using a local copy when the object has not changed.
+
+    The local copy is keyed by the object's generation. If one exists, the download is sent with if_generation_not_match so an unchanged object costs a single request with an empty 304 response instead of a full transfer.
+
+    Args:
+        bucket (GCS bucket): The bucket holding the blob. \n
+        blob_name (str): Name of the blob. \n
+        cache_dir (str): Local cache directory. Defaults to blob_cache_dir from the config- an empty value disables the cache.
+
+    Returns:
+        The blob contents as bytes. Raises the storage client's exception if the blob can't be read.
+    """
+
+    with span("gcs.read", blob=blob_name) as read_span:
+        data, cached = _read_blob(bucket, blob_name, cache_dir)
+        read_span.add(bytes=len(data)).set(cached=cached)
+        return data
+
+
+def _read_blob(bucket, blob_name, cache_dir):
+    # Returns the blob contents and whether they came from the local cache.
+    cache_dir = get_config().blob_cache_dir if cache_dir is None else cache_dir
+    blob = bucket.blob(blob_name)
+
+    if not cache_dir:
+        return blob.download_as_bytes(), False
+
+    data_path, meta_path = _cache_paths(bucket, blob_name, cache_dir)
+    cached_data, meta = _read_cached(data_path, meta_path)
+
+    if cached_data is not None and meta.get("generation"):
+        # Imported here- the storage client has already loaded it by the time a blob is read.
+        from google.api_core.exceptions import NotModified
+
+        try:
+            data = blob.download_as_bytes(if_generation_not_match=meta["generation"])
+        except NotModified:
+            logger.info(
+                "Using cached %s (generation %s)", blob_name, meta["generation"]
+            )
+            return cached_data, True
+    else:
+        data = blob.download_as_bytes()
+
+    # The download fills in the generation and etag from the response headers.
+    generation = getattr(blob, "generation", None)
+
+    if generation:
+        _write_cached(
+            data_path,
+            meta_path,
+            data,
+            {"generation": int(generation), "etag": getattr(blob, "etag", None)},
+        )
+
+    return data, False
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Tuple
+from .config import customer_file, product_file, email_template
+from utils.customers import (
+    Customer,
+    load_customers,
+    create_customer_list,
+    get_customer_to_product_map,
+)
+from utils.products import load_product_costs
+from utils.notifications import load_email_template
+from utils.spans import span, current_span
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+@dataclass(frozen=True)
+class ConfigBundle:
+    customers: Tuple[Customer, ...]
+    customer_product_dict: Mapping[str, Customer]
+    product_costs: Mapping[str, int]
+    email_template: Mapping[str, str]
+
+
+def _load_customer_info(bucket, customer_file):
+    customers = create_customer_list(load_customers(bucket, customer_file))
+    return tuple(customers), get_customer_to_product_map(customers)
+
+
+@span("config.load")
+def load_config_bundle(
+    bucket,
+    customer_file=customer_file,
+    product_file=product_file,
+    email_template=email_template,
+):
+    """
+    Downloads and parses the customers, products and email template files from GCP at the same time, so loading the config costs a single round-trip instead of three in a row.
+
+    Args:
+        bucket (GCS bucket): The config bucket. \n
+        customer_file, product_file, email_template (str): File names in the bucket. Default to the file names in the config.
+
+    Returns:
+        A ConfigBundle. Its dictionaries are read-only views so the stages can share it safely.
+    """
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        customers_future = executor.submit(_load_customer_info, bucket, customer_file)
+        products_future = executor.submit(load_product_costs, bucket, product_file)
+        template_future = executor.submit(load_email_template, bucket, email_template)
+
+        customers, customer_product_dict = customers_future.result()
+        product_costs = products_future.result()
+        et = template_future.result()
+
+    current_span().add(items=len(customers))
+    logger.info(
+        f"Loaded {len(customers)} customers, {len(customer_product_dict)} customer products and {len(product_costs)} product prices"
+    )
+
+    return ConfigBundle(
+        customers,
+        MappingProxyType(customer_product_dict),
+        MappingProxyType(product_costs),
+        MappingProxyType(et),
+    )
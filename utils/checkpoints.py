@@ -0,0 +1,119 @@
+import json
+from .config import checkpoint_file
+from utils.blob_cache import is_not_found
+from utils.time import parse_gmt, format_gmt
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+def load_checkpoints(bucket, checkpoint_file=checkpoint_file):
+    """
+    Opens the checkpoint json file from GCP. It records the newest sale that was already processed for each machine.
+
+    Args:
+        checkpoint_file (str): Name of the checkpoint file in the bucket. Defaults to the checkpoint_file in the config.
+
+    Returns:
+        A dictionary in the format {machine_id: {"transaction_id": id, "authorization_dt": "2025-10-06T16:54:51.225Z", "sales_date": "10-06-2025"}}. Empty if the file does not exist yet.
+
+    Any other error reading the file is raised, so a run that can't tell what was already sent doesn't send the whole day again.
+    """
+
+    blob = bucket.blob(checkpoint_file)
+    logger.info(f"Reading checkpoints from: {checkpoint_file}")
+
+    try:
+        checkpoint_string = blob.download_as_bytes().decode("utf-8")
+    except Exception as e:
+        if not is_not_found(e):
+            logger.error(f"Error reading {checkpoint_file} from GCS: {e}")
+            raise
+        # The file won't exist on the first run- every sale is treated as new.
+        logger.warning(
+            f"No checkpoints read from {checkpoint_file}: it doesn't exist yet"
+        )
+        return {}
+
+    return json.loads(checkpoint_string)
+
+
+def save_checkpoints(bucket, checkpoints, checkpoint_file=checkpoint_file):
+    """
+    Uploads the checkpoint dictionary to GCP so the next run can skip the sales that were already processed.
+
+    Args:
+        checkpoints (dict): Dictionary returned from load_checkpoints() and updated with update_checkpoint(). \n
+        checkpoint_file (str): Name of the checkpoint file in the bucket. Defaults to the checkpoint_file in the config.
+    """
+
+    blob = bucket.blob(checkpoint_file)
+
+    try:
+        blob.upload_from_string(
+            json.dumps(checkpoints, indent=2), content_type="application/json"
+        )
+        logger.info(f"Saved checkpoints for {len(checkpoints)} machines")
+
+    except Exception as e:
+        logger.error(f"Error writing {checkpoint_file} to GCS: {e}")
+
+
+def is_checkpointed(sale, checkpoint):
+    """
+    Returns True if the sale was already processed by a previous run. Since the API response is ordered newest first, every sale after it was processed as well.
+
+    Args:
+        sale (Sale): A sale from the API response. \n
+        checkpoint (dict): The checkpoint for the sale's machine, or None.
+
+    Returns:
+        Boolean
+    """
+
+    # A machine that has never had a sale has nothing to stop the scan at.
+    if not checkpoint or "transaction_id" not in checkpoint:
+        return False
+
+    if sale.transaction_id == checkpoint["transaction_id"]:
+        return True
+
+    return sale.authorized_at < parse_gmt(checkpoint["authorization_dt"])
+
+
+def update_checkpoint(checkpoints, machine_id, machine_daily_sales, sales_date):
+    """
+    Moves the checkpoint for a machine up to the newest of the sales that were just processed.
+
+    Args:
+        checkpoints (dict): Dictionary of checkpoints to update in place. \n
+        machine_id (str): The machine the sales came from. \n
+        machine_daily_sales (list): The sales from get_daily_sales() for this machine. \n
+        sales_date (str): The date the sales were processed for, from DayWindow.label.
+
+    Returns:
+        The updated checkpoints dictionary.
+    """
+
+    checkpoint = dict(checkpoints.get(machine_id, {}))
+    checkpoint["sales_date"] = sales_date
+
+    if machine_daily_sales:
+        newest_sale = max(machine_daily_sales, key=lambda sale: sale.authorized_at)
+        checkpoint["transaction_id"] = newest_sale.transaction_id
+        checkpoint["authorization_dt"] = format_gmt(newest_sale.authorized_at)
+
+    checkpoints[machine_id] = checkpoint
+
+    return checkpoints
+
+
+def is_day_processed(checkpoints, machine_ids, sales_date):
+    """
+    Returns True if a previous run already processed sales_date for every machine, meaning this is a rerun on the same day.
+    """
+
+    return bool(machine_ids) and all(
+        checkpoints.get(machine_id, {}).get("sales_date") == sales_date
+        for machine_id in machine_ids
+    )
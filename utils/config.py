@@ -1,18 +1,10 @@
 import os
-from dotenv import load_dotenv
-from logger import setup_logging
+import tempfile
+from dataclasses import dataclass
+from typing import Tuple
+from threading import Lock
 
-logger = setup_logging(__name__)
-
-load_dotenv()
-
-NAYAX_API_KEY = os.environ.get("NAYAX_API_KEY", "default")
-
-if not NAYAX_API_KEY:
-    logger.error(f"Missing Nayax API key.")
-    raise EnvironmentError("Missing Nayax API key. Please set NAYAX_API_KEY")
-
-machine_ids = ["567219276", "791321280"]
+# Settings that don't depend on the environment. Importing this module reads no environment variables and has no side effects- the environment is read once by load_config(), which main() calls at startup.
 
 # The JSON file storing customer data
 customer_file = "customers.json"
@@ -20,21 +12,289 @@ customer_file = "customers.json"
 # The file containing the product prices
 product_file = "products.json"
 
+# The file storing the last processed sale for each machine
+checkpoint_file = "checkpoints.json"
+
 # The file containing the email template
 email_template = "email-template.json"
 
+# Files in the bucket holding notifications that failed to send: retried on the next run, and given up on after send_max_attempts
+retry_queue_file = "retry-queue.json"
+dead_letter_file = "dead-letter.json"
+
+# File in the bucket holding Sheets rows a run could not write, replayed by the next run
+sheets_spool_file = "sheets-spool.jsonl"
+
+# File in the bucket holding the sales collected by the intraday poller, which the daily run sends the notifications from
+intraday_state_file = "intraday-state.json"
+
+# File in the bucket holding the Bloom filters of the sales processed on the last dedup_days days
+transaction_history_file = "transaction-history.bin"
+
+# Prefix in the config bucket for the shards of a sharded run, when SHARD_STORE is not set
+shards_prefix = "shards"
+
 # The local timezone of the machines
 machine_tz = "America/Los_Angeles"
 
-# Gmail login info
-sender_email = os.environ.get("GMAIL_ADDRESS")
-sender_pw = os.environ.get("GMAIL_APP_PW")
 
-if not sender_email or not sender_pw:
-    logger.error("Missing Gmail credentials. Please set GMAIL_ADDRESS and GMAIL_APP_PW")
-    raise EnvironmentError(
-        "Missing Gmail credentials. Please set GMAIL_ADDRESS and GMAIL_APP_PW."
+@dataclass(frozen=True)
+class Config:
+    """
+    Settings read from the environment. Use get_config() to get the run's Config.
+    """
+
+    NAYAX_API_KEY: str
+    sender_email: str
+    sender_pw: str
+    # Notification parameters
+    notification_address: str = None
+
+    # The machines to report on. MACHINE_IDS is a comma separated list.
+    machine_ids: Tuple[str, ...] = ("567219276", "791321280")
+
+    # Base URL of the Nayax Lynx API. Point it at a local stand-in for load testing.
+    nayax_api_url: str = "https://lynx.nayax.com"
+
+    # The config bucket holding the customer, product, template, checkpoint and queue files
+    config_bucket: str = None
+
+    # Google Sheets service account credentials file and the sheet to write to
+    google_sheets_credentials: str = None
+    google_sheets_id: str = None
+    google_sheets_name: str = None
+
+    # Maximum number of machines whose last sales are fetched from the Nayax API at the same time
+    fetch_workers: int = 8
+
+    # Bucket file used in place of the Nayax API for testing. Set MOCK_SALES_FILE to an empty string to call the live API.
+    mock_sales_file: str = "last_sales.json"
+
+    # Seconds to wait on a single Nayax API request before giving up on that machine
+    fetch_timeout: float = 20
+
+    # Pipeline settings: threads rendering notifications, and the most items waiting between two stages before the earlier stage pauses
+    render_workers: int = 2
+    pipeline_queue_size: int = 100
+
+    # Local directory where config files from the bucket are cached by object generation. Set BLOB_CACHE_DIR to an empty string to disable the cache.
+    blob_cache_dir: str = os.path.join(tempfile.gettempdir(), "underpin-blob-cache")
+
+    # Local append-only spool of rows waiting to be written to Google Sheets, flushed by a background thread every sheets_flush_interval seconds.
+    # Rows still unwritten when the run ends are uploaded to sheets_spool_file in the bucket and replayed by the next run.
+    sheets_spool_dir: str = os.path.join(tempfile.gettempdir(), "underpin-sheets-spool")
+    sheets_flush_interval: float = 0.5
+    # Seconds the end of the run waits for the spool to finish writing to Sheets
+    sheets_spool_timeout: float = 20
+
+    # SMTP server used to send the notifications
+    smtp_host: str = "smtp.gmail.com"
+    smtp_port: int = 587
+
+    # Set SMTP_STARTTLS to "false" to send to a local SMTP server without TLS, for example in testing.
+    smtp_starttls: bool = True
+
+    # Number of SMTP connections used to send notifications in parallel
+    smtp_pool_size: int = 3
+
+    # Sending rate limit, kept well under Gmail's limits: messages per second and the largest burst
+    smtp_rate_per_second: float = 5
+    smtp_burst: int = 10
+
+    # Failed sends are retried within the run send_retries times, waiting send_retry_backoff seconds and doubling each time
+    send_retries: int = 2
+    send_retry_backoff: float = 1
+
+    # Total runs a notification is attempted in before it is moved to the dead letter file
+    send_max_attempts: int = 5
+
+    # Sharded runs: a Cloud Run Job with --tasks sets CLOUD_RUN_TASK_COUNT and gives each task its CLOUD_RUN_TASK_INDEX. With more than one task, each fetches its share of the machines and the last to finish sends the notifications.
+    task_index: int = 0
+    task_count: int = 1
+    # Local directory shared by the tasks for their shards. Defaults to the config bucket.
+    shard_store: str = ""
+    # Names the run the shards belong to, in place of CLOUD_RUN_EXECUTION. Every task of one run must share it, and each run needs a new one. Set it to a failed execution's name to merge that execution's shards with --merge-shards.
+    shard_run_id: str = ""
+    # Number of shards --merge-shards merges, for when CLOUD_RUN_TASK_COUNT is that of the merging job rather than the failed run. Defaults to task_count.
+    shard_task_count: int = 0
+
+    # Intraday polling (python main.py --poll): seconds between polls of every machine, seconds between saves of the day's sales to intraday_state_file, and seconds to poll for before exiting. A poll_duration of 0 polls until the job is stopped.
+    poll_interval: float = 300
+    poll_save_interval: float = 900
+    poll_duration: float = 0
+    # Seconds after midnight that yesterday keeps being polled for sales Nayax reports late. Keep it shorter than the time until the daily run, or the daily run fetches every machine itself.
+    poll_grace_period: float = 25200
+
+    # Sales already processed are remembered for dedup_days days (0 turns it off) in Bloom filters sized for dedup_capacity sales a day, wrongly matching a new sale at most dedup_error_rate of the time. Each day takes about 4.2 bytes per sale of capacity at the default rate.
+    dedup_days: int = 7
+    dedup_capacity: int = 100000
+    dedup_error_rate: float = 1e-7
+
+    # Log output: "json" for Cloud Logging structured JSON or "text" for reading locally, and the level of every logger.
+    log_format: str = "json"
+    log_level: str = "DEBUG"
+    # Levels for single modules, which also cover the modules below them. LOG_LEVELS is a comma separated list, for example "utils.sales=WARNING,utils.delivery=INFO".
+    log_levels: Tuple[Tuple[str, str], ...] = ()
+
+
+def load_config(environ=None, dotenv=True):
+    """
+    Reads the settings from the environment, after loading a .env file if there is one.
+
+    Args:
+    environ (dict): The environment to read. Defaults to os.environ. \n
+    dotenv (bool): Load a .env file into os.environ first.
+
+    Returns:
+    A Config
+
+    Raises EnvironmentError if the Nayax API key or Gmail credentials are missing, or the task index is out of range.
+    """
+
+    if dotenv:
+        from dotenv import load_dotenv
+
+        load_dotenv()
+
+    env = os.environ if environ is None else environ
+    defaults = Config("", "", "")
+
+    NAYAX_API_KEY = env.get("NAYAX_API_KEY", "default")
+    if not NAYAX_API_KEY:
+        _config_error("Missing Nayax API key. Please set NAYAX_API_KEY")
+
+    sender_email = env.get("GMAIL_ADDRESS")
+    sender_pw = env.get("GMAIL_APP_PW")
+    if not sender_email or not sender_pw:
+        _config_error(
+            "Missing Gmail credentials. Please set GMAIL_ADDRESS and GMAIL_APP_PW."
+        )
+
+    task_index = int(env.get("CLOUD_RUN_TASK_INDEX", defaults.task_index))
+    task_count = int(env.get("CLOUD_RUN_TASK_COUNT", defaults.task_count))
+    if task_count < 1 or not 0 <= task_index < task_count:
+        _config_error(
+            f"CLOUD_RUN_TASK_INDEX {task_index} is not a task of CLOUD_RUN_TASK_COUNT {task_count}"
+        )
+
+    return Config(
+        NAYAX_API_KEY=NAYAX_API_KEY,
+        sender_email=sender_email,
+        sender_pw=sender_pw,
+        notification_address=env.get("NOTIFICATION_ADDRESS"),
+        machine_ids=_parse_machine_ids(env.get("MACHINE_IDS"), defaults.machine_ids),
+        nayax_api_url=env.get("NAYAX_API_URL", defaults.nayax_api_url).rstrip("/"),
+        config_bucket=env.get("CONFIG_BUCKET"),
+        google_sheets_credentials=env.get("GOOGLE_SHEETS_CREDENTIALS"),
+        google_sheets_id=env.get("GOOGLE_SHEETS_ID"),
+        google_sheets_name=env.get("GOOGLE_SHEETS_NAME"),
+        fetch_workers=int(env.get("FETCH_WORKERS", defaults.fetch_workers)),
+        mock_sales_file=env.get("MOCK_SALES_FILE", defaults.mock_sales_file),
+        fetch_timeout=float(env.get("FETCH_TIMEOUT", defaults.fetch_timeout)),
+        render_workers=int(env.get("RENDER_WORKERS", defaults.render_workers)),
+        pipeline_queue_size=int(
+            env.get("PIPELINE_QUEUE_SIZE", defaults.pipeline_queue_size)
+        ),
+        blob_cache_dir=env.get("BLOB_CACHE_DIR", defaults.blob_cache_dir),
+        sheets_spool_dir=env.get("SHEETS_SPOOL_DIR", defaults.sheets_spool_dir),
+        sheets_flush_interval=float(
+            env.get("SHEETS_FLUSH_INTERVAL", defaults.sheets_flush_interval)
+        ),
+        sheets_spool_timeout=float(
+            env.get("SHEETS_SPOOL_TIMEOUT", defaults.sheets_spool_timeout)
+        ),
+        smtp_host=env.get("SMTP_HOST", defaults.smtp_host),
+        smtp_port=int(env.get("SMTP_PORT", defaults.smtp_port)),
+        smtp_starttls=env.get("SMTP_STARTTLS", "true").lower() != "false",
+        smtp_pool_size=int(env.get("SMTP_POOL_SIZE", defaults.smtp_pool_size)),
+        smtp_rate_per_second=float(
+            env.get("SMTP_RATE_PER_SECOND", defaults.smtp_rate_per_second)
+        ),
+        smtp_burst=int(env.get("SMTP_BURST", defaults.smtp_burst)),
+        send_retries=int(env.get("SEND_RETRIES", defaults.send_retries)),
+        send_retry_backoff=float(
+            env.get("SEND_RETRY_BACKOFF", defaults.send_retry_backoff)
+        ),
+        send_max_attempts=int(env.get("SEND_MAX_ATTEMPTS", defaults.send_max_attempts)),
+        task_index=task_index,
+        task_count=task_count,
+        shard_store=env.get("SHARD_STORE", defaults.shard_store),
+        shard_run_id=env.get("SHARD_RUN_ID", defaults.shard_run_id),
+        shard_task_count=int(env.get("SHARD_TASK_COUNT", defaults.shard_task_count)),
+        poll_interval=float(env.get("POLL_INTERVAL", defaults.poll_interval)),
+        poll_save_interval=float(
+            env.get("POLL_SAVE_INTERVAL", defaults.poll_save_interval)
+        ),
+        poll_duration=float(env.get("POLL_DURATION", defaults.poll_duration)),
+        poll_grace_period=float(
+            env.get("POLL_GRACE_PERIOD", defaults.poll_grace_period)
+        ),
+        dedup_days=int(env.get("DEDUP_DAYS", defaults.dedup_days)),
+        dedup_capacity=int(env.get("DEDUP_CAPACITY", defaults.dedup_capacity)),
+        dedup_error_rate=float(env.get("DEDUP_ERROR_RATE", defaults.dedup_error_rate)),
+        log_format=env.get("LOG_FORMAT", defaults.log_format).lower(),
+        log_level=env.get("LOG_LEVEL", defaults.log_level).upper(),
+        log_levels=_parse_log_levels(env.get("LOG_LEVELS")),
+    )
+
+
+def _parse_machine_ids(value, default):
+    if not value:
+        return default
+    # A machine listed twice is only fetched once.
+    return tuple(
+        dict.fromkeys(
+            machine_id.strip() for machine_id in value.split(",") if machine_id.strip()
+        )
     )
 
-# Notification parameters
-notification_address = os.environ.get("NOTIFICATION_ADDRESS")
+
+def _parse_log_levels(value):
+    levels = []
+    for item in (value or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels.append((name.strip(), level.strip().upper()))
+    return tuple(levels)
+
+
+def _config_error(message):
+    # Imported here so importing the config doesn't set up logging.
+    from logger import setup_logging
+
+    setup_logging(__name__).error(message)
+    raise EnvironmentError(message)
+
+
+_config = None
+_config_lock = Lock()
+
+
+def get_config():
+    """
+    Returns the run's Config, loading it from the environment the first time.
+    """
+    global _config
+
+    with _config_lock:
+        if _config is None:
+            _config = load_config()
+        return _config
+
+
+def set_config(config):
+    """
+    Replaces the run's Config, for example with one built for local testing. Returns the previous Config.
+    """
+    global _config
+
+    with _config_lock:
+        previous, _config = _config, config
+        return previous
+
+
+def __getattr__(name):
+    # Keeps `from utils.config import smtp_host` working for the environment settings- the Config is loaded on first access.
+    if name in Config.__dataclass_fields__:
+        return getattr(get_config(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,170 @@
+import threading
+from .config import get_config
+from utils.delivery import SMTPPool, create_rate_limiter
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+class ServiceContext:
+    """
+    Holds one shared instance of each external client for the run. Each client is created the first time it is used and then reused by every module in utils, so the stages share the same sockets, credentials and TLS sessions.
+
+    Any client can be passed in directly, for example a stand-in for local testing. The client libraries themselves are only imported when their client is first created, so a run that never uses one doesn't pay for loading it.
+    """
+
+    def __init__(
+        self,
+        bucket_name=None,
+        storage_client=None,
+        bucket=None,
+        http_session=None,
+        sheet=None,
+        smtp_factory=None,
+    ):
+        self._bucket_name = bucket_name
+        self._storage_client = storage_client
+        self._bucket = bucket
+        self._http_session = http_session
+        self._sheet = sheet
+        self._smtp_factory = smtp_factory or self._connect_smtp
+        self._smtp_pool = None
+        self._rate_limiter = None
+        self._lock = threading.RLock()
+
+    @property
+    def storage_client(self):
+        with self._lock:
+            if self._storage_client is None:
+                from google.cloud import storage
+
+                self._storage_client = storage.Client()
+            return self._storage_client
+
+    @property
+    def bucket(self):
+        """
+        The config bucket named by the CONFIG_BUCKET environment variable.
+        """
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = self.storage_client.bucket(self.bucket_name)
+            return self._bucket
+
+    @property
+    def bucket_name(self):
+        return self._bucket_name or get_config().config_bucket
+
+    @property
+    def http_session(self):
+        """
+        A keep-alive requests.Session for the Nayax API. The connection pool is sized to the number of fetch workers so concurrent requests never wait on a free connection.
+        """
+        with self._lock:
+            if self._http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                config = get_config()
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=max(config.fetch_workers, 1)
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update(
+                    {
+                        "Authorization": f"Bearer {config.NAYAX_API_KEY}",
+                        "accept": "application/js",
+                    }
+                )
+                self._http_session = session
+            return self._http_session
+
+    @property
+    def sheet(self):
+        """
+        The Google Sheet opened with the service account credentials. Authentication only happens on first use.
+        """
+        # Imported here because utils.sheets uses the context to share the sheet.
+        from utils.sheets import open_sheet
+
+        with self._lock:
+            if self._sheet is None:
+                self._sheet = open_sheet()
+            return self._sheet
+
+    def _connect_smtp(self):
+        import smtplib
+
+        config = get_config()
+        server = smtplib.SMTP(config.smtp_host, config.smtp_port)
+        if config.smtp_starttls:
+            server.starttls()
+
+        server.ehlo_or_helo_if_needed()
+        if server.has_extn("auth"):
+            server.login(config.sender_email, config.sender_pw)
+
+        logger.info("Connection success to SMTP server %s", config.smtp_host)
+        return server
+
+    @property
+    def smtp_pool(self):
+        """
+        The pool of authenticated SMTP connections. Connections are opened as the senders need them, up to smtp_pool_size.
+        """
+        with self._lock:
+            if self._smtp_pool is None:
+                self._smtp_pool = SMTPPool(self._smtp_factory)
+            return self._smtp_pool
+
+    @property
+    def rate_limiter(self):
+        """
+        The token bucket shared by every SMTP sender in the run.
+        """
+        with self._lock:
+            if self._rate_limiter is None:
+                self._rate_limiter = create_rate_limiter()
+            return self._rate_limiter
+
+    def close(self):
+        """
+        Closes the SMTP connections and the HTTP session at the end of the run.
+        """
+        with self._lock:
+            if self._smtp_pool is not None:
+                self._smtp_pool.close()
+                self._smtp_pool = None
+
+            if self._http_session is not None:
+                self._http_session.close()
+                self._http_session = None
+
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_context():
+    """
+    Returns the ServiceContext shared by the whole run, creating it on first use.
+    """
+    global _context
+
+    with _context_lock:
+        if _context is None:
+            _context = ServiceContext()
+        return _context
+
+
+def set_context(context):
+    """
+    Replaces the shared ServiceContext, for example with one built from local stand-ins. Returns the previous context.
+    """
+    global _context
+
+    with _context_lock:
+        previous, _context = _context, context
+        return previous
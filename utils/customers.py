@@ -2,10 +2,9 @@ from dataclasses import dataclass
 import json
 from typing import List, Tuple
 from .config import customer_file
-from google.cloud import storage
+from utils.blob_cache import read_blob
 from logger import setup_logging
 
-
 logger = setup_logging(__name__)
 
 
@@ -14,6 +13,8 @@ class Customer:
     name: str
     email: str
     products: Tuple[str, ...]
+    # Machines that sell the customer's products, if listed in the customer file. Lets the pipeline send the customer's email as soon as those machines are fetched.
+    machines: Tuple[str, ...] = ()
 
 
 def load_customers(bucket, customer_file=customer_file):
@@ -27,12 +28,11 @@ def load_customers(bucket, customer_file=customer_file):
         An object containing the loaded JSON data.
     """
 
-    blob = bucket.blob(customer_file)
     logger.info(f"Reading customers from: {customer_file}")
 
     try:
-        # download_as_bytes() returns the content, which we decode to a string
-        customer_string = blob.download_as_bytes().decode("utf-8")
+        # read_blob() returns the content from the local cache or GCS, which we decode to a string
+        customer_string = read_blob(bucket, customer_file).decode("utf-8")
 
         # 3. Load and return the JSON data
         customer_data = json.loads(customer_string)
@@ -61,7 +61,13 @@ def create_customer_list(customer_data):
         return []
 
     customers = [
-        Customer(c["name"], c["email"], tuple(c["products"])) for c in customer_data
+        Customer(
+            c["name"],
+            c["email"],
+            tuple(c["products"]),
+            tuple(str(machine_id) for machine_id in c.get("machines", ())),
+        )
+        for c in customer_data
     ]
 
     return customers
@@ -0,0 +1,292 @@
+import hashlib
+import json
+import math
+from datetime import datetime, timedelta
+from .config import get_config, transaction_history_file
+from utils.blob_cache import is_not_found
+from utils.time import format_gmt
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+# lastSales responses overlap between runs, and a retried or repeated fetch returns the same sales again. Every sale is checked against an exact set of the sales already seen in the run, and then against a Bloom filter of the sales processed on the last dedup_days days. The Bloom filter has a fixed size whatever the number of sales, so memory stays flat and a lookup is a fixed number of bit reads.
+
+
+def transaction_key(sale):
+    """
+    Returns a 64 bit key for the sale. TransactionID is unique per machine sale in Nayax, and the product name is included so the products of a multivend sale are never mistaken for each other. Sales without a TransactionID are keyed by their machine, time, product and quantity.
+    """
+
+    if sale.transaction_id is not None:
+        text = f"{sale.transaction_id}|{sale.product_name}"
+    else:
+        text = f"{sale.machine_id}|{format_gmt(sale.authorized_at)}|{sale.product_name}|{sale.quantity}"
+    return int.from_bytes(
+        hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def bloom_size(capacity, error_rate):
+    """
+    Returns the (bits, hashes) of a Bloom filter holding capacity keys with the given false positive rate.
+    """
+
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    # Whole bytes, so the filter can be stored as they are.
+    bits = max(8, (bits + 7) // 8 * 8)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class BloomFilter:
+    """
+    A fixed size set of 64 bit keys that can answer "maybe seen" for a key that was never added, at the rate it was sized for, but never "not seen" for one that was. Keys are checked and added in batches with NumPy.
+    """
+
+    def __init__(self, bits, hashes, data=None):
+        # Imported on first use so runs that don't deduplicate don't load NumPy.
+        import numpy as np
+
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            self.array = np.zeros(bits // 8, dtype=np.uint8)
+        else:
+            self.array = np.frombuffer(bytearray(data), dtype=np.uint8)
+
+    def _positions(self, keys):
+        import numpy as np
+
+        keys = np.asarray(keys, dtype=np.uint64)
+        # Double hashing: the i-th position is h1 + i * h2, from the two halves of the key.
+        first = keys & np.uint64(0xFFFFFFFF)
+        second = (keys >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (first[:, None] + steps[None, :] * second[:, None]) % np.uint64(
+            self.bits
+        )
+
+    def add_many(self, keys):
+        import numpy as np
+
+        if not len(keys):
+            return
+        positions = self._positions(keys).ravel()
+        np.bitwise_or.at(
+            self.array,
+            (positions >> np.uint64(3)).astype(np.intp),
+            (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)),
+        )
+
+    def _contains_positions(self, positions):
+        import numpy as np
+
+        bytes_ = self.array[(positions >> np.uint64(3)).astype(np.intp)]
+        bits_set = (bytes_ >> (positions & np.uint64(7)).astype(np.uint8)) & np.uint8(1)
+        return bits_set.all(axis=1)
+
+    def contains_many(self, keys):
+        """
+        Returns a list of booleans, True for the keys that were probably added.
+        """
+        if not len(keys):
+            return []
+        return self._contains_positions(self._positions(keys)).tolist()
+
+    def to_bytes(self):
+        return self.array.tobytes()
+
+
+def _sales_day(sales_date):
+    return datetime.strptime(sales_date, "%m-%d-%Y").date()
+
+
+class TransactionHistory:
+    """
+    The sales processed on the last days days, as one BloomFilter per sales date. Adding sales for a new date drops the filters of dates days or more before it, so there are never more than days filters.
+    """
+
+    def __init__(self, days, capacity, error_rate):
+        self.days = days
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits, self.hashes = bloom_size(capacity, error_rate)
+        self.filters = {}
+
+    def contains_many(self, keys):
+        """
+        Returns a list of booleans, True for the keys that were probably processed on one of the days.
+        """
+        if not self.filters or not len(keys):
+            return [False] * len(keys)
+
+        # Every filter has the same size, so the bit positions are computed once for all of them.
+        blooms = list(self.filters.values())
+        positions = blooms[0]._positions(keys)
+        found = blooms[0]._contains_positions(positions)
+        for bloom in blooms[1:]:
+            found |= bloom._contains_positions(positions)
+        return found.tolist()
+
+    def add_many(self, sales_date, keys):
+        if sales_date not in self.filters:
+            self.filters[sales_date] = BloomFilter(self.bits, self.hashes)
+            self.rotate(sales_date)
+        self.filters[sales_date].add_many(keys)
+
+    def rotate(self, sales_date):
+        oldest = _sales_day(sales_date) - timedelta(days=self.days)
+        for old_date in [
+            old_date for old_date in self.filters if _sales_day(old_date) <= oldest
+        ]:
+            del self.filters[old_date]
+
+    def to_bytes(self):
+        header = {
+            "bits": self.bits,
+            "hashes": self.hashes,
+            "dates": list(self.filters),
+        }
+        return b"".join(
+            [json.dumps(header).encode("utf-8"), b"\n"]
+            + [bloom.to_bytes() for bloom in self.filters.values()]
+        )
+
+    def load_bytes(self, data):
+        """
+        Loads the filters saved by to_bytes(). Filters saved with a different size are dropped, for example after dedup_capacity changed.
+
+        Raises ValueError if the data is not a complete saved history.
+        """
+
+        header_line, newline, body = data.partition(b"\n")
+        try:
+            header = json.loads(header_line.decode("utf-8"))
+            bits, hashes, dates = header["bits"], header["hashes"], header["dates"]
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError(f"Transaction history header is unreadable: {e}") from e
+        if not newline or not isinstance(dates, list):
+            raise ValueError("Transaction history header is incomplete")
+
+        if bits != self.bits or hashes != self.hashes:
+            logger.warning(
+                "Transaction history was saved with a different size- starting a new one"
+            )
+            return self
+
+        size = self.bits // 8
+        if len(body) != size * len(dates):
+            raise ValueError(
+                f"Transaction history has {len(body)} bytes of filters, expected {size * len(dates)} for {len(dates)} days"
+            )
+        for index, sales_date in enumerate(header["dates"]):
+            self.filters[sales_date] = BloomFilter(
+                self.bits, self.hashes, body[index * size : (index + 1) * size]
+            )
+        return self
+
+
+class TransactionFilter:
+    """
+    Drops sales that were already seen: in this run, by an exact set of their keys, or on an earlier day, by an optional TransactionHistory. Keep one per run and pass every batch of sales through new_sales().
+    """
+
+    def __init__(self, history=None):
+        self.history = history
+        self.seen = set()
+        self.kept_keys = []
+        self.duplicates = 0
+        self.already_processed = 0
+
+    def new_sales(self, sales):
+        """
+        Returns the sales that were not seen before, in the same order.
+        """
+
+        kept = []
+        keys = []
+        for sale in sales:
+            key = transaction_key(sale)
+            if key in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add(key)
+            kept.append(sale)
+            keys.append(key)
+
+        if self.history is not None and keys:
+            processed = self.history.contains_many(keys)
+            if any(processed):
+                self.already_processed += sum(processed)
+                kept = [sale for sale, seen in zip(kept, processed) if not seen]
+                keys = [key for key, seen in zip(keys, processed) if not seen]
+
+        self.kept_keys.extend(keys)
+        return kept
+
+    def discard(self, sales):
+        """
+        Takes sales kept so far back out, so commit() doesn't add them to the history. For sales whose notifications did not go out.
+        """
+        if not sales:
+            return
+        keys = {transaction_key(sale) for sale in sales}
+        self.kept_keys = [key for key in self.kept_keys if key not in keys]
+
+    def commit(self, sales_date):
+        """
+        Adds the sales kept so far to the history as processed on sales_date. Call it once the notifications for them went out.
+        """
+        if self.history is not None:
+            self.history.add_many(sales_date, self.kept_keys)
+        self.kept_keys = []
+
+
+def load_transaction_history(bucket, history_file=transaction_history_file):
+    """
+    Reads the TransactionHistory from the bucket, sized by dedup_days, dedup_capacity and dedup_error_rate in the config.
+
+    Returns:
+    A TransactionHistory, or None if dedup_days is 0 or the file exists but can't be read. Empty if the file does not exist yet. A history that couldn't be read is never saved over, so the run only deduplicates its own sales.
+    """
+
+    config = get_config()
+    if not config.dedup_days:
+        return None
+
+    history = TransactionHistory(
+        config.dedup_days, config.dedup_capacity, config.dedup_error_rate
+    )
+    try:
+        data = bucket.blob(history_file).download_as_bytes()
+        return history.load_bytes(data)
+    except Exception as e:
+        if is_not_found(e):
+            # The file won't exist on the first run.
+            logger.info(f"No transaction history read from {history_file}: {e}")
+            return history
+        logger.error(
+            f"Error reading {history_file}- not deduplicating against earlier runs or saving the history this run: {e}"
+        )
+        return None
+
+
+def save_transaction_history(bucket, history, history_file=transaction_history_file):
+    """
+    Uploads the TransactionHistory to the bucket for the next run.
+    """
+
+    if history is None:
+        return 0
+
+    data = history.to_bytes()
+    try:
+        bucket.blob(history_file).upload_from_string(
+            data, content_type="application/octet-stream"
+        )
+        logger.info(
+            f"Saved transaction history for {len(history.filters)} days ({len(data)} bytes)"
+        )
+    except Exception as e:
+        logger.error(f"Error writing {history_file} to GCS: {e}")
+    return len(data)
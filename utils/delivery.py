@@ -0,0 +1,297 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from .config import get_config
+from utils.spans import span
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+@lru_cache(maxsize=None)
+def connection_errors():
+    """
+    Errors that mean the connection itself is gone, so the send is retried on a fresh connection. smtplib is only imported once a connection is in use.
+    """
+    import smtplib
+
+    return (
+        smtplib.SMTPServerDisconnected,
+        smtplib.SMTPConnectError,
+        ConnectionError,
+        TimeoutError,
+    )
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Tokens refill at rate per second up to capacity, and acquire() blocks until one is available.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            self._sleep(wait)
+
+
+class SMTPPool:
+    """
+    A pool of up to size authenticated SMTP connections. Connections are opened with factory on first use and each one is only used by one thread at a time.
+    """
+
+    def __init__(self, factory, size=None):
+        self.size = max(1, get_config().smtp_pool_size if size is None else size)
+        self._factory = factory
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._all = []
+
+    def _checkout(self):
+        server = None
+
+        while server is None:
+            try:
+                server = self._idle.get_nowait()
+                continue
+            except queue.Empty:
+                pass
+
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+
+            if can_open:
+                return self._open()
+
+            # Wait for a connection to be returned. None means one was discarded and a replacement can be opened.
+            server = self._idle.get()
+
+        return server
+
+    def _open(self):
+        try:
+            server = self._factory()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            self._idle.put(None)
+            raise
+
+        with self._lock:
+            self._all.append(server)
+        return server
+
+    def _discard(self, server):
+        with self._lock:
+            self._opened -= 1
+            if server in self._all:
+                self._all.remove(server)
+        try:
+            server.close()
+        except Exception:
+            pass
+
+        # Wake up a thread waiting for a connection so it can open a replacement.
+        self._idle.put(None)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the with block. A connection that raised one of connection_errors() is closed instead of being returned to the pool. Any other error, such as a refused recipient, leaves the connection usable.
+        """
+        server = self._checkout()
+        try:
+            yield server
+        except connection_errors():
+            self._discard(server)
+            raise
+        except BaseException:
+            self._idle.put(server)
+            raise
+        else:
+            self._idle.put(server)
+
+    def close(self):
+        with self._lock:
+            servers, self._all = self._all, []
+            self._opened = 0
+
+        for server in servers:
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+        self._idle = queue.LifoQueue()
+
+
+def send_message(pool, limiter, message, attempts=2):
+    """
+    Sends one Email over a pooled connection once the rate limiter allows it. If the connection died partway through a batch, the message is retried on a new connection.
+
+    Returns:
+    None if the message was sent, or the exception from the last attempt.
+    """
+
+    for attempt in range(1, attempts + 1):
+        limiter.acquire()
+        try:
+            with pool.connection() as server:
+                server.send_message(message.message)
+            return None
+
+        except connection_errors() as e:
+            logger.warning(
+                "SMTP connection lost (attempt %d of %d): %s", attempt, attempts, e
+            )
+            error = e
+
+        except Exception as e:
+            return e
+
+    return error
+
+
+def deliver(messages, pool, limiter, max_workers=None):
+    """
+    Sends every message in parallel over the pooled SMTP connections, behind the shared rate limiter.
+
+    Args:
+    messages (list): A list of Email objects \n
+    pool (SMTPPool) \n
+    limiter (TokenBucket) \n
+    max_workers (int): Number of sending threads. Defaults to the pool size.
+
+    Returns:
+    A list of (Email, error) tuples in the same order as messages. error is None for messages that were sent.
+    """
+
+    if not messages:
+        return []
+
+    workers = max(1, min(max_workers or pool.size, len(messages)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = list(
+            executor.map(lambda message: send_message(pool, limiter, message), messages)
+        )
+
+    return list(zip(messages, errors))
+
+
+def deliver_with_retries(
+    messages,
+    pool,
+    limiter,
+    retries=None,
+    backoff=None,
+    sleep=time.sleep,
+):
+    """
+    Sends every message with deliver(), then retries the ones that failed up to retries more times, waiting backoff seconds before the first retry and doubling the wait each time.
+
+    Returns:
+    A list of (Email, error) tuples in the same order as messages. error is None for messages that were sent and the last error for the ones that never were.
+    """
+
+    retries, backoff = _retry_settings(retries, backoff)
+
+    with span("smtp.deliver") as deliver_span:
+        deliver_span.add(items=len(messages))
+        results = deliver(messages, pool, limiter)
+
+        for retry in range(retries):
+            failed = [index for index, (_, error) in enumerate(results) if error]
+            if not failed:
+                break
+
+            wait = backoff * 2**retry
+            logger.warning(
+                f"Retrying {len(failed)} failed notifications in {wait} seconds (retry {retry + 1} of {retries})"
+            )
+            sleep(wait)
+
+            retried = deliver([results[index][0] for index in failed], pool, limiter)
+            for index, result in zip(failed, retried):
+                results[index] = result
+
+        deliver_span.set(failed=sum(1 for _, error in results if error))
+
+    return results
+
+
+def send_with_retries(
+    pool,
+    limiter,
+    message,
+    retries=None,
+    backoff=None,
+    sleep=time.sleep,
+):
+    """
+    Sends one message with send_message(), retrying up to retries more times with the same doubling backoff as deliver_with_retries(). Used when messages are sent one at a time as they are built, rather than as a batch.
+
+    Returns:
+    None if the message was sent, or the error from the last attempt.
+    """
+
+    retries, backoff = _retry_settings(retries, backoff)
+    error = send_message(pool, limiter, message)
+
+    for retry in range(retries):
+        if error is None:
+            break
+
+        sleep(backoff * 2**retry)
+        error = send_message(pool, limiter, message)
+
+    return error
+
+
+def _retry_settings(retries, backoff):
+    # Fills in send_retries and send_retry_backoff from the config.
+    config = get_config()
+    return (
+        config.send_retries if retries is None else retries,
+        config.send_retry_backoff if backoff is None else backoff,
+    )
+
+
+def create_rate_limiter(rate=None, burst=None):
+    """
+    Returns a TokenBucket with the sending rate from the config.
+    """
+    config = get_config()
+    return TokenBucket(
+        config.smtp_rate_per_second if rate is None else rate,
+        config.smtp_burst if burst is None else burst,
+    )
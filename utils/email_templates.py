@@ -0,0 +1,179 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from jinja2 import Environment
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+
+# The static HTML head with the email styles. It has no per-customer values, so it is added to every email as-is instead of being rebuilt.
+EMAIL_HEAD = """
+      <html>
+        <head>
+          <style>
+            body {
+              font-family: Arial, sans-serif;
+              line-height: 1.6;
+              color: #333;
+            }
+            h2 {
+              color: #2c3e50;
+            }
+              table {
+                  border-collapse: collapse;
+                  width: auto;
+                  margin: 20px 0;
+              }
+              th {
+                  background-color: #3498db;
+                  color: white;
+                  padding: 12px 20px;
+                  text-align: left;
+                  font-weight: bold;
+                  white-space: nowrap;
+              }
+              td {
+                  padding: 10px 20px;
+                  border-bottom: 1px solid #ddd;
+              }
+              tr:hover {
+                  background-color: #f5f5f5;
+              }
+              .total-row {
+                  font-weight: bold;
+                  background-color: #ecf0f1;
+                  font-size: 1.1em;
+              }
+              .total-row td {
+                  padding: 15px 20px;
+              }
+              td:nth-child(2), td:nth-child(3) {
+                  text-align: center;
+              }
+              th:nth-child(2), th:nth-child(3) {
+                  text-align: center;
+            }
+          </style>
+        </head>
+"""
+
+HTML_BODY_SOURCE = """        <body>
+          <h2>Daily Sales Report</h2>
+          <p>{{ greeting }}</p>
+          <p>{{ header }}</p>
+          
+          <table>
+            <thead>
+              <tr>
+                <th>Product Name</th>
+                <th>Quantity Sold</th>
+                <th>Revenue</th>
+              </tr>
+            </thead>
+            <tbody>
+{%- for product, quantity_sold, revenue in line_items %}
+            <tr>
+              <td>{{ product }}</td>
+              <td>{{ quantity_sold }}</td>
+              <td>${{ revenue }}</td>
+            </tr>
+{%- endfor %}
+              <tr class="total-row">
+                <td colspan="2">Total Revenue</td>
+                <td>${{ total_revenue }}</td>
+              </tr>
+            </tbody>
+          </table>
+          
+          <p>{{ sign_off }}<br>{{ signature }}</p>
+        </body>
+      </html>
+"""
+
+TEXT_BODY_SOURCE = (
+    "{{ greeting }}{{ header }}"
+    "{% for product, quantity_sold, revenue in line_items %}"
+    "{{ product }} (Qty: {{ quantity_sold }}) - ${{ revenue }}\n"
+    "{% endfor %}"
+    "{{ total_revenue_msg }} {{ total_revenue }}\n\n"
+    "{{ sign_off }}\n"
+    "{{ signature }}"
+)
+
+# HTML values are escaped, the plain text body is not.
+_html_env = Environment(autoescape=True, keep_trailing_newline=True)
+_text_env = Environment(autoescape=False, keep_trailing_newline=True)
+
+
+@dataclass(frozen=True)
+class EmailTemplates:
+    """
+    The email template from email-template.json with its HTML and plain text bodies compiled to Jinja2 templates.
+    """
+
+    subject: str
+    greeting: str
+    header: str
+    sign_off: str
+    signature: str
+    total_revenue_msg: str
+    html_body: object
+    text_body: object
+
+    def render(self, customer_name, date, line_items, total_revenue):
+        """
+        Renders one customer's email.
+
+        Args:
+        customer_name (str) \n
+        date (str): The date the sales are from. \n
+        line_items (list): [(product_name, quantity_sold, revenue), ...] with revenue already formatted as dollars. \n
+        total_revenue (str): The customer's total, formatted as dollars.
+
+        Returns:
+        A tuple of (subject, plain text body, html body)
+        """
+
+        values = {
+            "greeting": self.greeting.format(customer_name=customer_name) + "\n\n",
+            "header": self.header.format(date=date) + "\n\n",
+            "sign_off": self.sign_off,
+            "signature": self.signature,
+            "total_revenue_msg": self.total_revenue_msg,
+            "line_items": line_items,
+            "total_revenue": total_revenue,
+        }
+
+        subject = self.subject.format(customer_name=customer_name, date=date)
+        html_body = EMAIL_HEAD + self.html_body.render(values)
+        return subject, self.text_body.render(values), html_body
+
+
+@lru_cache(maxsize=8)
+def _compile_email_templates(template_items):
+    et = dict(template_items)
+    logger.info("Compiling email templates")
+
+    return EmailTemplates(
+        subject=et["subject"],
+        greeting=et["greeting"],
+        header=et["header"],
+        sign_off=et["sign_off"] + "\n",
+        signature=et["signature"],
+        total_revenue_msg=et["total_revenue"],
+        html_body=_html_env.from_string(HTML_BODY_SOURCE),
+        text_body=_text_env.from_string(TEXT_BODY_SOURCE),
+    )
+
+
+def compile_email_templates(et):
+    """
+    Compiles the email template loaded from email-template.json. The result is cached, so the templates are only compiled once per run no matter how many customers there are.
+
+    Args:
+    et (dict): The email template from load_email_template().
+
+    Returns:
+    An EmailTemplates object
+    """
+    return _compile_email_templates(tuple(sorted(et.items())))
@@ -0,0 +1,87 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+
+# One line of `python -X importtime` output: "import time:       self [us] |  cumulative | imported package"
+_IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+@dataclass(frozen=True)
+class ImportTime:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse_importtime(output):
+    """
+    Parses the stderr of `python -X importtime` into ImportTime records, in the order the imports finished.
+    """
+
+    records = []
+    for line in output.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            records.append(
+                ImportTime(module, int(self_us), int(cumulative_us), len(indent) // 2)
+            )
+    return records
+
+
+def measure_imports(module="main", python=sys.executable):
+    """
+    Imports module in a fresh interpreter with -X importtime and returns the ImportTime records. The current environment is passed through, so the settings the module reads at import time are the same as in a real run.
+    """
+
+    completed = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+
+    return parse_importtime(completed.stderr)
+
+
+def format_report(records, module="main", top=20):
+    """
+    Formats the slowest imports: the total for module, then the top modules by cumulative time (the module and everything it imported) and by self time.
+    """
+
+    root = next((r for r in records if r.module == module), None)
+    lines = []
+
+    if root is not None:
+        lines.append(f"Importing {module} took {root.cumulative_us / 1000:.1f} ms")
+
+    for title, key in (("cumulative", "cumulative_us"), ("self", "self_us")):
+        lines.append("")
+        lines.append(f"Slowest {top} modules by {title} time:")
+        slowest = sorted(records, key=lambda r: getattr(r, key), reverse=True)
+        for record in slowest[:top]:
+            lines.append(f"{getattr(record, key) / 1000:10.1f} ms  {record.module}")
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Lists the slowest modules to import, from python -X importtime."
+    )
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    print(format_report(measure_imports(args.module), args.module, args.top))
+
+
+if __name__ == "__main__":
+    # python -m utils.import_report [module] [--top N]
+    main()
@@ -0,0 +1,276 @@
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from .config import get_config, intraday_state_file
+from utils.checkpoints import is_checkpointed, update_checkpoint
+from utils.dedup import TransactionFilter
+from utils.products import format_cents
+from utils.sales import fetch_all_daily_sales, serialize_sale, deserialize_sale
+from utils.spans import span
+from utils.time import get_day_window
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+# The poller polls every machine's lastSales every poll_interval seconds and folds the sales that are new since the last poll into a DayAccumulator for the day. Once the day has been over for poll_grace_period and a poll after that has picked up its late sales, the accumulator is complete, and the daily run sends the notifications from it instead of downloading and scanning every machine again.
+
+
+@dataclass
+class DayAccumulator:
+    """
+    A day's sales, folded in as the poller finds them.
+
+    sales_by_machine: {machine_id: list of Sale, newest first} \n
+    cursors: {machine_id: checkpoint} of the newest sale folded in for each machine, in the format of update_checkpoint(). A poll only reads up to it. \n
+    complete: True once the day has been over for poll_grace_period and a poll of every machine after that succeeded.
+    """
+
+    sales_date: str
+    sales_by_machine: dict = field(default_factory=dict)
+    cursors: dict = field(default_factory=dict)
+    complete: bool = False
+    _dedup: TransactionFilter = field(
+        default_factory=TransactionFilter, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        # Sales loaded from the saved state count as seen, so an overlapping poll doesn't add them again.
+        for sales in self.sales_by_machine.values():
+            self._dedup.new_sales(sales)
+
+    def fold(self, machine_id, new_sales):
+        """
+        Adds sales newer than everything already folded in for the machine.
+
+        Returns:
+        The number of sales added
+        """
+
+        machine_sales = self.sales_by_machine.setdefault(machine_id, [])
+        update_checkpoint(self.cursors, machine_id, new_sales, self.sales_date)
+        new_sales = self._dedup.new_sales(new_sales)
+        if not new_sales:
+            return 0
+
+        # New sales are all newer than the ones already here, so the list stays newest first.
+        machine_sales[:0] = new_sales
+        return len(new_sales)
+
+    def covers(self, machine_ids):
+        return all(machine_id in self.sales_by_machine for machine_id in machine_ids)
+
+    def sales_source(self, machine_id, checkpoint=None):
+        """
+        Returns a machine's sales for the day, in place of fetching them, for run_pipeline(sales_source=). Sales up to the checkpoint were already sent and are left out.
+        """
+        if machine_id not in self.sales_by_machine:
+            raise LookupError(f"The poller has no sales for {machine_id}")
+        return [
+            sale
+            for sale in self.sales_by_machine[machine_id]
+            if not is_checkpointed(sale, checkpoint)
+        ]
+
+    def summary(self):
+        # The customer and product totals are computed from the sales by the daily run- this is only for the poller's log.
+        sales = [sale for sales in self.sales_by_machine.values() for sale in sales]
+        return {
+            "sales_date": self.sales_date,
+            "sales": len(sales),
+            "machines": len(self.sales_by_machine),
+            "settlement_cents": sum(sale.settlement_cents for sale in sales),
+        }
+
+    def to_dict(self):
+        return {
+            "sales_date": self.sales_date,
+            "complete": self.complete,
+            "cursors": self.cursors,
+            "sales": {
+                machine_id: [serialize_sale(sale) for sale in sales]
+                for machine_id, sales in self.sales_by_machine.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["sales_date"],
+            {
+                machine_id: [deserialize_sale(sale) for sale in sales]
+                for machine_id, sales in data["sales"].items()
+            },
+            data["cursors"],
+            data["complete"],
+        )
+
+
+def load_intraday_state(bucket, state_file=intraday_state_file):
+    """
+    Reads the poller's accumulators from the bucket.
+
+    Returns:
+    A dictionary in the format {sales_date: DayAccumulator}. Empty if the poller has never run.
+    """
+
+    try:
+        data = json.loads(bucket.blob(state_file).download_as_bytes().decode("utf-8"))
+    except Exception as e:
+        # The file won't exist unless the poller is running.
+        logger.info(f"No intraday sales read from {state_file}: {e}")
+        return {}
+
+    return {day["sales_date"]: DayAccumulator.from_dict(day) for day in data["days"]}
+
+
+def save_intraday_state(bucket, days, state_file=intraday_state_file):
+    """
+    Uploads the poller's accumulators to the bucket, so a restarted poller carries on from them and the daily run can send from them.
+    """
+
+    data = json.dumps(
+        {"days": [day.to_dict() for day in days.values()]}, separators=(",", ":")
+    )
+    try:
+        bucket.blob(state_file).upload_from_string(
+            data, content_type="application/json"
+        )
+        logger.info(f"Saved intraday sales for {', '.join(days)}")
+    except Exception as e:
+        logger.error(f"Error writing {state_file} to GCS: {e}")
+    return len(data)
+
+
+def load_completed_day(bucket, sales_date, machine_ids):
+    """
+    Returns the poller's DayAccumulator for sales_date if it is complete and has every machine, otherwise None and the day has to be fetched.
+    """
+
+    day = load_intraday_state(bucket).get(sales_date)
+    if day is None:
+        return None
+    if not day.complete or not day.covers(machine_ids):
+        logger.warning(
+            f"Intraday sales for {sales_date} are incomplete- fetching every machine instead"
+        )
+        return None
+    return day
+
+
+def poll_day(day, machine_ids, window, bucket):
+    """
+    Fetches each machine's sales since its cursor and folds them into day.
+
+    Returns:
+    A tuple of (sales added, list of machines that could not be fetched)
+    """
+
+    with span(
+        "poll", sales_date=day.sales_date, machines=len(machine_ids)
+    ) as poll_span:
+        fetched = fetch_all_daily_sales(machine_ids, day.cursors, bucket, window)
+        added = sum(
+            day.fold(machine_id, sales) for machine_id, sales in fetched.items()
+        )
+        failed = [machine_id for machine_id in machine_ids if machine_id not in fetched]
+        poll_span.add(items=added).set(failed=len(failed))
+
+    return added, failed
+
+
+def run_poller(
+    bucket,
+    machine_ids=None,
+    interval=None,
+    save_interval=None,
+    duration=None,
+    grace_period=None,
+):
+    """
+    Polls every machine until stopped or for duration seconds, folding the new sales into today's DayAccumulator and saving the accumulators every save_interval seconds and on the way out.
+
+    After midnight yesterday keeps being polled for its late sales, and is marked complete by the first poll of every machine once grace_period has passed. Only today and yesterday are kept.
+
+    Args:
+    bucket (GCS bucket): The config bucket. \n
+    machine_ids (list): Defaults to machine_ids from the config. \n
+    interval, save_interval, duration, grace_period (float): Default to poll_interval, poll_save_interval, poll_duration and poll_grace_period from the config.
+
+    Returns:
+    A dictionary of the number of polls and sales added
+    """
+
+    config = get_config()
+    machine_ids = machine_ids or config.machine_ids
+    interval = config.poll_interval if interval is None else interval
+    save_interval = (
+        config.poll_save_interval if save_interval is None else save_interval
+    )
+    duration = config.poll_duration if duration is None else duration
+    grace_period = timedelta(
+        seconds=config.poll_grace_period if grace_period is None else grace_period
+    )
+
+    days = load_intraday_state(bucket)
+    stats = {"polls": 0, "sales": 0}
+    started = last_save = time.monotonic()
+
+    try:
+        while True:
+            today_window = get_day_window(days_ago=0)
+            yesterday_window = get_day_window(days_ago=1)
+
+            yesterday = days.get(yesterday_window.label)
+            if yesterday is not None and not yesterday.complete:
+                # Checked before polling, so the poll that completes the day started after the grace period.
+                settled = (
+                    datetime.now(timezone.utc) >= yesterday_window.end + grace_period
+                )
+                added, failed = poll_day(
+                    yesterday, machine_ids, yesterday_window, bucket
+                )
+                stats["sales"] += added
+                # Nayax reports some sales late- until the grace period is over, and on the next poll if a machine failed, the day keeps being polled.
+                yesterday.complete = settled and not failed
+                if yesterday.complete:
+                    logger.info(
+                        f"Intraday sales for {yesterday.sales_date} are complete: {yesterday.summary()}"
+                    )
+
+            for sales_date in [
+                sales_date
+                for sales_date in days
+                if sales_date not in (today_window.label, yesterday_window.label)
+            ]:
+                del days[sales_date]
+
+            today = days.setdefault(
+                today_window.label, DayAccumulator(today_window.label)
+            )
+            added, _ = poll_day(today, machine_ids, today_window, bucket)
+            stats["polls"] += 1
+            stats["sales"] += added
+
+            summary = today.summary()
+            logger.info(
+                "Today so far: %s sales on %s machines, $%s settled",
+                summary["sales"],
+                summary["machines"],
+                format_cents(summary["settlement_cents"]),
+            )
+
+            if time.monotonic() - last_save >= save_interval:
+                with span("poll.save", days=len(days)) as save_span:
+                    save_span.add(bytes=save_intraday_state(bucket, days))
+                last_save = time.monotonic()
+
+            if duration and time.monotonic() - started + interval >= duration:
+                break
+            time.sleep(interval)
+    finally:
+        # Also runs when SIGTERM stops the job, so the next poller and the daily run start from the latest sales.
+        with span("poll.save", days=len(days)) as save_span:
+            save_span.add(bytes=save_intraday_state(bucket, days))
+
+    return stats
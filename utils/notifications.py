@@ -1,15 +1,26 @@
 from datetime import date, timedelta
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from .config import sender_email, sender_pw, notification_address, email_template
+from .config import get_config
 from dataclasses import dataclass
 from utils.customers import Customer
 from logger import setup_logging
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from .config import machine_tz
+from utils.blob_cache import read_blob
 from utils.time import get_yesterdays_date
+from utils.aggregate import aggregate_sales
+from utils.products import format_cents
+from utils.context import get_context
+from utils.delivery import deliver_with_retries
+from utils.retry_queue import (
+    load_retry_queue,
+    save_retry_queue,
+    add_dead_letters,
+    serialize_email,
+    deserialize_email,
+)
 import json
 
 logger = setup_logging(__name__)
@@ -21,7 +32,8 @@ class Email:
     customer: Customer
     customer_sales: list
     yesterdays_date: str
-    total_revenue: float
+    total_revenue_cents: int
+    attempts: int = 0
 
 
 def load_email_template(bucket, email_template):
@@ -34,12 +46,11 @@ def load_email_template(bucket, email_template):
 
     """
 
-    blob = bucket.blob(email_template)
     logger.info(f"Reading email_template from: {email_template}")
 
     try:
-        # download_as_bytes() returns the content, which we decode to a string
-        email_template_string = blob.download_as_bytes().decode("utf-8")
+        # read_blob() returns the content from the local cache or GCS, which we decode to a string
+        email_template_string = read_blob(bucket, email_template).decode("utf-8")
 
         # 3. Load and return the JSON data
         data = json.loads(email_template_string)
@@ -70,282 +81,235 @@ def create_email_msg(sender_email, recipients, subject, body, html_body):
     return message
 
 
-def create_email_obj(message, customer_sales, yesterdays_date, total_revenue, customer):
+def create_email_obj(
+    message, customer_sales, yesterdays_date, total_revenue_cents, customer
+):
     email_obj = Email(
         message,
         customer,
         customer_sales,
         yesterdays_date,
-        total_revenue,
+        total_revenue_cents,
     )
     return email_obj
 
 
-def create_notifications(bucket, customer_sales_dict: dict):
+def create_notifications(
+    customer_sales_dict: dict,
+    product_costs: dict,
+    email_template_data: dict,
+    spool=None,
+    yesterdays_date=None,
+):
     """
     Takes a dictionary of customers: Sends a notification to each customer containing their sales as well as the value of those sales.
 
-    Args: customer_sales_dict (dict)
+    Args: customer_sales_dict (dict) - dictionary of {Customer: [Sale, ...]} from group_sales_by_customer() \n
+          product_costs (dict) - dictionary of {"product name": price in cents} from load_product_costs() \n
+          email_template_data (dict) - the email template loaded at startup by load_email_template() \n
+          spool (SheetSpool) - optional. The receipt and transaction rows are spooled for Google Sheets as soon as they are built. \n
+          yesterdays_date (str) - optional. DayWindow.label of the day the sales are from. Defaults to yesterday.
 
     Returns:
-    A list of sales:
-    list(sales_map.values()), notification_rows, sales_list, successfully_sent, failed_sends)
+    messages (list): A list of Email objects, one per customer \n
+    itemized_receipt_rows (list): One row per customer and product: [yesterdays_date, customer.name, customer.email, product_name, quantity_sold, revenue_cents] \n
+    sales_list (list): One row per sale: [transaction_dt, customer.name, customer.email, product_name, quantity_sold, revenue_cents]
 
     """
 
-    yesterdays_date = get_yesterdays_date()
+    yesterdays_date = yesterdays_date or get_yesterdays_date()
 
-    sales_list = []
-    sales_map = {}
     messages = []
 
-    et = load_email_template(bucket, email_template)
+    # Imported on first use so runs without sales don't load Jinja2.
+    from utils.email_templates import compile_email_templates
 
-    for customer, sales in customer_sales_dict.items():
-        # Email creation
+    templates = compile_email_templates(email_template_data)
 
-        subject = et["subject"].format(
-            customer_name=customer.name, date=yesterdays_date
-        )
-        greeting = et["greeting"].format(customer_name=customer.name) + "\n\n"
-        header = et["header"].format(date=yesterdays_date) + "\n\n"
-        body = greeting + header
-        sign_off = et["sign_off"] + "\n"
-        signature = et["signature"]
-        total_revenue_msg = et["total_revenue"]
-
-        recipients = [notification_address]
-        recipients.append(customer.email)
-
-        total_revenue = 0
-
-        # Create HTML body
-        html_body = f"""
-      <html>
-        <head>
-          <style>
-            body {{
-              font-family: Arial, sans-serif;
-              line-height: 1.6;
-              color: #333;
-            }}
-            h2 {{
-              color: #2c3e50;
-            }}
-              table {{
-                  border-collapse: collapse;
-                  width: auto;
-                  margin: 20px 0;
-              }}
-              th {{
-                  background-color: #3498db;
-                  color: white;
-                  padding: 12px 20px;
-                  text-align: left;
-                  font-weight: bold;
-                  white-space: nowrap;
-              }}
-              td {{
-                  padding: 10px 20px;
-                  border-bottom: 1px solid #ddd;
-              }}
-              tr:hover {{
-                  background-color: #f5f5f5;
-              }}
-              .total-row {{
-                  font-weight: bold;
-                  background-color: #ecf0f1;
-                  font-size: 1.1em;
-              }}
-              .total-row td {{
-                  padding: 15px 20px;
-              }}
-              td:nth-child(2), td:nth-child(3) {{
-                  text-align: center;
-              }}
-              th:nth-child(2), th:nth-child(3) {{
-                  text-align: center;
-            }}
-          </style>
-        </head>
-        <body>
-          <h2>Daily Sales Report</h2>
-          <p>{greeting}</p>
-          <p>{header}</p>
-          
-          <table>
-            <thead>
-              <tr>
-                <th>Product Name</th>
-                <th>Quantity Sold</th>
-                <th>Revenue</th>
-              </tr>
-            </thead>
-            <tbody>
-      """
-
-        # Initialize a dictionary to combine the sales of the same product to add to the email body (rather than listing the product multiple times)
-        combined_product_quantities = {}
-
-        for sale in sales:
-            product_name = sale["product_name"]
-            revenue = round(sale["revenue"], 2)
-            total_revenue += revenue
-            quantity_sold = sale["quantity_sold"]
-
-            sales_list.append(
-                [
-                    sale["transaction_dt"],
-                    customer.name,
-                    customer.email,
-                    product_name,
-                    quantity_sold,
-                    revenue,
-                ]
-            )
+    # Compute every customer and product total in one vectorized pass.
+    aggregate = aggregate_sales(customer_sales_dict, product_costs)
 
-            # Create a dictionary of products sold for every customer. Each customer gets one line per product. Update the product quantities dictionary which exists only within the loop for each customer to add the aggregated product sales to the email body.
-            if product_name in sales_map.keys():
-                new_quantity_sold = sales_map[product_name][4] + quantity_sold
-                combined_product_quantities[product_name][0] += quantity_sold
-                new_revenue = sales_map[product_name][5] + revenue
-                combined_product_quantities[product_name][1] += revenue
-                sales_map[product_name] = [
-                    yesterdays_date,
-                    customer.name,
-                    customer.email,
-                    product_name,
-                    new_quantity_sold,
-                    new_revenue,
-                ]
-            else:
-                sales_map[product_name] = [
-                    yesterdays_date,
-                    customer.name,
-                    customer.email,
-                    product_name,
-                    quantity_sold,
-                    revenue,
-                ]
-                combined_product_quantities[product_name] = [quantity_sold, revenue]
-
-        # Initialize a customer sales list to add the combined product quantities to.
-        customer_sales = []
-
-        # Go through the dictionary and add each product and the combined quanties to the html email body.
-        for product in combined_product_quantities:
-            customer_sales.append(
-                f"{product} ({combined_product_quantities[product][0]}x)"
-            )
+    # Start writing the rows to Sheets while the emails are rendered and sent.
+    if spool is not None:
+        spool.append(1, aggregate.receipt_rows)
+        spool.append(2, aggregate.transaction_rows)
 
-            html_body += f"""
-            <tr>
-              <td>{product}</td>
-              <td>{combined_product_quantities[product][0]}</td>
-              <td>${combined_product_quantities[product][1]:.2f}</td>
-            </tr>
-        """
-            body += f"{product} (Qty: {combined_product_quantities[product][0]}) - ${combined_product_quantities[product][1]}\n"
-
-        # Add total row
-        html_body += f"""
-              <tr class="total-row">
-                <td colspan="2">Total Revenue</td>
-                <td>${total_revenue:.2f}</td>
-              </tr>
-            </tbody>
-          </table>
-          
-          <p>{sign_off}<br>{signature}</p>
-        </body>
-      </html>
-      """
-
-        # Add to the plain text body
-        body += f"{total_revenue_msg} {total_revenue}\n\n"
-        body += f"{sign_off}\n"
-        body += signature
-
-        message = create_email_msg(sender_email, recipients, subject, body, html_body)
+    for customer, line_items in aggregate.line_items.items():
         messages.append(
-            create_email_obj(
-                message, customer_sales, yesterdays_date, total_revenue, customer
+            render_notification(
+                customer,
+                line_items,
+                aggregate.totals[customer],
+                templates,
+                yesterdays_date,
             )
         )
 
-    itemized_receipt_rows = list(sales_map.values())
-    return messages, itemized_receipt_rows, sales_list
+    return messages, aggregate.receipt_rows, aggregate.transaction_rows
+
 
+def render_notification(
+    customer, line_items, total_revenue_cents, templates, yesterdays_date
+):
+    """
+    Renders one customer's notification from their totals in a SalesAggregate.
+
+    Args: customer (Customer) \n
+          line_items (list) - the customer's [(product_name, quantity_sold, revenue_cents), ...] from SalesAggregate.line_items \n
+          total_revenue_cents (int) - the customer's total from SalesAggregate.totals \n
+          templates (EmailTemplates) - from compile_email_templates() \n
+          yesterdays_date (str) - the date the sales are from
 
-def send_notifications(messages: list):
+    Returns: An Email object
     """
-    Accepts a list of Email objects, connects to GOOGLE SMTP and sends an email containing each message to the customer.
+
+    config = get_config()
+    recipients = [config.notification_address, customer.email]
+
+    # One line per product with the combined quantities, for the notification sheet.
+    customer_sales = [
+        f"{product} ({quantity_sold}x)" for product, quantity_sold, _ in line_items
+    ]
+
+    subject, body, html_body = templates.render(
+        customer.name,
+        yesterdays_date,
+        [
+            (product, quantity_sold, format_cents(revenue_cents))
+            for product, quantity_sold, revenue_cents in line_items
+        ],
+        format_cents(total_revenue_cents),
+    )
+
+    message = create_email_msg(
+        config.sender_email, recipients, subject, body, html_body
+    )
+    return create_email_obj(
+        message,
+        customer_sales,
+        yesterdays_date,
+        total_revenue_cents,
+        customer,
+    )
+
+
+def send_notifications(messages: list, bucket=None, ignore_backoff=False, spool=None):
+    """
+    Accepts a list of Email objects and sends an email containing each message to the customer. Messages are sent in parallel over the run's pool of GOOGLE SMTP connections, behind a rate limiter.
+
+    Messages that failed in earlier runs are read from the retry queue and sent along with them. Messages that still fail after the in-run retries are written back to the queue for the next run, and ones that have failed send_max_attempts runs are moved to the dead letter file.
 
     Args:
     messages (list): A list of MIMEMultipart message objects \n
+    bucket (GCS bucket): Bucket holding the retry queue. Defaults to the shared context's bucket. \n
+    ignore_backoff (bool): Retry every queued message now, even ones that are still backing off. \n
+    spool (SheetSpool): optional. The notification rows are spooled for the Notification sheet.
 
     Returns:
 
-    itemized_receipt_rows(list): A list containing the sales for the customer- multiple sales for the same product are combined together so there is one line for each product. [yesterdays_date, customer.name, customer.email, product_name, quantity_sold, revenue] \n
     notification_rows (list): A list containing each notifcation and that status of whether or not it was successfully sent \n
     successfully_sent (int): The amount of messages that were succcessfully sent \n
     failed_sends (int): The amount of messages that failed to send.
     """
 
-    notification_rows = []
     successfully_sent = 0
     failed_sends = 0
 
-    try:
+    context = get_context()
+    bucket = bucket or context.bucket
+
+    queued_messages, waiting, notification_rows, queue_changed = (
+        load_queued_notifications(bucket, ignore_backoff)
+    )
+    failed_entries = []
 
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(sender_email, sender_pw)
-            logger.info("Connection success to GMAIL SMTP")
-
-            if not messages or not messages[0].customer:
-                return send_no_sales(server, messages[0], notification_rows)
-
-            # Loop through the list of messages and then send them all.
-            for message in messages:
-                try:
-                    server.send_message(message.message)
-                    logger.info(
-                        f"Email sent successfully to  {message.customer.name} at {message.customer.email} and {notification_address} "
-                    )
-                    successfully_sent += 1
-                    notification_status = "sent"
-                    notification_rows = add_notification_row(
-                        notification_rows, message, notification_status
-                    )
-
-                except Exception as e:
-                    logger.error(
-                        f"Failed to send email to {message.customer.name}: {str(e)}"
-                    )
-                    failed_sends += 1
-                    notification_status = "failed"
-                    notification_rows = add_notification_row(
-                        notification_rows, message, notification_status
-                    )
+    for message, error in deliver_with_retries(
+        queued_messages + list(messages), context.smtp_pool, context.rate_limiter
+    ):
+        notification_status = log_send_result(message, error)
 
-    except Exception as e:
-        logger.error(f"Failed to connect to gmail service: {e}")
-        return f"Failed to connect to gmail service: {e}"
+        if error is None:
+            successfully_sent += 1
+        else:
+            failed_sends += 1
+            failed_entries.append(serialize_email(message, error))
+
+        notification_rows = add_notification_row(
+            notification_rows, message, notification_status
+        )
+
+    save_failed_notifications(bucket, waiting, failed_entries, queue_changed)
+
+    if spool is not None:
+        spool.append(0, notification_rows)
 
     return notification_rows, successfully_sent, failed_sends
 
 
-def send_no_sales(server, message, notification_rows):
+def load_queued_notifications(bucket, ignore_backoff=False):
+    """
+    Reads the retry queue and moves the notifications that used up their attempts to the dead letter file.
+
+    Returns:
+    queued_messages (list): Email objects that are due to be resent \n
+    waiting (list): Queue entries that are still backing off \n
+    notification_rows (list): A "dead-letter" row for each notification that was given up on \n
+    queue_changed (bool): True if the queue has to be saved again at the end of the run. None if the queue couldn't be read, so it is left as it is.
+    """
+
     try:
-        server.send_message(message.message)
-        logger.info(f"Email sent successfully to {notification_address}")
-        notification_row = add_notification_row(notification_rows, message, "sent")
-        return notification_row, 1, 0
+        due, waiting, expired = load_retry_queue(bucket, ignore_backoff=ignore_backoff)
     except Exception as e:
-        logger.error(f"Failed to send email to {notification_address}")
-        notification_row = add_notification_row(notification_rows, message, "failed")
-        return notification_row, 0, 1
+        # Rewriting the queue now would lose every entry in it.
+        logger.error(f"Error reading the retry queue- leaving it as it is: {e}")
+        return [], [], [], None
+
+    if not add_dead_letters(bucket, expired):
+        # Kept in the queue until the dead letter file can be written.
+        waiting = waiting + expired
+        expired = []
+    notification_rows = []
+    for entry in expired:
+        notification_rows = add_notification_row(
+            notification_rows, deserialize_email(entry), "dead-letter"
+        )
+
+    queued_messages = [deserialize_email(entry) for entry in due]
+    return queued_messages, waiting, notification_rows, bool(due or expired)
+
+
+def log_send_result(message, error):
+    """
+    Logs the outcome of sending one Email and returns its status for the Notification sheet: "sent" or "failed".
+    """
+
+    recipient = (
+        message.customer.name if message.customer else get_config().notification_address
+    )
+
+    if error is None:
+        logger.info("Email sent successfully to %s", recipient)
+        return "sent"
+
+    logger.error("Failed to send email to %s: %s", recipient, error)
+    return "failed"
+
+
+def save_failed_notifications(bucket, waiting, failed_entries, queue_changed):
+    """
+    Writes the notifications that failed this run back to the retry queue, along with the ones still backing off.
+    """
+
+    if queue_changed is None:
+        if failed_entries:
+            logger.error(
+                f"{len(failed_entries)} failed notifications were not queued for retry because the retry queue could not be read"
+            )
+        return
+
+    # Only rewrite the queue when this run changed it.
+    if queue_changed or failed_entries:
+        save_retry_queue(bucket, waiting + failed_entries)
 
 
 def add_notification_row(notification_rows, message, notification_status):
@@ -356,7 +320,7 @@ def add_notification_row(notification_rows, message, notification_status):
                 message.customer.name,
                 message.customer.email,
                 ", ".join(message.customer_sales),
-                message.total_revenue,
+                message.total_revenue_cents,
                 notification_status,
             ]
         )
@@ -365,7 +329,7 @@ def add_notification_row(notification_rows, message, notification_status):
             [
                 message.yesterdays_date,
                 "Main Notification Address",
-                notification_address,
+                get_config().notification_address,
                 "No Sales",
                 0,
                 notification_status,
@@ -374,17 +338,29 @@ def add_notification_row(notification_rows, message, notification_status):
     return notification_rows
 
 
-def send_no_sales_notification():
+def send_no_sales_notification(spool=None, yesterdays_date=None):
 
-    yesterdays_date = get_yesterdays_date()
+    config = get_config()
+    yesterdays_date = yesterdays_date or get_yesterdays_date()
     message = create_email_msg(
-        sender_email,
-        [notification_address],
+        config.sender_email,
+        [config.notification_address],
         f"Daily Sales Notification Report {yesterdays_date}",
         f"Sales-Notification service completed successfully- No sales from {yesterdays_date}",
         None,
     )
     notification_rows, successfully_sent, failed_sends = send_notifications(
-        [create_email_obj(message, [], yesterdays_date, 0, customer=None)]
+        [create_email_obj(message, [], yesterdays_date, 0, customer=None)],
+        spool=spool,
     )
     return notification_rows
+
+
+def resend_failed_notifications(bucket=None, spool=None):
+    """
+    Sends only the notifications waiting in the retry queue, without fetching or rendering anything. Used to resend a few failed emails without rerunning the whole job.
+
+    Returns:
+    notification_rows, successfully_sent, failed_sends as in send_notifications()
+    """
+    return send_notifications([], bucket, ignore_backoff=True, spool=spool)
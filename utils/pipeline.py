@@ -0,0 +1,425 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from .config import get_config
+from utils.sales import get_machine_daily_sales, group_sales_by_customer, merge_sales
+from utils.aggregate import aggregate_sales
+from utils.notifications import (
+    render_notification,
+    load_queued_notifications,
+    log_send_result,
+    add_notification_row,
+    save_failed_notifications,
+)
+from utils.retry_queue import serialize_email
+from utils.dedup import TransactionFilter
+from utils.delivery import send_with_retries
+from utils.context import get_context
+from utils.time import get_day_window
+from utils.spans import span
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+# Marks the end of a stage's input.
+_DONE = object()
+
+# Notification rows are handed to the sheet spool in batches of up to this many.
+ROW_BATCH_SIZE = 50
+
+
+@dataclass
+class PipelineResult:
+    """
+    What a pipeline run did.
+
+    sales_by_machine: {machine_id: list of sales from yesterday}, in machine_ids order, for updating the checkpoints. Machines that failed to fetch, and machines with sales of a customer whose notification could not be rendered, are left out. \n
+    notification_rows: The rows written to the Notification sheet. \n
+    customers: Number of customers with sales. \n
+    render_failed: Customers whose totals or notification could not be rendered. Their machines are left out of sales_by_machine and their sales aren't committed to the dedup history, so the next run picks them up again. \n
+    duplicates: Sales dropped because the run had already seen them. \n
+    already_processed: Sales dropped because an earlier run processed them. \n
+    stage_seconds: {stage name: seconds from the start of the run until the stage finished}
+    """
+
+    sales_by_machine: dict = field(default_factory=dict)
+    notification_rows: list = field(default_factory=list)
+    customers: int = 0
+    render_failed: int = 0
+    sent: int = 0
+    failed: int = 0
+    duplicates: int = 0
+    already_processed: int = 0
+    stage_seconds: dict = field(default_factory=dict)
+
+
+async def _run_stage(
+    name, inbox, handle, concurrency, outbox, result, started, finish=None
+):
+    """
+    Runs concurrency copies of handle over the items in inbox until the end of the input, then calls finish and marks the end of outbox.
+    """
+
+    # The stages all start together, so each span runs from the start of the pipeline until the stage is done.
+    with span(f"pipeline.{name}", concurrency=concurrency) as stage_span:
+
+        async def work():
+            while True:
+                item = await inbox.get()
+                if item is _DONE:
+                    # Let the other workers of the stage see the end as well.
+                    await inbox.put(_DONE)
+                    return
+                await handle(item)
+                stage_span.add(items=1)
+
+        await asyncio.gather(*(work() for _ in range(max(1, concurrency))))
+
+        if finish is not None:
+            await finish()
+
+    result.stage_seconds[name] = time.perf_counter() - started
+
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+async def _feed(queue, items):
+    for item in items:
+        await queue.put(item)
+
+
+async def _run_pipeline(
+    machine_ids,
+    checkpoints,
+    config,
+    window,
+    spool,
+    bucket,
+    queue_size,
+    sales_source,
+    dedup,
+):
+    settings = get_config()
+    context = get_context()
+    bucket = bucket or context.bucket
+    # A machine listed twice is only fetched once.
+    machine_ids = list(dict.fromkeys(machine_ids))
+    window = window or get_day_window()
+    session = context.http_session
+    pool = context.smtp_pool
+    limiter = context.rate_limiter
+
+    result = PipelineResult()
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    # A dedicated pool so every stage gets its full concurrency, whatever the default executor size is on this machine.
+    executor = ThreadPoolExecutor(
+        max_workers=settings.fetch_workers + settings.render_workers + pool.size + 1,
+        thread_name_prefix="pipeline",
+    )
+
+    def in_thread(function, *args):
+        return loop.run_in_executor(executor, partial(function, *args))
+
+    # Bounded queues between the stages- a stage that gets ahead waits for the next one to catch up.
+    machines = asyncio.Queue(queue_size)
+    fetched = asyncio.Queue(queue_size)
+    ready_customers = asyncio.Queue(queue_size)
+    outgoing = asyncio.Queue(queue_size)
+    sent = asyncio.Queue(queue_size)
+
+    try:
+        queued_messages, waiting, dead_letter_rows, queue_changed = await in_thread(
+            load_queued_notifications, bucket
+        )
+        result.notification_rows.extend(dead_letter_rows)
+        if spool is not None:
+            spool.append(0, dead_letter_rows)
+
+        # fetch + filter: get_machine_daily_sales() streams each machine and stops reading at the start of yesterday or the checkpoint.
+        async def fetch(machine_id):
+            try:
+                if sales_source is not None:
+                    sales = await in_thread(
+                        sales_source, machine_id, checkpoints.get(machine_id)
+                    )
+                else:
+                    sales = await in_thread(
+                        get_machine_daily_sales,
+                        machine_id,
+                        checkpoints.get(machine_id),
+                        session,
+                        bucket,
+                        window,
+                    )
+            except Exception as e:
+                logger.error("Error fetching sales for %s: %s", machine_id, e)
+                sales = None
+            await fetched.put((machine_id, sales))
+
+        # group: a customer is ready once every machine that sells their products is fetched. Customers without a machines list wait for every machine.
+        remaining_machines = set(machine_ids)
+        pending_sales = {}
+        released = set()
+
+        async def release(customers):
+            # Every customer whose machines were all fetched by now goes to the render stage in one batch, so their totals are computed in one vectorized pass.
+            if not customers:
+                return
+            if not released:
+                # Compile the templates once before the first render, rather than in whichever render thread gets there first. Runs without sales never load Jinja2.
+                from utils.email_templates import compile_email_templates
+
+                compile_email_templates(config.email_template)
+
+            batch = {}
+            for customer in customers:
+                if customer not in released:
+                    result.customers += 1
+                    released.add(customer)
+                batch[customer] = list(merge_sales(pending_sales.pop(customer)))
+            await ready_customers.put(batch)
+
+        async def group(item):
+            machine_id, sales = item
+            remaining_machines.discard(machine_id)
+
+            if sales is not None:
+                # Overlapping or retried fetches return some sales twice- each is only counted once.
+                sales = dedup.new_sales(sales)
+                result.sales_by_machine[machine_id] = sales
+                for customer, customer_sales in group_sales_by_customer(
+                    sales, config.customer_product_dict
+                ).items():
+                    if customer in released:
+                        # The customer file's machines list is missing this machine- these sales get a second email.
+                        logger.warning(
+                            "Sales for %s on machine %s, which is not in their machines list",
+                            customer.name,
+                            machine_id,
+                        )
+                    pending_sales.setdefault(customer, []).append(customer_sales)
+
+            await release(
+                [
+                    customer
+                    for customer in pending_sales
+                    if customer.machines
+                    and remaining_machines.isdisjoint(customer.machines)
+                ]
+            )
+
+        async def group_finish():
+            await release(list(pending_sales))
+
+        # render: totals for a batch of customers in one aggregate_sales() pass, then one notification at a time, so each email can go out while the rest are still being rendered or fetched.
+        yesterdays_date = window.label
+        unrendered_machines = set()
+
+        def render_failed(customers, batch):
+            # Handled like a failed fetch: the machines' checkpoints stay where they are, so the next run sends these sales again.
+            result.render_failed += len(customers)
+            for customer in customers:
+                unrendered_machines.update(sale.machine_id for sale in batch[customer])
+
+        async def render(batch):
+            try:
+                aggregate = await in_thread(
+                    aggregate_sales, batch, config.product_costs
+                )
+            except Exception as e:
+                logger.error(
+                    "Error totalling sales for %s customers: %s", len(batch), e
+                )
+                render_failed(list(batch), batch)
+                return
+
+            # One spool append per batch for the Itemized Receipt and Transaction Log sheets.
+            if spool is not None:
+                spool.append(1, aggregate.receipt_rows)
+                spool.append(2, aggregate.transaction_rows)
+
+            from utils.email_templates import compile_email_templates
+
+            templates = compile_email_templates(config.email_template)
+            for customer, line_items in aggregate.line_items.items():
+                try:
+                    message = await in_thread(
+                        render_notification,
+                        customer,
+                        line_items,
+                        aggregate.totals[customer],
+                        templates,
+                        yesterdays_date,
+                    )
+                except Exception as e:
+                    logger.error(
+                        "Error creating notification for %s: %s", customer.name, e
+                    )
+                    render_failed([customer], batch)
+                    continue
+                await outgoing.put(message)
+
+        # Notifications queued by earlier runs go straight to the send stage.
+        requeue = asyncio.create_task(_feed(outgoing, queued_messages))
+
+        async def render_finish():
+            await requeue
+
+        async def send(message):
+            error = await in_thread(send_with_retries, pool, limiter, message)
+            await sent.put((message, error))
+
+        # persist: record each result and hand the rows to the sheet spool in small batches.
+        failed_entries = []
+        row_batch = []
+
+        def flush_rows():
+            if spool is not None and row_batch:
+                spool.append(0, list(row_batch))
+            row_batch.clear()
+
+        async def persist(item):
+            message, error = item
+            notification_status = log_send_result(message, error)
+
+            if error is None:
+                result.sent += 1
+            else:
+                result.failed += 1
+                failed_entries.append(serialize_email(message, error))
+
+            add_notification_row(row_batch, message, notification_status)
+            result.notification_rows.append(row_batch[-1])
+
+            if len(row_batch) >= ROW_BATCH_SIZE or sent.empty():
+                flush_rows()
+
+        async def persist_finish():
+            flush_rows()
+            await in_thread(
+                save_failed_notifications,
+                bucket,
+                waiting,
+                failed_entries,
+                queue_changed,
+            )
+
+        stages = [
+            _feed(machines, list(machine_ids) + [_DONE]),
+            _run_stage(
+                "fetch",
+                machines,
+                fetch,
+                settings.fetch_workers,
+                fetched,
+                result,
+                started,
+            ),
+            _run_stage(
+                "group",
+                fetched,
+                group,
+                1,
+                ready_customers,
+                result,
+                started,
+                group_finish,
+            ),
+            _run_stage(
+                "render",
+                ready_customers,
+                render,
+                settings.render_workers,
+                outgoing,
+                result,
+                started,
+                render_finish,
+            ),
+            _run_stage("send", outgoing, send, pool.size, sent, result, started),
+            _run_stage(
+                "persist", sent, persist, 1, None, result, started, persist_finish
+            ),
+        ]
+        await asyncio.gather(*stages)
+
+    finally:
+        executor.shutdown(wait=False)
+
+    if unrendered_machines:
+        logger.error(
+            "%s customers could not be rendered- not checkpointing machines %s",
+            result.render_failed,
+            ", ".join(sorted(map(str, unrendered_machines))),
+        )
+        for machine_id in unrendered_machines:
+            dedup.discard(result.sales_by_machine.pop(machine_id, []))
+
+    result.duplicates = dedup.duplicates
+    result.already_processed = dedup.already_processed
+    if dedup.duplicates or dedup.already_processed:
+        logger.warning(
+            "Dropped %s duplicate sales and %s sales processed by an earlier run",
+            dedup.duplicates,
+            dedup.already_processed,
+        )
+
+    # Keep the configured machine order so the checkpoints are updated deterministically.
+    result.sales_by_machine = {
+        machine_id: result.sales_by_machine[machine_id]
+        for machine_id in machine_ids
+        if machine_id in result.sales_by_machine
+    }
+    return result
+
+
+def run_pipeline(
+    machine_ids,
+    checkpoints,
+    config,
+    window=None,
+    spool=None,
+    bucket=None,
+    queue_size=None,
+    sales_source=None,
+    dedup=None,
+):
+    """
+    Runs fetch -> filter -> group -> render -> send -> persist as concurrent asyncio stages connected by bounded queues, so a customer's email is rendered and sent while later machines are still downloading. The run takes about as long as its slowest stage rather than the sum of all of them.
+
+    The blocking work of each stage runs in threads: fetch_workers machines are fetched at once, render_workers notifications are rendered at once and one send per pooled SMTP connection is in flight. Notifications that failed in earlier runs are sent along with the new ones, as in send_notifications().
+
+    Args:
+
+    machine_ids (list): List of machine id strings. \n
+    checkpoints (dict): Checkpoints from load_checkpoints(). \n
+    config (ConfigBundle): The customers, product prices and email template from load_config_bundle(). \n
+    window (DayWindow): The day to report on. Defaults to yesterday. \n
+    spool (SheetSpool): Receives the receipt, transaction and notification rows as they are produced. \n
+    bucket (GCS bucket): Bucket holding the mock sales file and the retry queue. Defaults to the shared context's bucket. \n
+    queue_size (int): The most items waiting between two stages. \n
+    sales_source (function): Called with a machine ID and its checkpoint to get the machine's new sales from yesterday in place of fetching them, for example MergedShards.sales_source when the sales were fetched by sharded tasks. \n
+    dedup (TransactionFilter): Drops the sales already seen. Defaults to one that only drops sales seen twice in this run.
+
+    Returns:
+
+    A PipelineResult
+    """
+
+    return asyncio.run(
+        _run_pipeline(
+            machine_ids,
+            checkpoints or {},
+            config,
+            window,
+            spool,
+            bucket,
+            max(1, queue_size or get_config().pipeline_queue_size),
+            sales_source,
+            dedup or TransactionFilter(),
+        )
+    )
@@ -1,34 +1,78 @@
 import json
+from decimal import Decimal, ROUND_HALF_UP
 from .config import product_file
+from utils.blob_cache import read_blob
 from logger import setup_logging
 #import os
 
 logger = setup_logging(__name__)
 
+
+def to_cents(value):
+    '''
+    Converts a dollar amount from a JSON file or the API to integer cents without going through float arithmetic. Example: 5.1 -> 510
+
+    Args: value (float, int, str or None). None is treated as 0.
+
+    Returns: int
+    '''
+    if value is None:
+        return 0
+    return int(Decimal(str(value)).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def format_cents(cents):
+    '''
+    Formats integer cents as a dollar amount with two decimals. Example: 510 -> "5.10"
+
+    Args: cents (int)
+
+    Returns: str
+    '''
+    sign = "-" if cents < 0 else ""
+    dollars, cents = divmod(abs(cents), 100)
+    return f"{sign}{dollars}.{cents:02d}"
+
+
+def sale_cents(sale, product_costs):
+    '''
+    Returns the revenue of a sale in cents: its quantity at the product's price, or the SettlementValue Nayax reported for it if the product has no price in products.json.
+
+    Args: sale (Sale), product_costs (dict) from load_product_costs()
+
+    Returns: int
+    '''
+    unit_cents = product_costs.get(sale.product_name)
+    if unit_cents is None:
+        return sale.settlement_cents
+    return sale.quantity * unit_cents
+
+
 def load_product_costs(bucket, product_file = product_file):
     '''
-    Opens the products json file and returns a dictionary in the format {"product name": price}. Example: {"Sticker Left" : 5.00 }
+    Opens the products json file and returns a dictionary in the format {"product name": price in cents}. Example: {"Sticker Left" : 500 }
+
+    Prices are held as integer cents from here on so every total is exact.
 
     Args: filename (str) default = product_file from config. 
 
-    Returns: dictionary in the format: {"product name": price}. Example: {"Sticker Left" : 5.00 }
+    Returns: dictionary in the format: {"product name": price in cents}. Example: {"Sticker Left" : 500 }
     '''
 
-    blob = bucket.blob(product_file)
     logger.info(f"Reading products from: {product_file}")
 
     try:
-        # download_as_bytes() returns the content, which we decode to a string
-        products_string = blob.download_as_bytes().decode("utf-8")
+        # read_blob() returns the content from the local cache or GCS, which we decode to a string
+        products_string = read_blob(bucket, product_file).decode("utf-8")
         
         # 3. Load and return the JSON data
         product_data = json.loads(products_string)
-        return {item['name']: item['price'] for item in product_data}
+        return {item['name']: to_cents(item['price']) for item in product_data}
     
     except Exception as e:
         # Handle cases where the file doesn't exist or is empty
         logger.error(f"Error reading {product_file} from GCS: {e}")
-        return [] # Return empty list or handle the error
+        return {} # Return empty dictionary or handle the error
 
 
     # if os.path.exists(product_file):
@@ -38,7 +82,7 @@ def load_product_costs(bucket, product_file = product_file):
     #         with open (filename, "r") as file:
     #             product_data = json.load(file)
 
-    #         return {item['name']: item['price'] for item in product_data}
+    #         return {item['name']: to_cents(item['price']) for item in product_data}
         
     #     except Exception as e:
     #         logger.error(f"Error opening product file: {e}")
@@ -0,0 +1,166 @@
+import json
+from datetime import datetime, timedelta, timezone
+from email import message_from_string
+from email.policy import SMTP
+from .config import get_config, retry_queue_file, dead_letter_file
+from utils.blob_cache import is_not_found
+from utils.customers import Customer
+from utils.time import format_gmt, parse_gmt
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+# Queued notifications wait this long before their next run, doubled for every failed run.
+QUEUE_BACKOFF = timedelta(minutes=15)
+
+
+def serialize_email(message, error=None):
+    """
+    Converts an Email object to a JSON-safe dictionary, including the full MIME message so it can be resent exactly as built.
+    """
+
+    now = datetime.now(timezone.utc)
+    attempts = message.attempts + 1
+
+    return {
+        "message": message.message.as_string(policy=SMTP),
+        "customer": (
+            {
+                "name": message.customer.name,
+                "email": message.customer.email,
+                "products": list(message.customer.products),
+                "machines": list(message.customer.machines),
+            }
+            if message.customer
+            else None
+        ),
+        "customer_sales": list(message.customer_sales),
+        "yesterdays_date": message.yesterdays_date,
+        "total_revenue_cents": message.total_revenue_cents,
+        "attempts": attempts,
+        "last_error": str(error) if error else None,
+        "next_attempt_at": format_gmt(now + QUEUE_BACKOFF * 2 ** (attempts - 1)),
+    }
+
+
+def deserialize_email(data):
+    """
+    Rebuilds an Email object from a dictionary created by serialize_email().
+    """
+
+    # Imported here because utils.notifications uses the retry queue.
+    from utils.notifications import Email
+
+    customer = data["customer"]
+
+    return Email(
+        message_from_string(data["message"]),
+        (
+            Customer(
+                customer["name"],
+                customer["email"],
+                tuple(customer["products"]),
+                tuple(customer.get("machines", ())),
+            )
+            if customer
+            else None
+        ),
+        data["customer_sales"],
+        data["yesterdays_date"],
+        data["total_revenue_cents"],
+        data["attempts"],
+    )
+
+
+def _read_entries(bucket, filename):
+    # Only a missing file means no entries. Any other error is raised, so a file that couldn't be read is never overwritten with an empty list.
+    blob = bucket.blob(filename)
+
+    try:
+        data = blob.download_as_bytes()
+    except Exception as e:
+        if not is_not_found(e):
+            raise
+        # The file won't exist until the first notification fails.
+        logger.info(f"No entries read from {filename}: it doesn't exist yet")
+        return []
+
+    return json.loads(data.decode("utf-8"))
+
+
+def _write_entries(bucket, filename, entries):
+    blob = bucket.blob(filename)
+    blob.upload_from_string(
+        json.dumps(entries, indent=2), content_type="application/json"
+    )
+
+
+def load_retry_queue(bucket, retry_queue_file=retry_queue_file, ignore_backoff=False):
+    """
+    Reads the notifications that failed in earlier runs. With ignore_backoff every entry that hasn't expired is treated as due.
+
+    Returns:
+    A tuple of (due, waiting, expired) lists of serialized entries. due are ready to be retried now, waiting are still backing off, and expired have used up send_max_attempts.
+
+    Raises the read error if the queue exists but can't be read or parsed.
+    """
+
+    now = datetime.now(timezone.utc)
+    send_max_attempts = get_config().send_max_attempts
+    due, waiting, expired = [], [], []
+
+    for entry in _read_entries(bucket, retry_queue_file):
+        if entry["attempts"] >= send_max_attempts:
+            expired.append(entry)
+        elif ignore_backoff or parse_gmt(entry["next_attempt_at"]) <= now:
+            due.append(entry)
+        else:
+            waiting.append(entry)
+
+    if due or waiting or expired:
+        logger.info(
+            f"Retry queue: {len(due)} due, {len(waiting)} waiting, {len(expired)} expired"
+        )
+
+    return due, waiting, expired
+
+
+def save_retry_queue(bucket, entries, retry_queue_file=retry_queue_file):
+    """
+    Replaces the retry queue with entries. An empty list clears it.
+    """
+
+    try:
+        _write_entries(bucket, retry_queue_file, entries)
+        if entries:
+            logger.warning(f"{len(entries)} notifications queued for retry")
+
+    except Exception as e:
+        logger.error(f"Error writing {retry_queue_file} to GCS: {e}")
+
+
+def add_dead_letters(bucket, entries, dead_letter_file=dead_letter_file):
+    """
+    Appends notifications that kept failing to the dead letter file, where they are kept for an operator instead of being retried.
+
+    Returns:
+    True if the entries were written. If the dead letter file can't be read it is left as it is and False is returned.
+    """
+
+    if not entries:
+        return True
+
+    try:
+        _write_entries(
+            bucket,
+            dead_letter_file,
+            _read_entries(bucket, dead_letter_file) + entries,
+        )
+        logger.error(
+            f"Moved {len(entries)} notifications to the dead letter file {dead_letter_file}"
+        )
+        return True
+
+    except Exception as e:
+        logger.error(f"Error writing {dead_letter_file} to GCS: {e}")
+        return False
@@ -1,129 +1,382 @@
-from utils.time import is_yesterday, is_before_yesterday, convert_gmt_pst
-from utils.config import NAYAX_API_KEY
+from utils.time import parse_gmt, format_gmt, get_day_window
+from utils.config import get_config, machine_tz
 from logger import setup_logging
-from utils.customers import load_customers
-import requests
+from utils.checkpoints import is_checkpointed
+from utils.products import to_cents
+from utils.blob_cache import read_blob
+from utils.context import get_context
+from utils.spans import span, current_span
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from operator import attrgetter
+import heapq
+import sys
+import codecs
+import io
+import json
+import re
 
-# For testing:
-from google.cloud import storage
-import os
+logger = setup_logging(__name__)
+
+# Bytes read from the sales response at a time.
+stream_chunk_size = 64 * 1024
+
+_machine_zone = ZoneInfo(machine_tz)
+
+# Whitespace and commas between the sales in the JSON list.
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+@dataclass(frozen=True, slots=True)
+class Sale:
+    transaction_id: int
+    machine_id: str
+    product_name: str
+    quantity: int
+    settlement_cents: int
+    authorized_at: datetime
+
+    @classmethod
+    def from_api(cls, sale: dict, machine_id=None):
+        """
+        Builds a Sale from a sale in the Nayax API response, keeping only the fields the service reads. Product names are interned so every sale of a product shares one string.
+        """
+        return cls(
+            sale.get("TransactionID"),
+            machine_id,
+            sys.intern(sale["ProductName"]),
+            int(sale["Quantity"]),
+            to_cents(sale.get("SettlementValue")),
+            parse_gmt(sale["AuthorizationDateTimeGMT"]),
+        )
+
+    @property
+    def local_time(self):
+        """
+        The sale time converted to the machine's local timezone.
+        """
+        return self.authorized_at.astimezone(_machine_zone)
+
+
+def serialize_sale(sale):
+    """
+    Converts a Sale to a compact JSON-safe list, for storing sales between runs or tasks. deserialize_sale() reverses it.
+    """
+    return [
+        sale.transaction_id,
+        sale.machine_id,
+        sale.product_name,
+        sale.quantity,
+        sale.settlement_cents,
+        format_gmt(sale.authorized_at),
+    ]
+
+
+def deserialize_sale(data):
+    (
+        transaction_id,
+        machine_id,
+        product_name,
+        quantity,
+        settlement_cents,
+        authorized_at,
+    ) = data
+    return Sale(
+        transaction_id,
+        machine_id,
+        sys.intern(product_name),
+        quantity,
+        settlement_cents,
+        parse_gmt(authorized_at),
+    )
+
+
+def get_session():
+    """
+    Returns the keep-alive requests.Session from the shared ServiceContext, so every Nayax API call and fetch worker reuses the same connections instead of opening a new one per machine.
+    """
+    return get_context().http_session
 
 
-logger = setup_logging(__name__)
+def iter_sales(chunks, machine_id=None):
+    """
+    Incrementally parses a JSON list of sales as the bytes arrive and yields each sale as a Sale, which keeps only the fields the service reads.
+
+    Only one sale is fully decoded at a time, so memory stays flat no matter how long the machine's history is. The caller can stop iterating at any point and the rest of the payload is never read.
+
+    Args:
+
+    chunks (iterable): Iterable of bytes, for example response.iter_content(). \n
+    machine_id (str): The machine the sales came from.
+
+    Returns:
+
+    A generator of Sale objects. Raises ValueError once the chunks run out if the list was never closed, so a cut off response isn't mistaken for the machine's whole list.
+    """
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    started = False
+
+    for chunk in chunks:
+        # Drop the part of the buffer that was already parsed.
+        buffer = buffer[pos:] + utf8.decode(chunk)
+        pos = 0
+
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+
+            if pos >= len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != "[":
+                    logger.warning(f"Unexpected Data Format: {buffer[pos:pos + 80]}")
+                    return
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                sale, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The sale is split across chunks- wait for the next one.
+                break
 
+            yield Sale.from_api(sale, machine_id)
 
-def get_last_sales(machine_id):
+    # Only reached if the list was never closed- a payload cut off between two sales is as incomplete as one cut off inside a sale.
+    if started:
+        raise ValueError("Sales payload ended before the end of the list")
+
+
+def get_last_sales(machine_id, session=None, bucket=None):
     """
     Function to connect to the Nayax api. Accepts the machine id to pass as a header. For example: 942488501.
 
-    API should return the machines list of "last sales". Function returns this list in json format.
+    API should return the machines list of "last sales". The response is streamed and parsed with iter_sales(), so sales are yielded as they arrive and the rest of the response is never downloaded once the caller stops iterating.
 
     Args:
 
-    machine_id(str): "012345678"
+    machine_id(str): "012345678" \n
+    session (requests.Session): Session to send the request with. Defaults to the shared session from get_session(). \n
+    bucket (GCS bucket): Bucket holding the mock sales file. Only used when mock_sales_file is set in the config. Defaults to the shared context's bucket.
 
     Returns:
 
-    An list of sales from yesterday in JSON format.
+    A generator of the machine's last sales as Sale objects, newest first.
 
     """
 
-    url = f"https://lynx.nayax.com/operational/v1/machines/{machine_id}/lastSales"
-    headers = {"Authorization": f"Bearer {NAYAX_API_KEY}", "accept": "application/js"}
-
-    # Use an environment variable to define the bucket name for Google Cloud Storage
-    BUCKET_NAME = os.environ.get("CONFIG_BUCKET")
-    # Initialize the storage client and bucket for Google Cloud
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_NAME)
+    config = get_config()
+    mock_sales_file = config.mock_sales_file
 
     # For testing without API connection
-    mock_last_sales_response = load_customers(bucket, "last_sales.json")
-    return mock_last_sales_response
+    if mock_sales_file:
+        if bucket is None:
+            # Use the config bucket from the shared context rather than a new storage client per call
+            bucket = get_context().bucket
+
+        logger.info("Reading sales for %s from: %s", machine_id, mock_sales_file)
+        mock_file = io.BytesIO(read_blob(bucket, mock_sales_file))
+        yield from iter_sales(
+            _count_bytes(iter(lambda: mock_file.read(stream_chunk_size), b"")),
+            machine_id,
+        )
+        return
+
+    url = f"{config.nayax_api_url}/operational/v1/machines/{machine_id}/lastSales"
+
+    if session is None:
+        session = get_session()
+
+    with session.get(url, timeout=config.fetch_timeout, stream=True) as response:
+        # Raise on an error status so the machine is reported as failed rather than as having no sales.
+        response.raise_for_status()
+        logger.info("Succesfully connected to LYNX API for machine %s", machine_id)
+        yield from iter_sales(
+            _count_bytes(response.iter_content(chunk_size=stream_chunk_size)),
+            machine_id,
+        )
+
+
+def _count_bytes(chunks):
+    # Adds the size of each chunk read to the current span, so the fetch records show how much of the response was downloaded.
+    for chunk in chunks:
+        current_span().add(bytes=len(chunk))
+        yield chunk
+
+
+def get_machine_daily_sales(
+    machine_id, checkpoint=None, session=None, bucket=None, window=None
+):
+    """
+    Streams a machine's last sales and returns the new sales from yesterday. The download stops as soon as get_daily_sales() passes the start of yesterday or reaches the machine's checkpoint.
+
+    Args:
 
+    machine_id (str): "012345678" \n
+    checkpoint (dict): The machine's checkpoint from load_checkpoints(), or None. \n
+    session (requests.Session): Passed through to get_last_sales(). \n
+    bucket (GCS bucket): Passed through to get_last_sales(). \n
+    window (DayWindow): Passed through to get_daily_sales().
+
+    Returns:
+
+    A list of the machine's sales from yesterday, newest first.
     """
-    try:
 
-      response = requests.get(url, headers=headers)
+    with span("fetch.machine", machine_id=machine_id) as fetch_span:
+        last_sales = get_last_sales(machine_id, session, bucket)
+
+        try:
+            daily_sales = get_daily_sales(last_sales, checkpoint, window)
+        finally:
+            # Closes the HTTP response or blob reader if the scan stopped early.
+            last_sales.close()
 
-      if response.status_code == 200:
-          last_sales = response.json()
-          logger.info(f"Succesfully connected to LYNX API")
-          return last_sales
-      else:
-          logger.error(f'Error: {response.status_code}')
+        fetch_span.add(items=len(daily_sales))
+        return daily_sales
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error in HTTP request: {e}")
-        return None
+
+def fetch_all_daily_sales(
+    machine_ids, checkpoints=None, bucket=None, window=None, max_workers=None
+):
     """
+    Fetches and filters the sales for every machine concurrently. At most max_workers requests are in flight at once and they all share one keep-alive session, so the total fetch time is set by the slowest machine rather than the sum of all of them.
 
+    A failure for one machine is logged and does not affect the others.
+
+    Args:
 
-def get_daily_sales(last_sales: list):
+    machine_ids (list): List of machine id strings. \n
+    checkpoints (dict): Checkpoints from load_checkpoints(). Defaults to None, which scans every machine's whole list. \n
+    bucket (GCS bucket): Bucket passed through to get_last_sales for the mock sales file. \n
+    window (DayWindow): The day to keep sales from. Defaults to yesterday. \n
+    max_workers (int): Maximum number of concurrent requests. Defaults to fetch_workers from the config.
+
+    Returns:
+
+    A dictionary in the format {machine_id: list of sales from yesterday}, in the same order as machine_ids. Machines that failed are left out.
     """
-    Function takes the API returned list of last sales, uses the is_yesterday function to filter it and returns a new list of the sales from that day.
 
-    Args: Last_sales (list)
+    checkpoints = checkpoints or {}
+    session = get_session()
+
+    # Compute the window once so every machine is cut at exactly the same instants.
+    window = window or get_day_window()
+    results = {}
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers or get_config().fetch_workers)
+    ) as executor:
+        futures = {
+            executor.submit(
+                get_machine_daily_sales,
+                machine_id,
+                checkpoints.get(machine_id),
+                session,
+                bucket,
+                window,
+            ): machine_id
+            for machine_id in machine_ids
+        }
+
+        for future in as_completed(futures):
+            machine_id = futures[future]
+            try:
+                results[machine_id] = future.result()
+            except Exception as e:
+                logger.error("Error fetching sales for %s: %s", machine_id, e)
+
+    # Keep the configured machine order so the combined list is deterministic.
+    return {
+        machine_id: results[machine_id]
+        for machine_id in machine_ids
+        if machine_id in results
+    }
+
+
+get_sale_time = attrgetter("authorized_at")
+
+
+def get_daily_sales(last_sales, checkpoint: dict = None, window=None):
+    """
+    Function takes the API returned last sales and returns a new list of the sales from yesterday.
+
+    The sales are checked one at a time as they are read, in a single pass: sales from today at the front of the list are skipped, and the read stops at the first sale before yesterday or the first sale already processed by a previous run. The cost is O(k) for the k sales read up to that point, and nothing past it is downloaded or parsed. A binary search would need the whole list in memory first, which costs more than the scan it saves on a streamed response.
+
+    Args: Last_sales (iterable) - list or generator of Sale objects from get_last_sales(), newest first. \n
+          checkpoint (dict) - the machine's checkpoint from load_checkpoints(). Defaults to None, which scans the whole list. \n
+          window (DayWindow) - the day to keep sales from. Defaults to yesterday from get_day_window().
 
     Returns: list of sales from yesterday.
 
     """
+
+    if isinstance(last_sales, (dict, str, bytes)) or last_sales is None:
+        logger.warning(f"Unexpected Data Format: {type(last_sales)}")
+        return []
+
+    window = window or get_day_window()
+    window_end = window.end
     daily_sales = []
+    scanned = 0
 
-    if isinstance(last_sales, list):
+    for sale in last_sales:
+        scanned += 1
+        if is_checkpointed(sale, checkpoint) or window.is_before(sale.authorized_at):
+            break
 
-        for sale in last_sales:
-            sale_date = sale.get(
-                "AuthorizationDateTimeGMT", "No Authorization Date Time"
-            )
+        # Sales from today are at the front of the list.
+        if sale.authorized_at < window_end:
+            daily_sales.append(sale)
 
-            if is_yesterday(sale_date):
-                daily_sales.append(sale)
+    current_span().set(scanned=scanned)
+    return daily_sales
 
-            elif is_before_yesterday(sale_date):
-                break
 
-    else:
-        logger.warning(f"Unexpected Data Format: {type(last_sales)}")
+def merge_sales(sales_by_machine):
+    """
+    Heap-merges the per-machine sales lists, each ordered newest first, into one stream ordered newest first across every machine.
 
-    return daily_sales
+    Args:
 
+    sales_by_machine (iterable): Iterable of sales lists, for example the values from fetch_all_daily_sales().
 
-def group_sales_by_customer(
-    daily_sales: list, customer_product_dict: dict, product_costs: dict
-):
+    Returns:
+
+    A generator of sales ordered newest first.
     """
-    Function returns a dictionary with the Customer name as the key and their sales as a list of sales.
+    return heapq.merge(*sales_by_machine, key=get_sale_time, reverse=True)
+
 
-    Args: daily_sales (list) \n
+def group_sales_by_customer(daily_sales: list, customer_product_dict: dict):
+    """
+    Function returns a dictionary with the Customer as the key and their sales as a list of Sale objects.
+
+    Args: daily_sales (list) - list of Sale objects \n
           customer_product_dict(dict)  - dictionary where the keys are products and the values are customer objects. \n
-          product_costs (dict) - dictionary of {"product name": price (float)} \n
 
-    Returns: Dict in the format: {"product name:" product, "settlement_value": settlement_value, "quantity_sold": quantity, "transaction_dt": datetime, "revenue": revenue (float)}
+    Returns: Dict in the format: {Customer: [Sale, ...]}
     """
 
     customer_sales_dict = {}
 
     for sale in daily_sales:
-        product = sale["ProductName"]
-        settlement_value = sale["SettlementValue"]
-        quantity = sale["Quantity"]
-        revenue = product_costs[product] * quantity
-        transaction_dt = str(convert_gmt_pst(sale["AuthorizationDateTimeGMT"]))
-        customer = customer_product_dict.get(product)
+        customer = customer_product_dict.get(sale.product_name)
 
         if customer:
-            sale_info = {
-                "product_name": product,
-                "settlement_value": settlement_value,
-                "quantity_sold": quantity,
-                "transaction_dt": transaction_dt,
-                "revenue": revenue,
-            }
-
             if customer not in customer_sales_dict:
                 customer_sales_dict[customer] = []
-            customer_sales_dict[customer].append(sale_info)
+            customer_sales_dict[customer].append(sale)
 
     return customer_sales_dict
 
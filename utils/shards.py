@@ -0,0 +1,309 @@
+import json
+import os
+import threading
+import zlib
+from dataclasses import dataclass, field
+from .config import get_config, shards_prefix
+from utils.sales import serialize_sale, deserialize_sale
+from utils.checkpoints import is_checkpointed
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+# A Cloud Run Job started with --tasks N runs N copies of the job with CLOUD_RUN_TASK_INDEX 0 to N-1. Each task fetches and filters its share of the machines and writes the sales to a shard file in the shard store. The task that writes the last shard claims the run, merges every shard and does the grouping, rendering, sending and Sheets rows once for the whole fleet.
+
+
+def shard_for(machine_id, task_count):
+    """
+    Returns the index of the task that handles the machine. A CRC of the machine ID gives every task and every run the same answer, unlike hash(), which changes between processes.
+    """
+    return zlib.crc32(str(machine_id).encode("utf-8")) % max(1, task_count)
+
+
+def shard_machines(machine_ids, task_index, task_count):
+    """
+    Returns the machines handled by task task_index of task_count, in the configured order.
+    """
+    return [
+        machine_id
+        for machine_id in machine_ids
+        if shard_for(machine_id, task_count) == task_index
+    ]
+
+
+class DirectoryStore:
+    """
+    A shard store in a local directory, for running the shards on one machine or in testing.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    def write(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        # Readers never see half a shard.
+        os.replace(temp_path, path)
+
+    def read(self, name):
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def create(self, name, data=b""):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return True
+
+    def delete(self, name):
+        path = self._path(name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            # Removes the run's directory once its last file is gone.
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+class BucketStore:
+    """
+    A shard store in the config bucket, under prefix.
+    """
+
+    def __init__(self, bucket, prefix=shards_prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _blob(self, name):
+        return self.bucket.blob(f"{self.prefix}/{name}")
+
+    def write(self, name, data):
+        self._blob(name).upload_from_string(data, content_type="application/json")
+
+    def read(self, name):
+        return self._blob(name).download_as_bytes()
+
+    def exists(self, name):
+        return self._blob(name).exists()
+
+    def create(self, name, data=b""):
+        # Imported here so loading the module doesn't import the Google client.
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            # Generation 0 means the object must not exist yet, so only one task can create it.
+            self._blob(name).upload_from_string(data, if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def delete(self, name):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self._blob(name).delete()
+        except NotFound:
+            pass
+
+
+def open_shard_store(bucket=None):
+    """
+    Returns the shard store named by SHARD_STORE: a local directory, or the config bucket if it is not set.
+    """
+
+    directory = get_config().shard_store
+    if directory:
+        return DirectoryStore(directory)
+    return BucketStore(bucket)
+
+
+def shard_run_key(window):
+    """
+    Names the run the shards belong to. SHARD_RUN_ID comes first, so an operator can point --merge-shards at a failed execution, then CLOUD_RUN_EXECUTION, which every task of a Cloud Run Job execution shares. Without either the shards of the same sales day belong together, so a run that failed before its shards were removed has to be finished with --merge-shards before another can merge.
+    """
+    run_key = get_config().shard_run_id or os.environ.get("CLOUD_RUN_EXECUTION")
+    if run_key:
+        return run_key
+    logger.warning(
+        "Neither CLOUD_RUN_EXECUTION nor SHARD_RUN_ID is set- naming the run by its sales day"
+    )
+    return window.day.isoformat()
+
+
+def _claim_name(run_key):
+    return f"{run_key}/merge.claim"
+
+
+def _shard_name(run_key, task_index, task_count):
+    return f"{run_key}/shard-{task_index:04d}-of-{task_count:04d}.json"
+
+
+def write_shard(
+    store, run_key, task_index, task_count, sales_by_machine, failed, sales_date
+):
+    """
+    Writes one task's sales to the shard store. A task that is retried overwrites its own shard.
+
+    Args:
+    store: From open_shard_store(). \n
+    run_key (str): From shard_run_key(). \n
+    task_index, task_count (int): The task and the number of tasks. \n
+    sales_by_machine (dict): {machine_id: list of Sale} for the task's machines. \n
+    failed (list): The task's machines that could not be fetched. \n
+    sales_date (str): DayWindow.label of the day the sales are from.
+    """
+
+    shard = {
+        "task_index": task_index,
+        "task_count": task_count,
+        "sales_date": sales_date,
+        "machines": {
+            machine_id: [serialize_sale(sale) for sale in sales]
+            for machine_id, sales in sales_by_machine.items()
+        },
+        "failed": list(failed),
+    }
+    data = json.dumps(shard, separators=(",", ":")).encode("utf-8")
+    store.write(_shard_name(run_key, task_index, task_count), data)
+    logger.info(
+        "Wrote shard %s of %s with %s machines to %s",
+        task_index,
+        task_count,
+        len(sales_by_machine),
+        run_key,
+    )
+    return len(data)
+
+
+def claim_merge(store, run_key, task_count):
+    """
+    Returns True if every shard of the run is written and this task is the first to claim the merge. Every task calls it after writing its own shard, so the last one to finish does the merge and the others exit.
+    """
+
+    missing = [
+        task_index
+        for task_index in range(task_count)
+        if not store.exists(_shard_name(run_key, task_index, task_count))
+    ]
+    if missing:
+        logger.info(
+            "Waiting on %s of %s shards- another task will merge them",
+            len(missing),
+            task_count,
+        )
+        return False
+
+    if not store.create(_claim_name(run_key)):
+        logger.info("Another task already claimed the merge of %s", run_key)
+        return False
+
+    return True
+
+
+def remove_shards(store, run_key, task_count):
+    """
+    Deletes every shard of the run and its merge claim. Call it once the merged sales were sent and the checkpoints saved, so the shard store doesn't grow with every run and a run reusing the key starts clean.
+    """
+
+    try:
+        for task_index in range(task_count):
+            store.delete(_shard_name(run_key, task_index, task_count))
+        store.delete(_claim_name(run_key))
+    except Exception as e:
+        logger.error(f"Error removing the shards of {run_key}: {e}")
+        return False
+    logger.info("Removed %s shards of %s", task_count, run_key)
+    return True
+
+
+@dataclass
+class MergedShards:
+    """
+    Every task's sales for one run.
+
+    sales_by_machine: {machine_id: list of Sale}. A machine is in exactly one shard, so a customer whose products are on machines in different shards is grouped once, from all of them. \n
+    failed: Machines that could not be fetched by their task. \n
+    run_key, task_count: The run and its number of shards, for remove_shards() once the run is done.
+    """
+
+    sales_date: str
+    sales_by_machine: dict = field(default_factory=dict)
+    failed: set = field(default_factory=set)
+    run_key: str = ""
+    task_count: int = 0
+
+    def sales_source(self, machine_id, checkpoint=None):
+        """
+        Returns a machine's sales, in place of fetching them, for run_pipeline(sales_source=). Sales up to the checkpoint are left out, so merging the same shards again after the notifications went out sends nothing twice.
+        """
+        if machine_id in self.failed or machine_id not in self.sales_by_machine:
+            raise LookupError(f"No shard has the sales for {machine_id}")
+        return [
+            sale
+            for sale in self.sales_by_machine[machine_id]
+            if not is_checkpointed(sale, checkpoint)
+        ]
+
+
+def load_shards(store, run_key, task_count, sales_date):
+    """
+    Reads and merges every shard of the run.
+
+    Args:
+    store: From open_shard_store(). \n
+    run_key (str): From shard_run_key(). \n
+    task_count (int): The number of tasks. \n
+    sales_date (str): DayWindow.label of the day being reported on. Every shard must be from this day.
+
+    Returns:
+    A MergedShards
+
+    Raises LookupError if a shard can't be read and ValueError if a shard is from another day.
+    """
+
+    merged = MergedShards(sales_date, run_key=run_key, task_count=task_count)
+    for task_index in range(task_count):
+        name = _shard_name(run_key, task_index, task_count)
+        try:
+            shard = json.loads(store.read(name).decode("utf-8"))
+        except Exception as e:
+            raise LookupError(f"Shard {name} could not be read: {e}") from e
+
+        # A task that started on the other side of midnight fetched a different day.
+        if shard["sales_date"] != sales_date:
+            raise ValueError(
+                f"Shard {name} is from {shard['sales_date']}, not {sales_date}"
+            )
+
+        for machine_id, sales in shard["machines"].items():
+            # Keyed by machine, so a machine written by two tasks is only counted once.
+            merged.sales_by_machine[machine_id] = [
+                deserialize_sale(sale) for sale in sales
+            ]
+        merged.failed.update(shard["failed"])
+
+    merged.failed.difference_update(merged.sales_by_machine)
+    logger.info(
+        "Merged %s shards: %s machines, %s failed",
+        task_count,
+        len(merged.sales_by_machine),
+        len(merged.failed),
+    )
+    return merged
@@ -1,6 +1,9 @@
-import gspread
-import os
+import json
+import threading
 from logger import setup_logging
+from utils.config import get_config
+from utils.context import get_context
+from utils.spans import span
 
 logger = setup_logging(__name__)
 
@@ -11,19 +14,26 @@ SCOPES = [
 ]
 
 
-# The ID and range of a sample spreadsheet.
-try:
-    GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
-    GOOGLE_SHEETS_NAME = os.getenv("GOOGLE_SHEETS_NAME")
-    GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
+# The column holding revenue in integer cents for each worksheet index: notifications, itemized receipts and the transaction log.
+WORKSHEET_CENTS_COLUMNS = {0: 4, 1: 5, 2: 5}
 
-except Exception as e:
-    logger.error(f"error retrieving google sheet ID or Name: {e}")
 
+# sheetId of each worksheet in index order, per spreadsheet ID. Fetched once and reused for every write.
+_worksheet_ids = {}
+_worksheet_ids_lock = threading.Lock()
 
-def connect_sheets():
 
-    creds_file = os.getenv("GOOGLE_SHEETS_CREDENTIALS")
+def open_sheet():
+    """
+    Authenticates with the service account credentials and opens the Google Sheet. Use connect_sheets() to get the sheet shared by the run instead of authenticating again.
+    """
+
+    # gspread and the Google auth libraries are only loaded once a run has rows to write.
+    import gspread
+
+    # The ID and name of the spreadsheet, and the service account credentials file.
+    config = get_config()
+    creds_file = config.google_sheets_credentials
 
     # Define the scope
     scopes = [
@@ -35,32 +45,147 @@ def connect_sheets():
 
     try:
 
-        gc = gspread.service_account(creds_file, scopes=scopes)
-        sheet = gc.open_by_key(GOOGLE_SHEETS_ID)
+        with span("sheets.connect"):
+            gc = gspread.service_account(creds_file, scopes=scopes)
+            sheet = gc.open_by_key(config.google_sheets_id)
 
     except Exception as e:
-        logger.error(f"Error opening google sheet {GOOGLE_SHEETS_NAME}: {str(e)}")
+        logger.error(
+            f"Error opening google sheet {config.google_sheets_name}: {str(e)}"
+        )
+        raise
 
     return sheet
 
 
-def write_to_sheet(sheet, index, rows):
+def connect_sheets():
+    """
+    Returns the Google Sheet from the shared ServiceContext. The sheet is only opened and authenticated the first time it is needed in a run.
+    """
+
+    return get_context().sheet
+
+
+def get_worksheet_ids(sheet):
+    """
+    Returns the sheetId of every worksheet in the spreadsheet, in index order. The spreadsheet metadata is only fetched the first time, so later writes need no lookups.
+    """
+
+    with _worksheet_ids_lock:
+        if sheet.id not in _worksheet_ids:
+            metadata = sheet.fetch_sheet_metadata(
+                params={"fields": "sheets.properties(sheetId,index)"}
+            )
+            properties = sorted(
+                (worksheet["properties"] for worksheet in metadata["sheets"]),
+                key=lambda worksheet: worksheet.get("index", 0),
+            )
+            _worksheet_ids[sheet.id] = [
+                worksheet["sheetId"] for worksheet in properties
+            ]
+
+        return _worksheet_ids[sheet.id]
+
+
+def to_cell(value):
+    """
+    Converts a python value to a Sheets API CellData, written as-is like append_rows does by default.
+    """
+
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {"userEnteredValue": {"boolValue": value}}
+    if isinstance(value, (int, float)):
+        return {"userEnteredValue": {"numberValue": value}}
+    return {"userEnteredValue": {"stringValue": str(value)}}
+
+
+def append_cells_request(sheet_id, rows):
+    """
+    Builds an appendCells request that adds rows after the last row with data in the worksheet.
+    """
+
+    return {
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [to_cell(value) for value in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def write_sheets(sheet, rows_by_index):
     """
-    Takes a sheet object from connect_sheets. Opens the worksheet at index and appends rows
+    Appends rows to several worksheets in a single spreadsheets.batchUpdate request.
 
     Args:
 
-    sheet (gspread obj): A sheets object returned from opening a google sheet. \n
+    sheet (gspread obj): A sheets object returned from connect_sheets. \n
 
-    index (int): Index of the worksheet you want to write to. \n
+    rows_by_index (dict): {worksheet index: rows}. Example: {0: notification_rows, 1: itemized_receipt_rows, 2: sales_list}
 
-    rows (list): A list including the values to write to the row. Example: [yesterdays_date, customer.name, customer.email, product_name, quantity_sold, revenue]
+    Revenue is held in integer cents until here and written to the sheet in dollars.
 
+    Returns:
+
+    True if the rows were written, False if not.
     """
 
     try:
-        worksheet = sheet.get_worksheet(index)
-        worksheet.append_rows(rows)
+        with span("sheets.write") as write_span:
+            worksheet_ids = get_worksheet_ids(sheet)
+            requests = [
+                append_cells_request(
+                    worksheet_ids[index],
+                    cents_to_dollars(rows, WORKSHEET_CENTS_COLUMNS.get(index)),
+                )
+                for index, rows in rows_by_index.items()
+                if rows
+            ]
+
+            if requests:
+                body = {"requests": requests}
+                write_span.add(
+                    items=sum(len(rows) for rows in rows_by_index.values()),
+                    bytes=len(json.dumps(body)),
+                ).set(worksheets=len(requests))
+                sheet.batch_update(body)
+        return True
 
     except Exception as e:
+        # The worksheets may have changed- look them up again next time.
+        with _worksheet_ids_lock:
+            _worksheet_ids.pop(getattr(sheet, "id", None), None)
         logger.error(f"Error writing to sheet: {e}")
+        return False
+
+
+def write_to_sheet(sheet, index, rows):
+    """
+    Takes a sheet object from connect_sheets. Appends rows to the worksheet at index. Use write_sheets() to write to several worksheets in one request.
+
+    Args:
+
+    sheet (gspread obj): A sheets object returned from opening a google sheet. \n
+
+    index (int): Index of the worksheet you want to write to. \n
+
+    rows (list): A list including the values to write to the row. Example: [yesterdays_date, customer.name, customer.email, product_name, quantity_sold, revenue_cents]
+
+    Revenue is held in integer cents until here and written to the sheet in dollars.
+
+    """
+
+    return write_sheets(sheet, {index: rows})
+
+
+def cents_to_dollars(rows, column):
+    """
+    Returns a copy of rows with the integer cents in column converted to dollars for the sheet. Rows are returned unchanged if column is None.
+    """
+
+    if column is None:
+        return rows
+
+    return [row[:column] + [row[column] / 100] + row[column + 1 :] for row in rows]
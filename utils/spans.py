@@ -0,0 +1,215 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+from logger import setup_logging
+
+# Span records go through the queued logging from setup_logging() and are always written as one JSON object per line, which Cloud Logging stores as a structured jsonPayload that dashboards can query directly.
+_span_logger = setup_logging("spans")
+
+# The span the current thread or asyncio task is inside of, so code further down can add its counts without the span being passed in.
+_current_span = ContextVar("current_span", default=None)
+
+
+class RunStats:
+    """
+    Totals of every span finished in the run, grouped by span name, for the run summary.
+    """
+
+    def __init__(self, run_id=None):
+        # Cloud Run sets CLOUD_RUN_EXECUTION for jobs, which ties the records to the execution in the console.
+        self.run_id = (
+            run_id or os.environ.get("CLOUD_RUN_EXECUTION") or uuid.uuid4().hex
+        )
+        self.started = time.perf_counter()
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            stats = self._spans.setdefault(
+                record["span"],
+                {"count": 0, "errors": 0, "duration_ms": 0.0, "max_ms": 0.0},
+            )
+            stats["count"] += 1
+            stats["errors"] += record["status"] != "ok"
+            stats["duration_ms"] += record["duration_ms"]
+            stats["max_ms"] = max(stats["max_ms"], record["duration_ms"])
+            for counter in ("items", "bytes"):
+                if counter in record:
+                    stats[counter] = stats.get(counter, 0) + record[counter]
+
+    def summary(self):
+        with self._lock:
+            return {
+                name: dict(stats, duration_ms=round(stats["duration_ms"], 3))
+                for name, stats in self._spans.items()
+            }
+
+
+_run = RunStats()
+
+
+def start_run(run_id=None):
+    """
+    Starts a new run summary. Spans finished before this are dropped from it.
+    """
+    global _run
+
+    _run = RunStats(run_id)
+    return _run
+
+
+def current_run():
+    """
+    Returns the RunStats of the current run, for reading the span totals without parsing the log.
+    """
+    return _run
+
+
+def _emit(record, severity="INFO"):
+    record = {"severity": severity, "run_id": _run.run_id, **record}
+    _span_logger.log(
+        logging.ERROR if severity == "ERROR" else logging.INFO,
+        record["message"],
+        extra={"json_fields": record},
+    )
+
+
+class Span(ContextDecorator):
+    """
+    Times a stage of the run and writes one JSON record when it ends, with its duration, the item and byte counts added to it and any other fields.
+
+    Use it as a context manager:
+
+        with span("sheets.write", worksheets=3) as s:
+            ...
+            s.add(items=len(rows), bytes=len(body))
+
+    or as a decorator, which times every call separately:
+
+        @span("config.load")
+        def load_config_bundle(bucket): ...
+
+    Code running inside a span can add to it with current_span().add().
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.items = None
+        self.bytes = None
+        self.duration = None
+        self._start = None
+        self._token = None
+
+    def _recreate_cm(self):
+        # A decorated function can run in several threads at once, so each call gets its own span.
+        return Span(self.name, **self.fields)
+
+    def add(self, items=0, bytes=0):
+        """
+        Adds to the number of items and bytes the span handled.
+        """
+        if items:
+            self.items = (self.items or 0) + items
+        if bytes:
+            self.bytes = (self.bytes or 0) + bytes
+        return self
+
+    def set(self, **fields):
+        """
+        Adds fields to the span's record.
+        """
+        self.fields.update(fields)
+        return self
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            self.fields.setdefault("parent", parent.name)
+        self._token = _current_span.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+
+        fields = dict(self.fields)
+        if exc_type is not None:
+            fields["error"] = exc_type.__name__
+        _record(self.name, self.duration, self.items, self.bytes, exc_type, fields)
+        return False
+
+
+def span(name, **fields):
+    """
+    Returns a Span named name, for timing a stage as a context manager or decorator. Names are dotted by area, for example "fetch.machine" or "sheets.write".
+    """
+    return Span(name, **fields)
+
+
+class _NoSpan:
+    # Stands in for current_span() outside of any span, so callers don't need to check.
+    name = None
+
+    def add(self, items=0, bytes=0):
+        return self
+
+    def set(self, **fields):
+        return self
+
+
+_no_span = _NoSpan()
+
+
+def current_span():
+    """
+    Returns the innermost open span in this thread or asyncio task. Outside of a span, the counts added to the returned object are ignored.
+    """
+    return _current_span.get() or _no_span
+
+
+def record_span(name, seconds, items=None, bytes=None, **fields):
+    """
+    Writes a span record for a duration that was measured some other way, for example the import time measured before this module was loaded.
+    """
+    _record(name, seconds, items, bytes, None, fields)
+
+
+def _record(name, seconds, items, bytes, exc_type, fields):
+    record = {
+        "message": f"span {name} took {seconds * 1000:.1f} ms",
+        "span": name,
+        "duration_ms": round(seconds * 1000, 3),
+        "status": "ok" if exc_type is None else "error",
+    }
+    if items is not None:
+        record["items"] = items
+    if bytes is not None:
+        record["bytes"] = bytes
+    record.update(fields)
+
+    _run.add(record)
+    _emit(record, "INFO" if exc_type is None else "ERROR")
+
+
+def emit_run_summary(**fields):
+    """
+    Writes one record summarising the run: the total time since start_run() and, for each span name, how many times it ran, its total and longest duration, errors and the items and bytes it handled.
+    """
+    duration = time.perf_counter() - _run.started
+    _emit(
+        {
+            "message": f"run took {duration * 1000:.1f} ms",
+            "span": "run",
+            "run_summary": True,
+            "duration_ms": round(duration * 1000, 3),
+            **fields,
+            "spans": _run.summary(),
+        }
+    )
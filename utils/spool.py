@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+from .config import get_config, sheets_spool_file
+from utils.sheets import connect_sheets, write_sheets
+from logger import setup_logging
+
+logger = setup_logging(__name__)
+
+# Longest wait between flush attempts while Google Sheets keeps failing.
+MAX_FLUSH_BACKOFF = 10
+
+
+class SheetSpool:
+    """
+    Write-behind buffer for Google Sheets rows. append() records the rows in a local append-only JSON lines file and returns immediately, and a background thread writes everything pending to Sheets in one batched request, so Sheets latency overlaps email delivery instead of following it.
+
+    Rows left over from a run that crashed or timed out are replayed by the next one: from the local file if it still exists, and from sheets_spool_file in the bucket, where close() uploads anything it could not write. Rows are written at least once- a crash between a successful write and the spool being trimmed replays them.
+    """
+
+    def __init__(
+        self,
+        bucket=None,
+        connect=connect_sheets,
+        spool_dir=None,
+        spool_file=sheets_spool_file,
+        flush_interval=None,
+    ):
+        config = get_config()
+        spool_dir = config.sheets_spool_dir if spool_dir is None else spool_dir
+        flush_interval = (
+            config.sheets_flush_interval if flush_interval is None else flush_interval
+        )
+
+        self.bucket = bucket
+        self.spool_file = spool_file
+        self.path = os.path.join(spool_dir, spool_file) if spool_dir else None
+        self.flush_interval = flush_interval
+        self._connect = connect
+        self._sheet = None
+        self._pending = []
+        self._replayed_from_bucket = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.rows_written = 0
+
+    def start(self):
+        """
+        Loads the rows left over from earlier runs and starts the background writer.
+        """
+
+        leftovers = self._read_local() + self._read_bucket()
+        if leftovers:
+            logger.info(f"Replaying {len(leftovers)} spooled Sheets writes")
+            with self._lock:
+                self._pending.extend(leftovers)
+                self._rewrite()
+
+        self._thread = threading.Thread(
+            target=self._run, name="sheet-spool", daemon=True
+        )
+        self._thread.start()
+        if leftovers:
+            self._wake.set()
+        return self
+
+    def append(self, index, rows):
+        """
+        Spools rows for the worksheet at index. The rows are on disk when this returns and are written to Sheets by the background thread.
+
+        Args:
+        index (int): Index of the worksheet: 0 notifications, 1 itemized receipts, 2 transaction log \n
+        rows (list): The rows, with revenue in integer cents as for write_sheets()
+        """
+
+        if not rows:
+            return
+
+        record = {"index": index, "rows": rows}
+        with self._lock:
+            self._pending.append(record)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as spool:
+                    spool.write(json.dumps(record) + "\n")
+                    spool.flush()
+                    os.fsync(spool.fileno())
+
+        self._wake.set()
+
+    def close(self, timeout=None):
+        """
+        Waits up to timeout seconds for the pending rows to be written. Anything still unwritten is uploaded to the bucket for the next run to replay.
+
+        The pending rows are uploaded before the wait as well. Cloud Run kills a task 10 seconds after SIGTERM, which can be before the wait is over, and the local spool doesn't outlive the instance. The upload is replaced or deleted once the writer is done.
+
+        Returns:
+        The number of rows that could not be written.
+        """
+
+        if timeout is None:
+            timeout = get_config().sheets_spool_timeout
+
+        uploaded = False
+        if self._thread is not None:
+            with self._lock:
+                pending = list(self._pending)
+            if pending:
+                uploaded = self._save_bucket(pending)
+
+            self._stopping.set()
+            self._wake.set()
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error(f"Sheets writes did not finish within {timeout} seconds")
+            self._thread = None
+
+        with self._lock:
+            pending = list(self._pending)
+
+        if pending:
+            # Once the rows are in the bucket the local copy would only replay them twice.
+            if self._save_bucket(pending):
+                logger.warning(
+                    f"Saved {len(pending)} unwritten Sheets writes to {self.spool_file}"
+                )
+                with self._lock:
+                    self._pending = []
+                    self._rewrite()
+        elif uploaded or self._replayed_from_bucket:
+            self._save_bucket([])
+            self._replayed_from_bucket = False
+
+        return sum(len(record["rows"]) for record in pending)
+
+    def _run(self):
+        failures = 0
+
+        while True:
+            if failures:
+                self._stopping.wait(
+                    min(self.flush_interval * 2**failures, MAX_FLUSH_BACKOFF)
+                )
+            else:
+                self._wake.wait()
+                # Gather rows appended in quick succession into the same request.
+                self._stopping.wait(self.flush_interval)
+            self._wake.clear()
+            stopping = self._stopping.is_set()
+
+            failures = 0 if self._flush() else failures + 1
+
+            # One last attempt is made after close() is called.
+            if stopping:
+                return
+
+    def _flush(self):
+        with self._lock:
+            batch = list(self._pending)
+
+        if not batch:
+            return True
+
+        try:
+            if self._sheet is None:
+                self._sheet = self._connect()
+        except Exception as e:
+            logger.error(f"Error connecting to sheets: {e}")
+            return False
+
+        rows_by_index = {}
+        for record in batch:
+            rows_by_index.setdefault(record["index"], []).extend(record["rows"])
+
+        if not write_sheets(self._sheet, rows_by_index):
+            return False
+
+        rows = sum(len(record["rows"]) for record in batch)
+        self.rows_written += rows
+        logger.info("Wrote %d spooled rows to sheets", rows)
+
+        with self._lock:
+            del self._pending[: len(batch)]
+            self._rewrite()
+        return True
+
+    def _rewrite(self):
+        # Replaces the spool file with the pending records. Called with the lock held.
+        if not self.path:
+            return
+
+        if not self._pending:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as spool:
+            spool.writelines(json.dumps(record) + "\n" for record in self._pending)
+        os.replace(temp_path, self.path)
+
+    def _read_local(self):
+        if not self.path:
+            return []
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            with open(self.path, encoding="utf-8") as spool:
+                return parse_spool(spool.read())
+        except FileNotFoundError:
+            return []
+
+    def _read_bucket(self):
+        if self.bucket is None:
+            return []
+
+        try:
+            records = parse_spool(
+                self.bucket.blob(self.spool_file).download_as_bytes().decode("utf-8")
+            )
+        except Exception as e:
+            # The file only exists after a run that could not write to Sheets.
+            logger.info(f"No spooled Sheets writes read from {self.spool_file}: {e}")
+            return []
+
+        self._replayed_from_bucket = True
+        return records
+
+    def _save_bucket(self, records):
+        if self.bucket is None:
+            return False
+
+        blob = self.bucket.blob(self.spool_file)
+        try:
+            if records:
+                blob.upload_from_string(
+                    "".join(json.dumps(record) + "\n" for record in records),
+                    content_type="application/jsonl",
+                )
+            else:
+                blob.delete()
+            return True
+        except Exception as e:
+            logger.error(f"Error saving {self.spool_file} to GCS: {e}")
+            return False
+
+
+def parse_spool(text):
+    """
+    Parses a JSON lines spool. A torn last line from a crash mid-write is skipped.
+    """
+
+    records = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            logger.warning("Skipping a partially written spool line")
+    return records
@@ -1,8 +1,93 @@
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, time, timedelta, timezone
+from dataclasses import dataclass
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 from .config import machine_tz
 
+# Maximum number of parsed timestamps kept by parse_gmt and convert_gmt_pst.
+TIMESTAMP_CACHE_SIZE = 65536
 
+
+@dataclass(frozen=True)
+class DayWindow:
+    """
+    A local calendar day of the machines, precomputed as UTC instants so a sale time can be checked with a plain comparison.
+
+    A sale is in the window if start <= sale time < end.
+    """
+
+    day: date
+    start: datetime
+    end: datetime
+    machine_tz: str = machine_tz
+
+    @property
+    def label(self):
+        # Formats the day in the traditional mo/day/year format
+        return self.day.strftime("%m-%d-%Y")
+
+    def contains(self, instant: datetime) -> bool:
+        return self.start <= instant < self.end
+
+    def is_before(self, instant: datetime) -> bool:
+        return instant < self.start
+
+
+def get_day_window(machine_tz: str = machine_tz, days_ago: int = 1, now=None):
+    """
+    Computes the UTC start and end of a local day of the machines. Call it once per run and share the result, rather than checking every sale against datetime.now().
+
+    Args:
+
+    machine_tz (str): Timezone of the machine- defaults to the machine timezone from config if not specified. \n
+    days_ago (int): How many days before today. Defaults to 1 (yesterday). \n
+    now (datetime): The current time. Defaults to datetime.now().
+
+    Returns:
+
+    A DayWindow
+    """
+    tz = ZoneInfo(machine_tz)
+    todays_date = (now or datetime.now(tz)).astimezone(tz).date()
+    day = todays_date - timedelta(days=days_ago)
+
+    # Combining with the zone handles the 23 and 25 hour days around daylight saving changes.
+    start = datetime.combine(day, time(), tzinfo=tz).astimezone(timezone.utc)
+    end = datetime.combine(day + timedelta(days=1), time(), tzinfo=tz).astimezone(
+        timezone.utc
+    )
+    return DayWindow(day, start, end, machine_tz)
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_gmt(gmt_datetime: str) -> datetime:
+    """
+    Parses a GMT datetime string from the API into a timezone aware datetime. Results are memoized, so every stage that reads the same sale shares one parse.
+
+    Args:
+
+    gmt_datetime (str): Datetime string in ISO8601 format. Example: "2025-10-06T16:54:51.225Z"
+
+    Returns:
+
+    A datetime in UTC
+
+    """
+    return datetime.fromisoformat(gmt_datetime.replace("Z", "+00:00"))
+
+
+def format_gmt(gmt_dt: datetime) -> str:
+    """
+    Formats a UTC datetime in the same ISO8601 format the API uses. Example: "2025-10-06T16:54:51.225Z"
+    """
+    return (
+        gmt_dt.astimezone(timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
 def convert_gmt_pst(gmt_datetime: str, machine_tz: str = machine_tz) -> datetime:
     """
     Since the API returns GMT time, this function converts it to the local machine time.
@@ -19,31 +104,19 @@ def convert_gmt_pst(gmt_datetime: str, machine_tz: str = machine_tz) -> datetime
     A datetime string converted the machine's local timezone
 
     """
-    gmt_dt = datetime.fromisoformat(gmt_datetime.replace("Z", "+00:00"))
+    gmt_dt = parse_gmt(gmt_datetime)
     machine_dt = gmt_dt.astimezone(ZoneInfo(machine_tz))
     return machine_dt
 
 
-def get_machine_sale_date(sale_date):
-    local_now = datetime.now(ZoneInfo(machine_tz))
-    todays_date = local_now.date()
-
-    yesterdays_date = todays_date - timedelta(days=1)
-    # May need this if the API actually returns the local time and not the GMT time- according to docs it is GMT.
-    # date_datetime = datetime.fromisoformat(sale_date.replace("Z", "+00:00"))
-    # dt_sale_date = date_datetime.date()
-    machine_sale_dt = convert_gmt_pst(sale_date)
-    machine_sale_date = machine_sale_dt.date()
-    return machine_sale_date, yesterdays_date
-
-
-def is_yesterday(sale_date):
+def is_yesterday(sale_date, window: DayWindow = None):
     """
-    Takes the sale date from the API response: "AuthorizationDateTimeGMT" and converts it to machine local time (PST) using the convert_gmt_pst function. Returns True if the date of the sale matches yesterdays date, False if not.
+    Takes the sale date from the API response: "AuthorizationDateTimeGMT" and returns True if the sale falls within yesterday in machine local time (PST), False if not.
 
     Args:
 
-    sale_date (str): Datetime string in ISO8601 format. Example: "2025-10-06T16:54:51.225Z"
+    sale_date (str): Datetime string in ISO8601 format. Example: "2025-10-06T16:54:51.225Z" \n
+    window (DayWindow): Yesterday's window. Pass the run's window when checking many sales- defaults to computing a new one.
 
     Returns:
 
@@ -51,41 +124,30 @@ def is_yesterday(sale_date):
 
     """
 
-    machine_sale_date, yesterdays_date = get_machine_sale_date(sale_date)
-
-    if machine_sale_date == yesterdays_date:
-        return True
-    else:
-        return False
+    window = window or get_day_window()
+    return window.contains(parse_gmt(sale_date))
 
 
-def is_before_yesterday(sale_date):
+def is_before_yesterday(sale_date, window: DayWindow = None):
     """
     Compares the passed in date to yesterdays date. If it is before, it returns True. Since the API response should be ordered, we shouldn't need to keep parsing the list once it hits a date before yesterday.
 
     Args:
 
-    sale_date (str): Datetime string in ISO8601 format. Example: "2025-10-06T16:54:51.225Z"
+    sale_date (str): Datetime string in ISO8601 format. Example: "2025-10-06T16:54:51.225Z" \n
+    window (DayWindow): Yesterday's window. Pass the run's window when checking many sales- defaults to computing a new one.
 
     Returns:
 
     Boolean
     """
 
-    machine_sale_date, yesterdays_date = get_machine_sale_date(sale_date)
-
-    if machine_sale_date < yesterdays_date:
-        return True
-    else:
-        return False
+    window = window or get_day_window()
+    return window.is_before(parse_gmt(sale_date))
 
 
 def get_yesterdays_date():
-    local_now = datetime.now(ZoneInfo(machine_tz))
-    todays_date = local_now.date()
-
-    yesterdays_date = (todays_date - timedelta(days=1)).strftime(
-        "%m-%d-%Y"
-    )  # Formats yesterdays date in the traditional mo/day/year format
-
-    return yesterdays_date
+    """
+    Returns yesterdays date in the machine timezone in the traditional mo/day/year format.
+    """
+    return get_day_window().label